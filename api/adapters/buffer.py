@@ -0,0 +1,453 @@
+import abc
+import json
+import struct
+import uuid
+from datetime import datetime, timedelta
+from collections import deque
+from typing import Deque, Dict, List, Optional, Tuple
+
+import redis.asyncio as redis
+
+from api import config
+from api.utils import metrics
+from api.utils.aggregation import minute_of
+from api.utils.user_state import UserStateCache
+
+ACCEPTED = "accepted"
+DUPLICATE = "duplicate"
+OUT_OF_ORDER = "out_of_order"
+# The buffer is empty and the newest stored minute of the user is not known
+# to the buffer: call again with `floors` read from the repository.
+UNKNOWN = "unknown"
+
+NO_FLOOR = object()
+
+
+class AbstractBuffer(abc.ABC):
+    """Per-user buffer of the points of the minute that is being collected.
+
+    Entries are dicts with the PutLocation fields, timestamps in UTC.
+    Appending a point does the whole ingest step for that point: dedupe,
+    newer-than check, append and, when the point is a minute or more after
+    the oldest buffered one, handing back the buffered entries (newest first)
+    so they can be persisted, the point itself starting the next buffer.
+
+    In write-behind mode the handed back entries go to a queue of closed
+    buffers instead, drained by the flusher with `pop_closed`.
+    """
+
+    async def append(self, entry: dict, floor=NO_FLOOR) -> Tuple[str, List[dict]]:
+        floors = {} if floor is NO_FLOOR else {entry["user_id"]: floor}
+        return (await self.append_many([entry], floors))[0]
+
+    @abc.abstractmethod
+    async def append_many(self, entries: List[dict],
+                          floors: Dict[str, Optional[datetime]] = None
+                          ) -> List[Tuple[str, List[dict]]]:
+        """Appends the entries in order, returning (status, flushed) for each.
+
+        `floors` maps user ids to the timestamp of their newest stored
+        location (None if they have none), used when their buffer is empty.
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def pop_closed(self, count: int) -> List[List[dict]]:
+        """Takes up to `count` closed buffers off the write-behind queue."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def requeue_closed(self, buffers: List[List[dict]]):
+        """Puts buffers taken with `pop_closed` back at the head of the queue."""
+        raise NotImplementedError
+
+
+def create_client(decode_responses: bool = True) -> redis.Redis:
+    pool = redis.BlockingConnectionPool(**config.get_redis_host_and_port(),
+                                        **config.get_redis_pool_config(),
+                                        db=0, decode_responses=decode_responses)
+    return redis.Redis(connection_pool=pool)
+
+
+EPOCH = datetime(1970, 1, 1)
+ONE_MICROSECOND = timedelta(microseconds=1)
+
+# How long the newest stored minute of a user is remembered once read from
+# the repository, in seconds.
+FLOOR_TTL = 24 * 60 * 60
+
+CLOSED_QUEUE = "buffer:closed"
+# A random value set when missing, so a new value tells that redis lost
+# the buffers
+EPOCH_KEY = "buffer:epoch"
+
+APPEND_SECONDS = metrics.REDIS_SECONDS.labels("append_many")
+POP_CLOSED_SECONDS = metrics.REDIS_SECONDS.labels("pop_closed")
+REQUEUE_CLOSED_SECONDS = metrics.REDIS_SECONDS.labels("requeue_closed")
+
+# KEYS: buffer list, timestamps set, newest stored minute, closed queue
+# ARGV: entry json, iso timestamp, epoch microseconds, floor (epoch
+#       microseconds, "none" when the user has no stored locations, "" when
+#       not known), floor ttl, "1" to queue closed buffers
+APPEND_SCRIPT = """
+local function to_us(iso)
+    local y, m, d, hh, mm, ss, frac = string.match(
+        iso, "^(%d+)-(%d+)-(%d+)T(%d+):(%d+):(%d+)%.?(%d*)")
+    y, m, d = tonumber(y), tonumber(m), tonumber(d)
+    if m <= 2 then y = y - 1 end
+    local era = math.floor(y / 400)
+    local yoe = y - era * 400
+    local doy = math.floor((153 * ((m + 9) % 12) + 2) / 5) + d - 1
+    local doe = yoe * 365 + math.floor(yoe / 4) - math.floor(yoe / 100) + doy
+    local days = era * 146097 + doe - 719468
+    local us = 0
+    if frac ~= "" then us = tonumber(frac) * 10 ^ (6 - #frac) end
+    return ((days * 24 + tonumber(hh)) * 60 + tonumber(mm)) * 60000000
+        + tonumber(ss) * 1000000 + us
+end
+
+local ts = tonumber(ARGV[3])
+local oldest = redis.call("LINDEX", KEYS[1], -1)
+if oldest then
+    if ts - to_us(cjson.decode(oldest)["timestamp"]) >= 60000000 then
+        local flushed = redis.call("LRANGE", KEYS[1], 0, -1)
+        local newest = to_us(cjson.decode(flushed[1])["timestamp"])
+        redis.call("DEL", KEYS[1], KEYS[2])
+        redis.call("LPUSH", KEYS[1], ARGV[1])
+        redis.call("SADD", KEYS[2], ARGV[2])
+        redis.call("SET", KEYS[3],
+                   string.format("%.0f", newest - newest % 60000000),
+                   "EX", ARGV[5])
+        if ARGV[6] == "1" then
+            redis.call("RPUSH", KEYS[4], "[" .. table.concat(flushed, ",") .. "]")
+            return {"accepted"}
+        end
+        return {"accepted", flushed}
+    end
+    if redis.call("SISMEMBER", KEYS[2], ARGV[2]) == 1 then
+        return {"duplicate"}
+    end
+    local newest = redis.call("LINDEX", KEYS[1], 0)
+    if ts <= to_us(cjson.decode(newest)["timestamp"]) then
+        return {"out_of_order"}
+    end
+else
+    local floor = redis.call("GET", KEYS[3])
+    if not floor then
+        if ARGV[4] == "" then
+            return {"unknown"}
+        end
+        floor = ARGV[4]
+        redis.call("SET", KEYS[3], floor, "EX", ARGV[5])
+    end
+    if floor ~= "none" and ts <= tonumber(floor) then
+        return {"out_of_order"}
+    end
+end
+redis.call("LPUSH", KEYS[1], ARGV[1])
+redis.call("SADD", KEYS[2], ARGV[2])
+return {"accepted"}
+"""
+
+
+def _to_us(timestamp: datetime) -> int:
+    return (timestamp - EPOCH) // ONE_MICROSECOND
+
+
+def _floor_arg(floors: Dict[str, Optional[datetime]], user_id: str) -> str:
+    # As the scripts take it: "" when not known, "none" when nothing is stored
+    if user_id not in floors:
+        return ""
+    return "none" if floors[user_id] is None else str(_to_us(floors[user_id]))
+
+
+def _dump_entry(entry: dict) -> dict:
+    return dict(entry, timestamp=entry["timestamp"].isoformat())
+
+
+def _load_entry(entry: dict) -> dict:
+    entry["timestamp"] = datetime.fromisoformat(entry["timestamp"])
+    return entry
+
+
+def _dumps(entry: dict) -> str:
+    return json.dumps(_dump_entry(entry))
+
+
+def _loads(raw: str) -> dict:
+    return _load_entry(json.loads(raw))
+
+
+class RedisBuffer(AbstractBuffer):
+    """Buffer kept in a redis list `{user_id}`, newest at the head, with the
+    buffered ISO timestamps mirrored in the set `{user_id}:timestamps`.
+
+    Every append is a single call to APPEND_SCRIPT, so concurrent requests
+    for the same user can't both flush a minute or both insert a point.
+    Closed buffers are queued as JSON arrays in the list CLOSED_QUEUE when
+    `write_behind` is set.
+
+    With a `state` cache, points it can tell redis would turn away are
+    answered without a call. EPOCH_KEY is read in the same pipeline as the
+    appends, to empty the cache when redis was restarted without its data.
+    """
+
+    def __init__(self, client: redis.Redis, write_behind: bool = False,
+                 state: Optional[UserStateCache] = None):
+        self.client = client
+        self.write_behind = write_behind
+        self.state = state
+        self.append_script = client.register_script(APPEND_SCRIPT)
+
+    async def append_many(self, entries: List[dict],
+                          floors: Dict[str, Optional[datetime]] = None
+                          ) -> List[Tuple[str, List[dict]]]:
+        floors = floors or {}
+        timestamps = [_to_us(entry["timestamp"]) for entry in entries]
+        results = self._check_state(entries, timestamps)
+        pending = [i for i, result in enumerate(results) if result is None]
+        if not pending:
+            return results
+        async with self.client.pipeline(transaction=False) as pipe:
+            for i in pending:
+                await self._append(pipe, entries[i], timestamps[i],
+                                   _floor_arg(floors, entries[i]["user_id"]))
+            if self.state is not None:
+                pipe.set(EPOCH_KEY, uuid.uuid4().hex, nx=True)
+                pipe.get(EPOCH_KEY)
+            with APPEND_SECONDS.time():
+                replies = await pipe.execute()
+        if self.state is not None:
+            self.state.check_epoch(replies[-1])
+        for i, reply in zip(pending, replies):
+            results[i] = self._result(entries[i], timestamps[i], reply)
+        return results
+
+    def _check_state(self, entries: List[dict], timestamps: List[int]
+                     ) -> List[Optional[Tuple[str, List[dict]]]]:
+        """The results the state cache can tell without redis, None for the
+        entries it can't."""
+        if self.state is None:
+            return [None] * len(entries)
+        results: List[Optional[Tuple[str, List[dict]]]] = []
+        for entry, timestamp in zip(entries, timestamps):
+            status = self.state.check(entry["user_id"], timestamp)
+            results.append(None if status is None else (status, []))
+        return results
+
+    def _result(self, entry: dict, timestamp: int, reply: list) -> Tuple[str, List[dict]]:
+        status = reply[0].decode() if isinstance(reply[0], bytes) else reply[0]
+        if self.state is not None and status == ACCEPTED:
+            self.state.accepted(entry["user_id"], timestamp)
+        return status, self._load_flushed(entry["user_id"], reply[1]) if len(reply) > 1 else []
+
+    async def _append(self, pipe, entry: dict, timestamp: int, floor: str):
+        user_id = entry["user_id"]
+        await self.append_script(
+            keys=[user_id, f"{user_id}:timestamps", f"{user_id}:last", CLOSED_QUEUE],
+            args=[_dumps(entry), entry["timestamp"].isoformat(), timestamp, floor,
+                  FLOOR_TTL, "1" if self.write_behind else "0"],
+            client=pipe)
+
+    def _load_flushed(self, user_id: str, flushed: list) -> List[dict]:
+        return [_loads(i) for i in flushed]
+
+    async def pop_closed(self, count: int) -> List[List[dict]]:
+        with POP_CLOSED_SECONDS.time():
+            raw = await self.client.lpop(CLOSED_QUEUE, count)
+        return [[_load_entry(i) for i in json.loads(buffer)] for buffer in raw or []]
+
+    async def requeue_closed(self, buffers: List[List[dict]]):
+        if buffers:
+            with REQUEUE_CLOSED_SECONDS.time():
+                await self.client.lpush(CLOSED_QUEUE, *[
+                    json.dumps([_dump_entry(i) for i in buffer])
+                    for buffer in reversed(buffers)])
+
+
+# KEYS: points sorted set, newest stored minute, closed queue
+# ARGV: packed point, epoch microseconds, floor (as in APPEND_SCRIPT), floor
+#       ttl, header of the closed buffer, "" to hand it back instead
+COMPACT_APPEND_SCRIPT = """
+local ts = tonumber(ARGV[2])
+local oldest = redis.call("ZRANGE", KEYS[1], 0, 0, "WITHSCORES")
+if oldest[1] then
+    if ts - tonumber(oldest[2]) >= 60000000 then
+        local flushed = redis.call("ZREVRANGE", KEYS[1], 0, -1)
+        local newest = tonumber(redis.call("ZSCORE", KEYS[1], flushed[1]))
+        redis.call("DEL", KEYS[1])
+        redis.call("ZADD", KEYS[1], ARGV[2], ARGV[1])
+        redis.call("SET", KEYS[2],
+                   string.format("%.0f", newest - newest % 60000000),
+                   "EX", ARGV[4])
+        if ARGV[5] ~= "" then
+            redis.call("RPUSH", KEYS[3], ARGV[5] .. table.concat(flushed))
+            return {"accepted"}
+        end
+        return {"accepted", flushed}
+    end
+    if redis.call("ZCOUNT", KEYS[1], ARGV[2], ARGV[2]) > 0 then
+        return {"duplicate"}
+    end
+    local newest = redis.call("ZREVRANGE", KEYS[1], 0, 0, "WITHSCORES")
+    if ts <= tonumber(newest[2]) then
+        return {"out_of_order"}
+    end
+else
+    local floor = redis.call("GET", KEYS[2])
+    if not floor then
+        if ARGV[3] == "" then
+            return {"unknown"}
+        end
+        floor = ARGV[3]
+        redis.call("SET", KEYS[2], floor, "EX", ARGV[4])
+    end
+    if floor ~= "none" and ts <= tonumber(floor) then
+        return {"out_of_order"}
+    end
+end
+redis.call("ZADD", KEYS[1], ARGV[2], ARGV[1])
+return {"accepted"}
+"""
+
+COMPACT_CLOSED_QUEUE = "buffer:closed:compact"
+
+# epoch microseconds, lat, long, accuracy, speed; NaN for missing values
+POINT = struct.Struct("<qdddd")
+# length of the user id, followed by the id
+HEADER = struct.Struct("<H")
+
+NAN = float("nan")
+
+
+def _pack(entry: dict, timestamp: int) -> bytes:
+    accuracy, speed = entry["accuracy"], entry["speed"]
+    return POINT.pack(timestamp, entry["lat"], entry["long"],
+                      NAN if accuracy is None else accuracy,
+                      NAN if speed is None else speed)
+
+
+def _unpack(user_id: str, packed: bytes) -> List[dict]:
+    entries = []
+    for timestamp, lat, long, accuracy, speed in POINT.iter_unpack(packed):
+        entries.append({
+            "timestamp": EPOCH + timedelta(microseconds=timestamp),
+            "lat": lat,
+            "long": long,
+            "accuracy": None if accuracy != accuracy else accuracy,
+            "speed": None if speed != speed else speed,
+            "user_id": user_id,
+        })
+    return entries
+
+
+def _header(user_id: str) -> bytes:
+    raw = user_id.encode()
+    return HEADER.pack(len(raw)) + raw
+
+
+class CompactRedisBuffer(RedisBuffer):
+    """Buffer kept in a redis sorted set `{user_id}:points`, scored by the
+    epoch microseconds of the points, which gives the order and the
+    duplicates without reading them back. Members are the points packed
+    with POINT: 40 bytes, no JSON or ISO timestamps to parse.
+
+    Takes a client without decode_responses. Closed buffers are queued in
+    COMPACT_CLOSED_QUEUE as the HEADER with the user id followed by the
+    points, newest first.
+    """
+
+    def __init__(self, client: redis.Redis, write_behind: bool = False,
+                 state: Optional[UserStateCache] = None):
+        super().__init__(client, write_behind, state)
+        self.append_script = client.register_script(COMPACT_APPEND_SCRIPT)
+
+    async def _append(self, pipe, entry: dict, timestamp: int, floor: str):
+        user_id = entry["user_id"]
+        await self.append_script(
+            keys=[f"{user_id}:points", f"{user_id}:last", COMPACT_CLOSED_QUEUE],
+            args=[_pack(entry, timestamp), timestamp, floor, FLOOR_TTL,
+                  _header(user_id) if self.write_behind else ""],
+            client=pipe)
+
+    def _load_flushed(self, user_id: str, flushed: list) -> List[dict]:
+        return _unpack(user_id, b"".join(flushed))
+
+    async def pop_closed(self, count: int) -> List[List[dict]]:
+        with POP_CLOSED_SECONDS.time():
+            raw = await self.client.lpop(COMPACT_CLOSED_QUEUE, count)
+        buffers = []
+        for closed in raw or []:
+            (size,) = HEADER.unpack_from(closed)
+            start = HEADER.size + size
+            buffers.append(_unpack(closed[HEADER.size:start].decode(), closed[start:]))
+        return buffers
+
+    async def requeue_closed(self, buffers: List[List[dict]]):
+        if buffers:
+            with REQUEUE_CLOSED_SECONDS.time():
+                await self.client.lpush(COMPACT_CLOSED_QUEUE, *[
+                    _header(buffer[0]["user_id"]) + b"".join(
+                        _pack(i, _to_us(i["timestamp"])) for i in buffer)
+                    for buffer in reversed(buffers)])
+
+
+class MemoryBuffer(AbstractBuffer):
+    """Python version of RedisBuffer's APPEND_SCRIPT, floors never expire.
+
+    For a single process that owns its users, like the importer.
+    """
+
+    def __init__(self, write_behind: bool = False):
+        self.write_behind = write_behind
+        self.buffers: Dict[str, List[dict]] = {}
+        self.timestamps: Dict[str, set] = {}
+        self.floors: Dict[str, Optional[datetime]] = {}
+        self.closed: Deque[List[dict]] = deque()
+
+    async def append_many(self, entries: List[dict],
+                          floors: Dict[str, Optional[datetime]] = None
+                          ) -> List[Tuple[str, List[dict]]]:
+        floors = floors or {}
+        return [self._append(dict(entry), floors) for entry in entries]
+
+    def _append(self, entry: dict, floors) -> Tuple[str, List[dict]]:
+        user_id, timestamp = entry["user_id"], entry["timestamp"]
+        buffer = self.buffers.get(user_id)
+        if buffer:
+            if timestamp - buffer[-1]["timestamp"] >= timedelta(minutes=1):
+                self.buffers[user_id] = [entry]
+                self.timestamps[user_id] = {timestamp}
+                self.floors[user_id] = minute_of(buffer[0]["timestamp"])
+                if self.write_behind:
+                    self.closed.append(buffer)
+                    return ACCEPTED, []
+                return ACCEPTED, buffer
+            if timestamp in self.timestamps[user_id]:
+                return DUPLICATE, []
+            if timestamp <= buffer[0]["timestamp"]:
+                return OUT_OF_ORDER, []
+        else:
+            if user_id not in self.floors:
+                if user_id not in floors:
+                    return UNKNOWN, []
+                self.floors[user_id] = floors[user_id]
+            floor = self.floors[user_id]
+            if floor is not None and timestamp <= floor:
+                return OUT_OF_ORDER, []
+            buffer = self.buffers[user_id] = []
+            self.timestamps[user_id] = set()
+        buffer.insert(0, entry)
+        self.timestamps[user_id].add(timestamp)
+        return ACCEPTED, []
+
+    def oldest(self, user_id: str) -> Optional[datetime]:
+        """Timestamp of the oldest point buffered for the user."""
+        buffer = self.buffers.get(user_id)
+        return buffer[-1]["timestamp"] if buffer else None
+
+    async def pop_closed(self, count: int) -> List[List[dict]]:
+        return [self.closed.popleft() for _ in range(min(count, len(self.closed)))]
+
+    async def requeue_closed(self, buffers: List[List[dict]]):
+        self.closed.extendleft(reversed(buffers))
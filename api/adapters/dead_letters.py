@@ -0,0 +1,88 @@
+import abc
+import json
+from dataclasses import asdict, dataclass, field
+from datetime import datetime
+from typing import List, Union
+
+import redis.asyncio as redis
+
+from api.domain import commands, events
+
+DEAD_LETTERS_KEY = "events:dead"
+# Batches the ingest worker gave up on, apart from the events the bus redrives
+INGEST_DEAD_LETTERS_KEY = "ingest:dead"
+
+
+@dataclass
+class DeadLetter:
+    event: Union[events.Event, commands.PutLocations]
+    handler: str
+    error: str
+    attempts: int
+    failed_at: datetime = field(default_factory=datetime.utcnow)
+
+
+class AbstractDeadLetters(abc.ABC):
+    """Events whose handler kept failing, or queued batches of points that
+    could not be stored, kept so they can be looked at and handled again
+    once the cause is fixed."""
+
+    @abc.abstractmethod
+    async def add(self, letter: DeadLetter):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def pop(self, count: int) -> List[DeadLetter]:
+        """Takes up to `count` letters off the store, oldest first."""
+        raise NotImplementedError
+
+
+def _dumps(letter: DeadLetter) -> str:
+    return json.dumps({
+        "event": type(letter.event).__name__,
+        "data": asdict(letter.event),
+        "handler": letter.handler,
+        "error": letter.error,
+        "attempts": letter.attempts,
+        "failed_at": letter.failed_at.isoformat(),
+    }, default=str)
+
+
+def _message(name: str, data: dict) -> Union[events.Event, commands.PutLocations]:
+    if name == commands.PutLocations.__name__:
+        return commands.PutLocations([
+            commands.PutLocation(**dict(i, timestamp=datetime.fromisoformat(i["timestamp"])))
+            for i in data["locations"]])
+    return getattr(events, name)(**data)
+
+
+def _loads(raw: str) -> DeadLetter:
+    letter = json.loads(raw)
+    return DeadLetter(
+        event=_message(letter["event"], letter["data"]),
+        handler=letter["handler"],
+        error=letter["error"],
+        attempts=letter["attempts"],
+        failed_at=datetime.fromisoformat(letter["failed_at"]),
+    )
+
+
+class RedisDeadLetters(AbstractDeadLetters):
+    """Letters as JSON in the redis list `key`, capped at `maxlen`, the
+    oldest being dropped first."""
+
+    def __init__(self, client: redis.Redis, maxlen: int = 100_000,
+                 key: str = DEAD_LETTERS_KEY):
+        self.client = client
+        self.maxlen = maxlen
+        self.key = key
+
+    async def add(self, letter: DeadLetter):
+        async with self.client.pipeline(transaction=False) as pipe:
+            pipe.rpush(self.key, _dumps(letter))
+            pipe.ltrim(self.key, -self.maxlen, -1)
+            await pipe.execute()
+
+    async def pop(self, count: int) -> List[DeadLetter]:
+        raw = await self.client.lpop(self.key, count)
+        return [_loads(i) for i in raw or []]
@@ -0,0 +1,197 @@
+import abc
+import json
+import time
+import zlib
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Dict, List
+
+import redis.asyncio as redis
+
+from api.domain import commands
+
+STREAM_PREFIX = "ingest"
+GROUP = "ingest"
+
+
+@dataclass
+class QueuedBatch:
+    partition: int
+    id: str
+    locations: List[commands.PutLocation] = field(default_factory=list)
+    # Times the batch was read, counting this one
+    deliveries: int = 1
+
+
+class AbstractIngestQueue(abc.ABC):
+    """Points validated by the API and waiting for a worker to store them.
+
+    Points are spread over `partitions` by user id, so all the points of a
+    user are in one partition, in the order they were queued. A batch read
+    by a consumer stays pending until it is acked, and can be claimed by
+    another consumer once it has been pending for long enough.
+    """
+
+    def __init__(self, partitions: int = 16):
+        self.partitions = partitions
+
+    def partition_of(self, user_id: str) -> int:
+        # crc32 rather than hash(), which differs between processes
+        return zlib.crc32(user_id.encode()) % self.partitions
+
+    async def enqueue(self, locations: List[commands.PutLocation]) -> int:
+        """Queues the points, one batch per partition, returning how many
+        batches were queued."""
+        batches: Dict[int, List[commands.PutLocation]] = {}
+        for location in locations:
+            batches.setdefault(self.partition_of(location.user_id), []).append(location)
+        await self._add(batches)
+        return len(batches)
+
+    @abc.abstractmethod
+    async def _add(self, batches: Dict[int, List[commands.PutLocation]]):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def read(self, partitions: List[int], consumer: str, count: int,
+                   pending: bool = False, block_ms: int = 0) -> List[QueuedBatch]:
+        """Up to `count` batches of each partition, oldest first. New batches
+        are read unless `pending`, which reads again those `consumer` has
+        not acked, with how many times each was read. New batches are
+        waited for up to `block_ms`."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def claim(self, partition: int, consumer: str, min_idle_ms: int,
+                    count: int) -> List[QueuedBatch]:
+        """Takes over batches of the partition other consumers have left
+        pending for `min_idle_ms` or longer."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def ack(self, batches: List[QueuedBatch]):
+        """Drops batches that were handled."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def stats(self) -> Dict[int, dict]:
+        """Per partition: batches queued (`length`), read and not acked
+        (`pending`), not read yet (`lag`) and the age in seconds of the
+        oldest one (`oldest_seconds`)."""
+        raise NotImplementedError
+
+
+def stream_name(partition: int) -> str:
+    return f"{STREAM_PREFIX}:{partition}"
+
+
+def _dumps(locations: List[commands.PutLocation]) -> str:
+    return json.dumps([[i.timestamp.isoformat(), i.lat, i.long, i.accuracy,
+                        i.speed, i.user_id] for i in locations])
+
+
+def _loads(raw: str) -> List[commands.PutLocation]:
+    return [commands.PutLocation(datetime.fromisoformat(timestamp), lat, long,
+                                 accuracy, speed, user_id)
+            for timestamp, lat, long, accuracy, speed, user_id in json.loads(raw)]
+
+
+def _batch(partition: int, entry_id: str, fields) -> QueuedBatch:
+    # Entries deleted while pending come back without fields
+    locations = _loads(fields["locations"]) if fields else []
+    return QueuedBatch(partition, entry_id, locations)
+
+
+def _age(entry_id: str, now_ms: int) -> float:
+    return max(0, now_ms - int(entry_id.split("-")[0])) / 1000
+
+
+class RedisIngestQueue(AbstractIngestQueue):
+    """A redis stream per partition, `ingest:{partition}`, read through the
+    consumer group GROUP. Batches are deleted from the stream when acked, so
+    the streams only hold what is left to do and are never trimmed."""
+
+    def __init__(self, client: redis.Redis, partitions: int = 16):
+        super().__init__(partitions)
+        self.client = client
+
+    async def create_groups(self):
+        # From the start of the stream, batches queued before there was a
+        # group are read as well
+        for partition in range(self.partitions):
+            try:
+                await self.client.xgroup_create(stream_name(partition), GROUP,
+                                                id="0", mkstream=True)
+            except redis.ResponseError as e:
+                if "BUSYGROUP" not in str(e):
+                    raise
+
+    async def _add(self, batches: Dict[int, List[commands.PutLocation]]):
+        async with self.client.pipeline(transaction=False) as pipe:
+            for partition, locations in batches.items():
+                pipe.xadd(stream_name(partition), {"locations": _dumps(locations)})
+            await pipe.execute()
+
+    async def read(self, partitions: List[int], consumer: str, count: int,
+                   pending: bool = False, block_ms: int = 0) -> List[QueuedBatch]:
+        streams = {stream_name(i): "0" if pending else ">" for i in partitions}
+        # BLOCK 0 would wait forever, and is ignored for pending reads
+        block = block_ms if block_ms and not pending else None
+        replies = await self.client.xreadgroup(GROUP, consumer, streams,
+                                               count=count, block=block)
+        batches = [_batch(int(name.split(":")[1]), entry_id, fields)
+                   for name, entries in replies or [] for entry_id, fields in entries]
+        if pending:
+            await self._count_deliveries(batches)
+        return batches
+
+    async def claim(self, partition: int, consumer: str, min_idle_ms: int,
+                    count: int) -> List[QueuedBatch]:
+        reply = await self.client.xautoclaim(stream_name(partition), GROUP, consumer,
+                                             min_idle_ms, count=count)
+        batches = [_batch(partition, entry_id, fields) for entry_id, fields in reply[1]]
+        await self._count_deliveries(batches)
+        return batches
+
+    async def _count_deliveries(self, batches: List[QueuedBatch]):
+        # New reads are first deliveries, the count of the others is kept
+        # by the group, and went up with the read that returned them
+        if not batches:
+            return
+        async with self.client.pipeline(transaction=False) as pipe:
+            for batch in batches:
+                pipe.xpending_range(stream_name(batch.partition), GROUP,
+                                    batch.id, batch.id, 1)
+            replies = await pipe.execute()
+        for batch, reply in zip(batches, replies):
+            if reply:
+                batch.deliveries = reply[0]["times_delivered"]
+
+    async def ack(self, batches: List[QueuedBatch]):
+        ids: Dict[int, List[str]] = {}
+        for batch in batches:
+            ids.setdefault(batch.partition, []).append(batch.id)
+        async with self.client.pipeline(transaction=False) as pipe:
+            for partition, entry_ids in ids.items():
+                pipe.xack(stream_name(partition), GROUP, *entry_ids)
+                pipe.xdel(stream_name(partition), *entry_ids)
+            await pipe.execute()
+
+    async def stats(self) -> Dict[int, dict]:
+        async with self.client.pipeline(transaction=False) as pipe:
+            for partition in range(self.partitions):
+                pipe.xlen(stream_name(partition))
+                pipe.xpending(stream_name(partition), GROUP)
+                pipe.xrange(stream_name(partition), count=1)
+            replies = await pipe.execute()
+        now_ms = int(time.time() * 1000)
+        stats = {}
+        for partition in range(self.partitions):
+            length, pending, oldest = replies[3 * partition:3 * partition + 3]
+            stats[partition] = {
+                "length": length,
+                "pending": pending["pending"],
+                "lag": length - pending["pending"],
+                "oldest_seconds": _age(oldest[0][0], now_ms) if oldest else 0.0,
+            }
+        return stats
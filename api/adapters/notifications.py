@@ -17,8 +17,8 @@ class EmailNotifications(AbstractNotifications):
         self.server = None 
 
     async def send(self, destination, message):
-        self.logger.log(logging.INFO, f"Sending email to {destination}")
-        print(message)
+        self.logger.info("Sending email to %s", destination)
+        self.logger.debug("Email to %s: %s", destination, message)
 
     async def publish(self, destination, message):
         await self.send(destination, message)
@@ -1,8 +1,13 @@
 from sqlalchemy.orm import registry
+from sqlalchemy.orm.exc import UnmappedClassError
+from sqlalchemy.orm import class_mapper
 from api.domain import models
-from sqlalchemy import Column, String, Float
-from sqlalchemy import DateTime, Table, event
+from sqlalchemy import Column, String, Float, Integer
+from sqlalchemy import DateTime, Index, MetaData, Table, event, inspect, text
+from datetime import date, datetime, timedelta
+from typing import List, Optional
 import logging
+import re
 
 logger = logging.getLogger(__name__)
 
@@ -10,31 +15,205 @@ mapper_registry = registry()
 
 metadata = mapper_registry.metadata
 
-location = Table(
-    "locations",
+
+def location_table(metadata: MetaData, partitioned: bool = False, **kwargs) -> Table:
+    # The unique constraints of a partitioned table or hypertable have to
+    # hold the partition key, so there the primary key is (timestamp, id)
+    return Table(
+        "locations",
+        metadata,
+        Column("timestamp", DateTime(), primary_key=partitioned),
+        Column("id", String(50), primary_key=True),
+        Column("lat", Float(), nullable=False),
+        Column("long", Float(), nullable=False),
+        Column("accuracy", Float()),
+        Column("speed", Float()),
+        Column("user_id", String(50)),
+        Column("samples", Integer(), nullable=False, server_default="1"),
+        Index("ix_locations_user_id_timestamp", "user_id", "timestamp", unique=True),
+        **kwargs,
+    )
+
+
+location = location_table(metadata)
+
+# models.Rollup, read and written with Core statements only
+rollup = Table(
+    "location_rollups",
     metadata,
-    Column("timestamp", DateTime()),
-    Column("id", String(50), primary_key=True),
-    Column("lat", Float(), nullable=False),
-    Column("long", Float(), nullable=False),
-    Column("accuracy", Float(), nullable=False),
-    Column("speed", Float(), nullable=False),
-    Column("user_id", String(50)),
+    Column("user_id", String(50), primary_key=True),
+    Column("resolution", String(8), primary_key=True),
+    Column("bucket", DateTime(), primary_key=True),
+    Column("points", Integer(), nullable=False),
+    Column("sum_lat", Float(), nullable=False),
+    Column("sum_long", Float(), nullable=False),
+    Column("max_speed", Float()),
+    Column("distance", Float(), nullable=False),
+    Column("first_timestamp", DateTime(), nullable=False),
+    Column("first_lat", Float(), nullable=False),
+    Column("first_long", Float(), nullable=False),
+    Column("last_timestamp", DateTime(), nullable=False),
+    Column("last_lat", Float(), nullable=False),
+    Column("last_long", Float(), nullable=False),
 )
 
 
+# PostGIS point of each location for GEO_INDEX, made by create_positions.
+# Left out of `location`, so the mapped class never sees it, and generated
+# from lat and long, so every insert, upsert and COPY fills it
+POSITION_COLUMN = "position"
+
+
+def position_statements() -> List[str]:
+    return [
+        "CREATE EXTENSION IF NOT EXISTS postgis",
+        f"ALTER TABLE {location.name} ADD COLUMN IF NOT EXISTS {POSITION_COLUMN} "
+        "geometry(Point, 4326) "
+        "GENERATED ALWAYS AS (ST_SetSRID(ST_MakePoint(long, lat), 4326)) STORED",
+        f"CREATE INDEX IF NOT EXISTS ix_locations_{POSITION_COLUMN} "
+        f"ON {location.name} USING GIST ({POSITION_COLUMN})",
+    ]
+
+
+def create_positions(engine):
+    """Adds the indexed position column, needs PostGIS on the server."""
+    logger.info("Adding the position column")
+    with engine.begin() as connection:
+        for statement in position_statements():
+            connection.exec_driver_sql(statement)
+
+
 def start_mappers():
+    try:
+        class_mapper(models.Location)
+        return
+    except UnmappedClassError:
+        pass
     logger.info("Starting mappers")
     mapper_registry.map_imperatively(models.Location, location)
     logger.info("Mappers started")
 
 
-def create_tables(engine):
+def create_tables(engine, layout: str = "plain", retention_days: int = 0):
+    """Creates the tables, `layout` being one of
+    plain: a single table
+    partitioned: a table range partitioned by day on timestamp, see
+                 maintain_partitions
+    timescale: a TimescaleDB hypertable with daily chunks, dropped after
+               `retention_days` (0 keeps them) by a TimescaleDB job
+    """
     logger.info("Creating tables")
-    metadata.create_all(engine)
+    if layout == "plain":
+        metadata.create_all(engine)
+    elif layout == "partitioned":
+        location_table(MetaData(), partitioned=True,
+                       postgresql_partition_by="RANGE (timestamp)").create(
+            engine, checkfirst=True)
+        with engine.begin() as connection:
+            connection.exec_driver_sql(
+                f"CREATE TABLE IF NOT EXISTS {DEFAULT_PARTITION} "
+                f"PARTITION OF {location.name} DEFAULT")
+    elif layout == "timescale":
+        with engine.begin() as connection:
+            connection.exec_driver_sql("CREATE EXTENSION IF NOT EXISTS timescaledb")
+        location_table(MetaData(), partitioned=True).create(engine, checkfirst=True)
+        with engine.begin() as connection:
+            connection.execute(text(
+                "SELECT create_hypertable(:table, 'timestamp', "
+                "chunk_time_interval => INTERVAL '1 day', if_not_exists => TRUE)"),
+                {"table": location.name})
+            if retention_days:
+                connection.execute(text(
+                    "SELECT add_retention_policy(:table, make_interval(days => :days), "
+                    "if_not_exists => TRUE)"),
+                    {"table": location.name, "days": retention_days})
+    else:
+        raise ValueError(f"Unknown table layout {layout}")
+    if layout != "plain":
+        rollup.create(engine, checkfirst=True)
     logger.info("Tables created")
 
 
+# Daily partitions of the partitioned layout are named locations_pYYYYMMDD,
+# rows of days without one go to the default partition
+DEFAULT_PARTITION = "locations_default"
+PARTITION_NAME = re.compile(r"^locations_p(\d{8})$")
+
+
+def partition_name(day: date) -> str:
+    return f"locations_p{day:%Y%m%d}"
+
+
+def create_partition_statement(day: date) -> str:
+    return (f"CREATE TABLE IF NOT EXISTS {partition_name(day)} "
+            f"PARTITION OF {location.name} "
+            f"FOR VALUES FROM ('{day.isoformat()}') TO ('{(day + timedelta(days=1)).isoformat()}')")
+
+
+def expired_partitions(names: List[str], cutoff: date) -> List[str]:
+    """The daily partitions in `names` holding only days before `cutoff`."""
+    expired = []
+    for name in names:
+        match = PARTITION_NAME.match(name)
+        if match and datetime.strptime(match[1], "%Y%m%d").date() < cutoff:
+            expired.append(name)
+    return sorted(expired)
+
+
+def maintain_partitions(engine, days_ahead: int = 7, retention_days: int = 0,
+                        start: Optional[date] = None, today: Optional[date] = None):
+    """Creates the daily partitions from `start` (today by default) to
+    `days_ahead` days after today, and with `retention_days` drops those
+    older than that and deletes the same days from the default partition.
+
+    Run it daily. Partitions can't be created for days that already have
+    rows in the default partition, so give `start` before loading old data.
+    """
+    today = today or date.today()
+    day = start or today
+    with engine.begin() as connection:
+        while day <= today + timedelta(days=days_ahead):
+            connection.exec_driver_sql(create_partition_statement(day))
+            day += timedelta(days=1)
+    if not retention_days:
+        return
+    cutoff = today - timedelta(days=retention_days)
+    with engine.begin() as connection:
+        names = connection.execute(text(
+            "SELECT child.relname FROM pg_inherits "
+            "JOIN pg_class child ON child.oid = pg_inherits.inhrelid "
+            "JOIN pg_class parent ON parent.oid = pg_inherits.inhparent "
+            "WHERE parent.relname = :table"), {"table": location.name}).scalars().all()
+        for name in expired_partitions(names, cutoff):
+            logger.info("Dropping partition %s", name)
+            connection.exec_driver_sql(f"DROP TABLE {name}")
+        connection.execute(text(
+            f"DELETE FROM {DEFAULT_PARTITION} WHERE timestamp < :cutoff"),
+            {"cutoff": cutoff})
+
+
+def migrate_tables(engine):
+    # Brings tables created before the samples column, the (user_id,
+    # timestamp) index and nullable means up to date, create_all skips
+    # existing tables.
+    columns = {c["name"]: c for c in inspect(engine).get_columns(location.name)}
+    for name in ("accuracy", "speed"):
+        if not columns[name]["nullable"]:
+            logger.info("Making %s nullable", name)
+            with engine.begin() as connection:
+                connection.exec_driver_sql(
+                    f"ALTER TABLE locations ALTER COLUMN {name} DROP NOT NULL")
+    if "samples" not in columns:
+        logger.info("Adding samples column")
+        with engine.begin() as connection:
+            connection.exec_driver_sql(
+                "ALTER TABLE locations ADD COLUMN samples INTEGER NOT NULL DEFAULT 1")
+    for index in location.indexes:
+        index.create(engine, checkfirst=True)
+    rollup.create(engine, checkfirst=True)
+    logger.info("Tables migrated")
+
+
 def drop_tables(engine):
     logger.info("Dropping tables")
     metadata.drop_all(engine)
@@ -1,8 +1,12 @@
+import abc
+import asyncio
 import json
 import redis.asyncio as redis
 import logging
 from api import config
+from api.utils import metrics
 import datetime
+from typing import List, Optional, Tuple
 
 
 class DateTimeEncoder(json.JSONEncoder):
@@ -14,11 +18,114 @@ class DateTimeEncoder(json.JSONEncoder):
 
 logger = logging.getLogger(__name__)
 
-r = redis.Redis(**config.get_redis_host_and_port())
+# (channel, event, data)
+Message = Tuple[str, str, dict]
 
+# One encoder for every message instead of one per json.dumps call
+_encoder = DateTimeEncoder()
 
-async def publish(channel: str, event: str, data: dict):
-    logger.info(f"Publishing {event} to {channel}")
-    await r.publish(channel, json.dumps({"event": event, "data": data},
-                                        cls=DateTimeEncoder))
-    logger.info(f"Published {event} to {channel}")
+
+def encode(event: str, data: dict) -> str:
+    return _encoder.encode({"event": event, "data": data})
+
+
+class AbstractPublisher(abc.ABC):
+    """Sends events to channels. Called like the old publish function for a
+    single event, publish_many sends the events of a unit of work at once."""
+
+    async def __call__(self, channel: str, event: str, data: dict):
+        await self.publish_many([(channel, event, data)])
+
+    @abc.abstractmethod
+    async def publish_many(self, messages: List[Message]):
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+
+class RedisPublisher(AbstractPublisher):
+    """Publishes in one pipeline per call, to pub/sub channels or, with
+    `stream_maxlen`, to the streams `events:{channel}` capped at about that
+    many entries, which consumers can read from where they left off."""
+
+    def __init__(self, client: redis.Redis, stream_maxlen: Optional[int] = None):
+        self.client = client
+        self.stream_maxlen = stream_maxlen
+
+    async def publish_many(self, messages: List[Message]):
+        if not messages:
+            return
+        logger.debug("Publishing %s events", len(messages))
+        async with self.client.pipeline(transaction=False) as pipe:
+            for channel, event, data in messages:
+                if self.stream_maxlen:
+                    pipe.xadd(f"events:{channel}",
+                              {"event": event, "data": _encoder.encode(data)},
+                              maxlen=self.stream_maxlen, approximate=True)
+                else:
+                    pipe.publish(channel, encode(event, data))
+            await pipe.execute()
+        metrics.EVENTS_PUBLISHED.inc(len(messages))
+
+    async def close(self):
+        await self.client.connection_pool.disconnect()
+
+
+class QueuedPublisher(AbstractPublisher):
+    """Hands events to a background task that sends whatever has piled up in
+    one call to `publisher`, so requests don't wait on redis.
+
+    At most `maxsize` batches wait in the queue, past that publish_many waits
+    for room. Batches that fail to send are logged and dropped.
+    """
+
+    def __init__(self, publisher: AbstractPublisher, maxsize: int = 1000):
+        self.publisher = publisher
+        self.maxsize = maxsize
+        self.queue: Optional[asyncio.Queue] = None
+        self.task: Optional[asyncio.Task] = None
+
+    async def publish_many(self, messages: List[Message]):
+        if not messages:
+            return
+        if self.task is None or self.task.done():
+            # Created here to belong to the loop of the app, not of the import
+            if self.queue is None:
+                self.queue = asyncio.Queue(self.maxsize)
+            self.task = asyncio.create_task(self._run())
+        await self.queue.put(messages)
+
+    async def _run(self):
+        while True:
+            batches = [await self.queue.get()]
+            while not self.queue.empty():
+                batches.append(self.queue.get_nowait())
+            messages = [message for batch in batches for message in batch]
+            try:
+                await self.publisher.publish_many(messages)
+            except Exception:
+                metrics.EVENTS_DROPPED.inc(len(messages))
+                logger.exception("Exception publishing %s events", len(messages))
+            finally:
+                for _ in batches:
+                    self.queue.task_done()
+
+    async def close(self):
+        """Waits for the queued events to be sent and stops the task."""
+        if self.task is not None and not self.task.done():
+            await self.queue.join()
+            self.task.cancel()
+        self.task = None
+        await self.publisher.close()
+
+
+def create_publisher() -> AbstractPublisher:
+    pool = redis.BlockingConnectionPool(**config.get_redis_host_and_port(),
+                                        **config.get_redis_pool_config(), db=0)
+    publisher = RedisPublisher(redis.Redis(connection_pool=pool),
+                               **config.get_event_sink_config())
+    queue_size = config.get_event_queue_size()
+    if queue_size:
+        return QueuedPublisher(publisher, queue_size)
+    return publisher
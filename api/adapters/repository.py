@@ -1,64 +1,286 @@
 import abc
 from dataclasses import asdict
+from api.adapters import orm
 from api.domain import models
+from sqlalchemy import Float, bindparam, case, cast, delete, exists, func, literal_column
+from sqlalchemy.dialects import postgresql
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy.orm import joinedload
 from sqlalchemy.future import select
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReturnDocument, UpdateOne
 from pymongo.errors import OperationFailure
 from api.domain import events
-from typing import Set, Optional, TypeVar
+from api.utils import geo, metrics, rollups as rollup_math
+from api.utils.aggregation import weighted_mean
+from datetime import datetime
+from typing import AsyncIterator, Dict, Iterable, List, Set, Optional, Tuple, TypeVar
 
 # Type declarations for MongoDB
 CollectionType = AsyncIOMotorClient
 
+# Fields holding the mean of the points of a minute
+MEAN_FIELDS = ("lat", "long", "accuracy", "speed")
+
+# Rows per INSERT statement, postgres takes at most 32767 parameters
+INSERT_CHUNK_SIZE = 1000
+
+# Rows fetched at a time when streaming a range
+STREAM_BATCH_SIZE = 500
+
+# PostGIS point of a location, see orm.create_positions
+POSITION = literal_column(f"{orm.location.name}.{orm.POSITION_COLUMN}")
+
+
+def merge_duplicates(locations: Iterable[models.Location]) -> List[models.Location]:
+    """Merges locations of the same user and timestamp into one, weighting the
+    means with `samples`, so a bulk upsert never touches a row twice."""
+    merged: Dict[tuple, models.Location] = {}
+    for location in locations:
+        key = (location.user_id, location.timestamp)
+        current = merged.get(key)
+        if current is None:
+            merged[key] = location
+            continue
+        samples = current.samples + location.samples
+        merged[key] = models.Location(
+            timestamp=current.timestamp,
+            user_id=current.user_id,
+            id=current.id,
+            samples=samples,
+            **{field: weighted_mean(getattr(current, field), current.samples,
+                                    getattr(location, field), location.samples)
+               for field in MEAN_FIELDS},
+        )
+    return list(merged.values())
+
+
+def merge_rollups(rollups: Iterable[models.Rollup]) -> List[models.Rollup]:
+    """Merges rollups of the same user, resolution and bucket, in order."""
+    merged: Dict[tuple, models.Rollup] = {}
+    for rollup in rollups:
+        key = (rollup.user_id, rollup.resolution, rollup.bucket)
+        current = merged.get(key)
+        merged[key] = rollup if current is None else rollup_math.merge(current, rollup)
+    return list(merged.values())
+
+
+def chunks(items: List, size: int = INSERT_CHUNK_SIZE):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def _timed(operation: str):
+    return metrics.REPOSITORY_SECONDS.labels(operation).time()
+
 class AbstractRepository(abc.ABC):
     def __init__(self):
         self.seen: Set[models.Location] = set()
         self.events: Set[events.Event] = set()
 
     async def add(self, location: models.Location):
-        await self._add(location)
+        with _timed("add"):
+            await self._add(location)
         self.seen.add(location)
 
     async def get(self, id: str) -> Optional[models.Location]:
-        location = await self._get(id)
+        with _timed("get"):
+            location = await self._get(id)
         if location:
             self.seen.add(location)
         return location
 
     async def delete(self, location: models.Location):
-        await self._delete(location)
+        with _timed("delete"):
+            await self._delete(location)
         self.seen.remove(location)
 
+    async def upsert(self, location: models.Location) -> models.Location:
+        """Stores the location, merging it into the stored one of the same user
+        and timestamp by a mean weighted with `samples`. Returns what was stored.
+        """
+        with _timed("upsert"):
+            location = await self._upsert(location)
+        self.seen.add(location)
+        return location
+
+    async def add_many(self, locations: List[models.Location]):
+        if locations:
+            with _timed("add_many"):
+                await self._add_many(locations)
+        self.seen.update(locations)
+
+    async def load_many(self, locations: List[models.Location]):
+        """Inserts locations that aren't stored yet the fastest way the
+        database takes them, for bulk imports. They are not kept in `seen`."""
+        if locations:
+            with _timed("load_many"):
+                await self._load_many(locations)
+
+    async def upsert_many(self, locations: List[models.Location]) -> List[models.Location]:
+        """Bulk `upsert`. Returns what was stored, in no particular order."""
+        locations = merge_duplicates(locations)
+        if not locations:
+            return []
+        with _timed("upsert_many"):
+            locations = await self._upsert_many(locations)
+        self.seen.update(locations)
+        return locations
+
+    async def get_last_locations_for_users(
+            self, user_ids: Iterable[str]) -> Dict[str, models.Location]:
+        """Newest location of each user, users without locations are left out."""
+        user_ids = list(set(user_ids))
+        if not user_ids:
+            return {}
+        with _timed("get_last_locations_for_users"):
+            locations = await self._get_last_locations_for_users(user_ids)
+        self.seen.update(locations.values())
+        return locations
+
     async def get_user_id_and_timestamp(self, user_id: str,
                                         timestamp: str) -> Optional[models.Location]:
-        location = await self._get_user_id_and_timestamp(user_id, timestamp)
+        with _timed("get_user_id_and_timestamp"):
+            location = await self._get_user_id_and_timestamp(user_id, timestamp)
         if location:
             self.seen.add(location)
         return location
 
     async def get_last_location_for_user(self, user_id: str) -> Optional[models.Location]:
-        location = await self._get_last_location_for_user(user_id)
+        with _timed("get_last_location_for_user"):
+            location = await self._get_last_location_for_user(user_id)
         if location:
             self.seen.add(location)
         return location
 
     async def get_location_by_timestamp(self, user_id: str,
                                         timestamp: str) -> Optional[models.Location]:
-        location = await self._get_location_by_timestamp(user_id, timestamp)
+        with _timed("get_location_by_timestamp"):
+            location = await self._get_location_by_timestamp(user_id, timestamp)
         if location:
             self.seen.add(location)
         return location
 
+    def get_range(self, user_id: str, start: Optional[datetime] = None,
+                  end: Optional[datetime] = None, after: Optional[datetime] = None,
+                  limit: Optional[int] = None) -> AsyncIterator[models.Location]:
+        """Locations of the user from `start` up to, not including, `end`,
+        oldest first, only those after the timestamp `after` (keyset
+        pagination) and at most `limit` of them.
+
+        Streamed from the database in batches, and not kept in `seen`.
+        """
+        return self._get_range(user_id, start, end, after, limit)
+
+    async def upsert_rollups(self, rollups: List[models.Rollup]):
+        """Adds the rollups to the stored ones of the same user, resolution
+        and bucket, as api.utils.rollups.merge does."""
+        rollups = merge_rollups(rollups)
+        if rollups:
+            with _timed("upsert_rollups"):
+                await self._upsert_rollups(rollups)
+
+    async def get_rollups(self, user_id: str, resolution: str,
+                          start: Optional[datetime] = None,
+                          end: Optional[datetime] = None) -> List[models.Rollup]:
+        """Rollups of the user with buckets from `start` up to, not
+        including, `end`, oldest first."""
+        with _timed("get_rollups"):
+            return await self._get_rollups(user_id, resolution, start, end)
+
+    async def delete_rollups(self, user_id: str):
+        with _timed("delete_rollups"):
+            await self._delete_rollups(user_id)
+
+    async def get_user_ids(self) -> List[str]:
+        """Every user with stored locations."""
+        with _timed("get_user_ids"):
+            return await self._get_user_ids()
+
+    async def get_in_bbox(self, min_lat: float, min_long: float, max_lat: float,
+                          max_long: float, start: Optional[datetime] = None,
+                          end: Optional[datetime] = None,
+                          limit: Optional[int] = None) -> List[models.Location]:
+        """Locations of every user within the box, edges included, from
+        `start` up to, not including, `end`, oldest first. Needs GEO_INDEX.
+        """
+        with _timed("get_in_bbox"):
+            return await self._get_in_bbox(min_lat, min_long, max_lat, max_long,
+                                           start, end, limit)
+
+    async def get_users_near(self, lat: float, long: float, radius: float,
+                             since: Optional[datetime] = None,
+                             limit: Optional[int] = None
+                             ) -> List[Tuple[models.Location, float]]:
+        """The last location of the users last seen within `radius` meters of
+        the point, and since `since`, with its distance in meters, nearest
+        first. Needs GEO_INDEX."""
+        with _timed("get_users_near"):
+            return await self._get_users_near(lat, long, radius, since, limit)
+
     @abc.abstractmethod
     async def _get_last_location_for_user(self, user_id: str) -> Optional[models.Location]:
         raise NotImplementedError
 
+    @abc.abstractmethod
+    async def _upsert_rollups(self, rollups: List[models.Rollup]):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def _get_rollups(self, user_id: str, resolution: str, start: Optional[datetime],
+                           end: Optional[datetime]) -> List[models.Rollup]:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def _delete_rollups(self, user_id: str):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def _get_user_ids(self) -> List[str]:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def _get_range(self, user_id: str, start: Optional[datetime],
+                   end: Optional[datetime], after: Optional[datetime],
+                   limit: Optional[int]) -> AsyncIterator[models.Location]:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def _get_in_bbox(self, min_lat: float, min_long: float, max_lat: float,
+                           max_long: float, start: Optional[datetime],
+                           end: Optional[datetime],
+                           limit: Optional[int]) -> List[models.Location]:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def _get_users_near(self, lat: float, long: float, radius: float,
+                              since: Optional[datetime], limit: Optional[int]
+                              ) -> List[Tuple[models.Location, float]]:
+        raise NotImplementedError
+
     @abc.abstractmethod
     async def _add(self, location: models.Location):
         raise NotImplementedError
 
+    @abc.abstractmethod
+    async def _upsert(self, location: models.Location) -> models.Location:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def _add_many(self, locations: List[models.Location]):
+        raise NotImplementedError
+
+    async def _load_many(self, locations: List[models.Location]):
+        await self._add_many(locations)
+
+    @abc.abstractmethod
+    async def _upsert_many(self, locations: List[models.Location]) -> List[models.Location]:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def _get_last_locations_for_users(
+            self, user_ids: List[str]) -> Dict[str, models.Location]:
+        raise NotImplementedError
+
     @abc.abstractmethod
     async def _get(self, id: str) -> Optional[models.Location]:
         raise NotImplementedError
@@ -80,6 +302,26 @@ class AbstractRepository(abc.ABC):
         raise NotImplementedError
 
 
+# Built once so SQLAlchemy's compiled cache always hits
+SELECT_BY_ID = select(orm.location).where(orm.location.c.id == bindparam("id"))
+SELECT_BY_USER_AND_TIMESTAMP = select(orm.location).where(
+    orm.location.c.user_id == bindparam("user_id"),
+    orm.location.c.timestamp == bindparam("timestamp"))
+SELECT_LAST_FOR_USER = select(orm.location)\
+    .where(orm.location.c.user_id == bindparam("user_id"))\
+    .order_by(orm.location.c.timestamp.desc())\
+    .limit(1)
+
+
+def _sql_haversine(lat1, long1, lat2, long2):
+    # Same formula as api.utils.rollups.haversine
+    phi1, phi2 = func.radians(lat1), func.radians(lat2)
+    a = (func.power(func.sin((phi2 - phi1) / 2), 2)
+         + func.cos(phi1) * func.cos(phi2)
+         * func.power(func.sin(func.radians(long2 - long1) / 2), 2))
+    return 2 * rollup_math.EARTH_RADIUS_M * func.asin(func.least(1.0, func.sqrt(a)))
+
+
 class SqlAlchemyRepository(AbstractRepository):
     def __init__(self, session: AsyncSession):
         super().__init__()
@@ -88,73 +330,325 @@ class SqlAlchemyRepository(AbstractRepository):
     async def _add(self, location: models.Location):
         self.session.add(location)
 
+    @staticmethod
+    def _values(location: models.Location) -> dict:
+        return {
+            "id": location.id,
+            "timestamp": location.timestamp,
+            "lat": location.lat,
+            "long": location.long,
+            "accuracy": location.accuracy,
+            "speed": location.speed,
+            "user_id": location.user_id,
+            "samples": location.samples,
+        }
+
+    @staticmethod
+    def _upsert_statement(values: List[dict]):
+        table = orm.location
+        stmt = postgresql.insert(table).values(values)
+        samples = table.c.samples + stmt.excluded.samples
+        # NULL when a side is NULL, that is every point missed the field,
+        # and then the other side
+        merged = {
+            field: func.coalesce((table.c[field] * table.c.samples
+                                  + stmt.excluded[field] * stmt.excluded.samples)
+                                 / cast(samples, Float),
+                                 table.c[field], stmt.excluded[field])
+            for field in MEAN_FIELDS
+        }
+        return stmt.on_conflict_do_update(
+            index_elements=[table.c.user_id, table.c.timestamp],
+            set_=dict(merged, samples=samples),
+        ).returning(*table.c)
+
+    async def _upsert(self, location: models.Location) -> models.Location:
+        result = await self.session.execute(
+            self._upsert_statement([self._values(location)]))
+        return models.Location(**dict(result.one()._mapping))
+
+    async def _add_many(self, locations: List[models.Location]):
+        for chunk in chunks(locations):
+            await self.session.execute(postgresql.insert(orm.location).values(
+                [self._values(location) for location in chunk]))
+
+    async def _load_many(self, locations: List[models.Location]):
+        # COPY on the session's connection, inside its transaction
+        connection = await self.session.connection()
+        raw = await connection.get_raw_connection()
+        values = [self._values(location) for location in locations]
+        await raw.driver_connection.copy_records_to_table(
+            orm.location.name, columns=list(values[0]),
+            records=[tuple(row.values()) for row in values])
+
+    async def _upsert_many(self, locations: List[models.Location]) -> List[models.Location]:
+        stored = []
+        for chunk in chunks(locations):
+            result = await self.session.execute(self._upsert_statement(
+                [self._values(location) for location in chunk]))
+            stored.extend(models.Location(**dict(row._mapping)) for row in result)
+        return stored
+
+    async def _get_last_locations_for_users(
+            self, user_ids: List[str]) -> Dict[str, models.Location]:
+        table = orm.location
+        result = await self.session.execute(
+            select(table)
+            .where(table.c.user_id.in_(user_ids))
+            .distinct(table.c.user_id)
+            .order_by(table.c.user_id, table.c.timestamp.desc()))
+        return {row.user_id: models.Location(**dict(row._mapping)) for row in result}
+
+    async def _select_one(self, stmt, **params) -> Optional[models.Location]:
+        # Core rows built into detached Locations, one statement per read
+        row = (await self.session.execute(stmt, params)).first()
+        if row:
+            return models.Location(**dict(row._mapping))
+
     async def _get(self, id) -> Optional[models.Location]:
-        result = await self.session.execute(select(models.Location)
-                                            .options(joinedload('*'))
-                                            .filter_by(id=id))
-        location = result.scalars().one_or_none()
-        if location:
-            await self.session.refresh(location)
-            self.session.expunge(location)
-        return location
+        return await self._select_one(SELECT_BY_ID, id=id)
 
     async def _delete(self, location: models.Location):
-        await self.session.delete(location)
+        await self.session.execute(
+            delete(orm.location).where(orm.location.c.id == location.id))
 
     async def _get_user_id_and_timestamp(self, user_id: str,
                                          timestamp: str) -> Optional[models.Location]:
-        result = await self.session.execute(select(models.Location)
-                                            .options(joinedload('*'))
-                                            .filter_by(user_id=user_id,
-                                                       timestamp=timestamp))
-        location = result.scalars().one_or_none()
-        if location:
-            await self.session.refresh(location)
-            self.session.expunge(location)
-        return location
+        return await self._select_one(SELECT_BY_USER_AND_TIMESTAMP,
+                                      user_id=user_id, timestamp=timestamp)
 
     async def _get_last_location_for_user(self, user_id: str) -> Optional[models.Location]:
-        # Get last location for user
-        result = await self.session.execute(select(models.Location)
-                                            .options(joinedload('*'))
-                                            .filter_by(user_id=user_id)
-                                            .order_by(models.Location.timestamp.desc())
-                                            .limit(1))
-        location = result.scalars().one_or_none()
-        if location:
-            await self.session.refresh(location)
-            self.session.expunge(location)
-
-        return location
+        return await self._select_one(SELECT_LAST_FOR_USER, user_id=user_id)
 
     async def _get_location_by_timestamp(self, user_id: str,
                                          timestamp: str) -> Optional[models.Location]:
-        result = await self.session.execute(select(models.Location)
-                                            .options(joinedload('*'))
-                                            .filter_by(user_id=user_id,
-                                                       timestamp=timestamp))
-        location = result.scalars().one_or_none()
-        if location:
-            await self.session.refresh(location)
-            self.session.expunge(location)
-        return location
+        return await self._select_one(SELECT_BY_USER_AND_TIMESTAMP,
+                                      user_id=user_id, timestamp=timestamp)
+
+    @staticmethod
+    def _upsert_rollups_statement(values: List[dict]):
+        table = orm.rollup
+        stmt = postgresql.insert(table).values(values)
+        current, other = table.c, stmt.excluded
+        later = other.first_timestamp > current.last_timestamp
+        gap = case((later, _sql_haversine(current.last_lat, current.last_long,
+                                          other.first_lat, other.first_long)),
+                   else_=0.0)
+        earlier_first = other.first_timestamp < current.first_timestamp
+        later_last = other.last_timestamp > current.last_timestamp
+        return stmt.on_conflict_do_update(
+            index_elements=[table.c.user_id, table.c.resolution, table.c.bucket],
+            set_={
+                "points": current.points + other.points,
+                "sum_lat": current.sum_lat + other.sum_lat,
+                "sum_long": current.sum_long + other.sum_long,
+                # greatest skips nulls
+                "max_speed": func.greatest(current.max_speed, other.max_speed),
+                "distance": current.distance + other.distance + gap,
+                **{field: case((earlier_first, other[field]), else_=current[field])
+                   for field in ("first_timestamp", "first_lat", "first_long")},
+                **{field: case((later_last, other[field]), else_=current[field])
+                   for field in ("last_timestamp", "last_lat", "last_long")},
+            })
+
+    async def _upsert_rollups(self, rollups: List[models.Rollup]):
+        for chunk in chunks(rollups):
+            await self.session.execute(
+                self._upsert_rollups_statement([asdict(rollup) for rollup in chunk]))
+
+    async def _get_rollups(self, user_id: str, resolution: str, start: Optional[datetime],
+                           end: Optional[datetime]) -> List[models.Rollup]:
+        table = orm.rollup
+        stmt = select(table).where(table.c.user_id == user_id,
+                                   table.c.resolution == resolution)
+        if start is not None:
+            stmt = stmt.where(table.c.bucket >= start)
+        if end is not None:
+            stmt = stmt.where(table.c.bucket < end)
+        result = await self.session.execute(stmt.order_by(table.c.bucket))
+        return [models.Rollup(**dict(row._mapping)) for row in result]
+
+    async def _delete_rollups(self, user_id: str):
+        await self.session.execute(
+            delete(orm.rollup).where(orm.rollup.c.user_id == user_id))
+
+    async def _get_user_ids(self) -> List[str]:
+        result = await self.session.execute(
+            select(orm.location.c.user_id).distinct().order_by(orm.location.c.user_id))
+        return list(result.scalars())
+
+    async def _get_range(self, user_id: str, start: Optional[datetime],
+                         end: Optional[datetime], after: Optional[datetime],
+                         limit: Optional[int]) -> AsyncIterator[models.Location]:
+        # Served by the (user_id, timestamp) index, whatever the page
+        table = orm.location
+        stmt = select(table).where(table.c.user_id == user_id)
+        if start is not None:
+            stmt = stmt.where(table.c.timestamp >= start)
+        if end is not None:
+            stmt = stmt.where(table.c.timestamp < end)
+        if after is not None:
+            stmt = stmt.where(table.c.timestamp > after)
+        stmt = stmt.order_by(table.c.timestamp).limit(limit)
+        result = await self.session.stream(
+            stmt, execution_options={"yield_per": STREAM_BATCH_SIZE})
+        async for row in result:
+            yield models.Location(**dict(row._mapping))
+
+    async def _get_in_bbox(self, min_lat: float, min_long: float, max_lat: float,
+                           max_long: float, start: Optional[datetime],
+                           end: Optional[datetime],
+                           limit: Optional[int]) -> List[models.Location]:
+        # A box in degrees is exactly what && matches on a geometry
+        table = orm.location
+        stmt = select(table).where(POSITION.op("&&")(
+            func.ST_MakeEnvelope(min_long, min_lat, max_long, max_lat, 4326)))
+        if start is not None:
+            stmt = stmt.where(table.c.timestamp >= start)
+        if end is not None:
+            stmt = stmt.where(table.c.timestamp < end)
+        result = await self.session.execute(
+            stmt.order_by(table.c.timestamp, table.c.user_id).limit(limit))
+        return [models.Location(**dict(row._mapping)) for row in result]
+
+    async def _get_users_near(self, lat: float, long: float, radius: float,
+                              since: Optional[datetime], limit: Optional[int]
+                              ) -> List[Tuple[models.Location, float]]:
+        # The index finds the minutes in a box around the circle, distances
+        # are on the sphere like api.utils.rollups.haversine
+        table = orm.location
+        newer = table.alias("newer")
+        point = func.ST_SetSRID(func.ST_MakePoint(long, lat), 4326)
+        dlat, dlong = geo.degrees_around(lat, radius)
+        distance = func.ST_Distance(func.geography(POSITION), func.geography(point), False)
+        stmt = select(table, distance.label("distance")).where(
+            POSITION.op("&&")(func.ST_Expand(point, dlong, dlat)),
+            func.ST_DWithin(func.geography(POSITION), func.geography(point), radius, False),
+            ~exists().where(newer.c.user_id == table.c.user_id,
+                            newer.c.timestamp > table.c.timestamp))
+        if since is not None:
+            stmt = stmt.where(table.c.timestamp >= since)
+        result = await self.session.execute(stmt.order_by(distance).limit(limit))
+        near = []
+        for row in result:
+            values = dict(row._mapping)
+            distance = values.pop("distance")
+            near.append((models.Location(**values), distance))
+        return near
+
+
+def _mongo_haversine(lat1, long1, lat2, long2) -> dict:
+    # Same formula as api.utils.rollups.haversine
+    def radians(value):
+        return {"$degreesToRadians": value}
+
+    def half_sin_squared(a, b):
+        half = {"$divide": [{"$subtract": [radians(b), radians(a)]}, 2]}
+        return {"$pow": [{"$sin": half}, 2]}
+
+    a = {"$add": [half_sin_squared(lat1, lat2),
+                  {"$multiply": [{"$cos": radians(lat1)}, {"$cos": radians(lat2)},
+                                 half_sin_squared(long1, long2)]}]}
+    return {"$multiply": [2 * rollup_math.EARTH_RADIUS_M,
+                          {"$asin": {"$min": [1.0, {"$sqrt": a}]}}]}
 
 
 class MongoDBRepository(AbstractRepository):
+    """With `geo` every location gets a GeoJSON `position`, for the 2dsphere
+    index made by manage_mongo_collections.py with GEO_INDEX=true."""
+
     def __init__(self, client: CollectionType, db_name: str, collection_name: str,
-                 session):
+                 session, geo: bool = False):
         super().__init__()
         self.collection: CollectionType = client[db_name][collection_name]
+        self.rollups: CollectionType = client[db_name][f"{collection_name}_rollups"]
         self.session = session
+        self.geo = geo
+
+    def _document(self, location: models.Location) -> dict:
+        document = asdict(location)
+        if self.geo:
+            document["position"] = geo.point(location.lat, location.long)
+        return document
+
+    def _update(self, location: models.Location) -> list:
+        update = self._merge_update(location)
+        if self.geo:
+            # A stage of its own, to see the merged lat and long
+            update.append({"$set": {"position": {"type": "Point",
+                                                 "coordinates": ["$long", "$lat"]}}})
+        return update
 
     async def _add(self, location: models.Location):
-        await self.collection.insert_one(asdict(location))
+        await self.collection.insert_one(self._document(location))
+
+    @staticmethod
+    def _merge_update(location: models.Location) -> list:
+        # Documents stored before `samples` existed count as one point
+        stored = {"$cond": [{"$eq": [{"$type": "$lat"}, "missing"]},
+                            0, {"$ifNull": ["$samples", 1]}]}
+        samples = {"$add": [stored, location.samples]}
+        merged = {}
+        for field in MEAN_FIELDS:
+            value = getattr(location, field)
+            if value is None:
+                # Every point missed it, null if the stored minute has none
+                merged[field] = {"$ifNull": [f"${field}", None]}
+                continue
+            # A null or missing stored value makes the mean null, then `value`
+            merged[field] = {"$ifNull": [{"$divide": [
+                {"$add": [{"$multiply": [f"${field}", stored]},
+                          value * location.samples]},
+                samples]}, value]}
+        return [{"$set": dict(merged, samples=samples,
+                              id={"$ifNull": ["$id", location.id]})}]
+
+    @staticmethod
+    def _to_location(document: dict) -> models.Location:
+        document.pop('_id')
+        document.pop('position', None)
+        return models.Location(**document)
+
+    async def _upsert(self, location: models.Location) -> models.Location:
+        document = await self.collection.find_one_and_update(
+            {"user_id": location.user_id, "timestamp": location.timestamp},
+            self._update(location),
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+        return self._to_location(document)
+
+    async def _add_many(self, locations: List[models.Location]):
+        await self.collection.insert_many([self._document(location)
+                                           for location in locations], ordered=False)
+
+    async def _upsert_many(self, locations: List[models.Location]) -> List[models.Location]:
+        keys = [{"user_id": location.user_id, "timestamp": location.timestamp}
+                for location in locations]
+        await self.collection.bulk_write(
+            [UpdateOne(key, self._update(location), upsert=True)
+             for key, location in zip(keys, locations)],
+            ordered=False)
+        stored = []
+        for chunk in chunks(keys):
+            async for document in self.collection.find({"$or": chunk}):
+                stored.append(self._to_location(document))
+        return stored
+
+    async def _get_last_locations_for_users(
+            self, user_ids: List[str]) -> Dict[str, models.Location]:
+        cursor = self.collection.aggregate([
+            {"$match": {"user_id": {"$in": user_ids}}},
+            {"$sort": {"user_id": 1, "timestamp": -1}},
+            {"$group": {"_id": "$user_id", "document": {"$first": "$$ROOT"}}},
+        ])
+        return {document["_id"]: self._to_location(document["document"])
+                async for document in cursor}
 
     async def _get(self, id: str) -> Optional[models.Location]:
         document = await self.collection.find_one({"id": id})
         if document:
-            document.pop('_id')
-            return models.Location(**document)
+            return self._to_location(document)
 
     async def _delete(self, location: models.Location):
         await self.collection.delete_one({"id": location.id})
@@ -164,8 +658,7 @@ class MongoDBRepository(AbstractRepository):
         document = await self.collection.find_one({"user_id": user_id,
                                                    "timestamp": timestamp})
         if document:
-            document[0].pop('_id')
-            return models.Location(**document)
+            return self._to_location(document)
 
     async def _get_last_location_for_user(self,
                                           user_id: str) -> Optional[models.Location]:
@@ -173,15 +666,246 @@ class MongoDBRepository(AbstractRepository):
             .sort("timestamp", -1).limit(1)
         document = await cursor.to_list(length=1)
         if document:
-            # Pop mongo id
-            document[0].pop('_id')
-            return models.Location(**document[0])
+            return self._to_location(document[0])
 
     async def _get_location_by_timestamp(self, user_id: str,
                                          timestamp: str) -> Optional[models.Location]:
         document = await self.collection.find_one({"user_id": user_id,
                                                    "timestamp": timestamp})
         if document:
-            print(document)
-            document.pop('_id')
-            return models.Location(**document)
+            return self._to_location(document)
+
+    @staticmethod
+    def _rollup_update(rollup: models.Rollup) -> list:
+        # Every expression of a $set stage sees the document as it was
+        exists = {"$gt": [{"$ifNull": ["$points", 0]}, 0]}
+
+        def added(field):
+            return {"$add": [{"$ifNull": [f"${field}", 0]}, getattr(rollup, field)]}
+
+        def kept_if(condition, fields):
+            return {field: {"$cond": [{"$and": [exists, condition]},
+                                      f"${field}", getattr(rollup, field)]}
+                    for field in fields}
+
+        later = {"$gt": [rollup.first_timestamp, "$last_timestamp"]}
+        gap = {"$cond": [{"$and": [exists, later]},
+                         _mongo_haversine("$last_lat", "$last_long",
+                                          rollup.first_lat, rollup.first_long), 0.0]}
+        return [{"$set": {
+            "points": added("points"),
+            "sum_lat": added("sum_lat"),
+            "sum_long": added("sum_long"),
+            # $max skips nulls
+            "max_speed": {"$max": ["$max_speed", rollup.max_speed]},
+            "distance": {"$add": [added("distance"), gap]},
+            **kept_if({"$lte": ["$first_timestamp", rollup.first_timestamp]},
+                      ("first_timestamp", "first_lat", "first_long")),
+            **kept_if({"$gte": ["$last_timestamp", rollup.last_timestamp]},
+                      ("last_timestamp", "last_lat", "last_long")),
+        }}]
+
+    async def _upsert_rollups(self, rollups: List[models.Rollup]):
+        await self.rollups.bulk_write(
+            [UpdateOne({"user_id": rollup.user_id, "resolution": rollup.resolution,
+                        "bucket": rollup.bucket},
+                       self._rollup_update(rollup), upsert=True)
+             for rollup in rollups],
+            ordered=False)
+
+    async def _get_rollups(self, user_id: str, resolution: str, start: Optional[datetime],
+                           end: Optional[datetime]) -> List[models.Rollup]:
+        query = {"user_id": user_id, "resolution": resolution}
+        bucket = {}
+        if start is not None:
+            bucket["$gte"] = start
+        if end is not None:
+            bucket["$lt"] = end
+        if bucket:
+            query["bucket"] = bucket
+        rollups = []
+        async for document in self.rollups.find(query).sort("bucket", 1):
+            document.pop("_id")
+            rollups.append(models.Rollup(**document))
+        return rollups
+
+    async def _delete_rollups(self, user_id: str):
+        await self.rollups.delete_many({"user_id": user_id})
+
+    async def _get_user_ids(self) -> List[str]:
+        return sorted(await self.collection.distinct("user_id"))
+
+    async def _get_range(self, user_id: str, start: Optional[datetime],
+                         end: Optional[datetime], after: Optional[datetime],
+                         limit: Optional[int]) -> AsyncIterator[models.Location]:
+        cursor = self.collection.find(_range_query(user_id, start, end, after),
+                                      batch_size=STREAM_BATCH_SIZE)\
+            .sort("timestamp", 1).limit(limit or 0)
+        async for document in cursor:
+            yield self._to_location(document)
+
+    async def _get_in_bbox(self, min_lat: float, min_long: float, max_lat: float,
+                           max_long: float, start: Optional[datetime],
+                           end: Optional[datetime],
+                           limit: Optional[int]) -> List[models.Location]:
+        cursor = self.collection.find(
+            _bbox_query(min_lat, min_long, max_lat, max_long, start, end))\
+            .sort([("timestamp", 1), ("user_id", 1)]).limit(limit or 0)
+        return [self._to_location(document) async for document in cursor]
+
+    async def _get_users_near(self, lat: float, long: float, radius: float,
+                              since: Optional[datetime], limit: Optional[int]
+                              ) -> List[Tuple[models.Location, float]]:
+        # The users with a location near the point, then their last one
+        geo_near = {"near": geo.point(lat, long), "key": "position",
+                    "distanceField": "distance", "maxDistance": radius,
+                    "spherical": True}
+        if since is not None:
+            geo_near["query"] = {"timestamp": {"$gte": since}}
+        cursor = self.collection.aggregate([{"$geoNear": geo_near},
+                                            {"$group": {"_id": "$user_id"}}])
+        user_ids = [document["_id"] async for document in cursor]
+        last = await self._get_last_locations_for_users(user_ids)
+        return nearest(last.values(), lat, long, radius, since, limit)
+
+
+class MongoDBTimeSeriesRepository(MongoDBRepository):
+    """For a time series collection (timeField timestamp, metaField user_id),
+    which takes neither a unique index nor upserts. Each flushed part of a
+    minute is inserted as a measurement with its `samples`, and the parts
+    of a minute are merged with merge_duplicates when read, in insertion
+    order like the upserts of MongoDBRepository merge them.
+    """
+
+    async def _find_merged(self, query: dict, direction: int = 1) -> List[models.Location]:
+        cursor = self.collection.find(query).sort([("timestamp", direction), ("_id", 1)])
+        return merge_duplicates([self._to_location(document) async for document in cursor])
+
+    async def _upsert(self, location: models.Location) -> models.Location:
+        [stored] = await self._upsert_many([location])
+        return stored
+
+    async def _upsert_many(self, locations: List[models.Location]) -> List[models.Location]:
+        await self._add_many(locations)
+        stored = []
+        for chunk in chunks([{"user_id": location.user_id, "timestamp": location.timestamp}
+                             for location in locations]):
+            stored.extend(await self._find_merged({"$or": chunk}))
+        return stored
+
+    async def _get_last_locations_for_users(
+            self, user_ids: List[str]) -> Dict[str, models.Location]:
+        cursor = self.collection.aggregate([
+            {"$match": {"user_id": {"$in": user_ids}}},
+            {"$group": {"_id": "$user_id", "timestamp": {"$max": "$timestamp"}}},
+        ])
+        keys = [{"user_id": document["_id"], "timestamp": document["timestamp"]}
+                async for document in cursor]
+        if not keys:
+            return {}
+        return {location.user_id: location
+                for location in await self._find_merged({"$or": keys})}
+
+    async def _get(self, id: str) -> Optional[models.Location]:
+        location = await super()._get(id)
+        if location:
+            return await self._get_location_by_timestamp(location.user_id,
+                                                         location.timestamp)
+
+    async def _get_user_id_and_timestamp(self, user_id: str,
+                                         timestamp: str) -> Optional[models.Location]:
+        return await self._get_location_by_timestamp(user_id, timestamp)
+
+    async def _get_last_location_for_user(self,
+                                          user_id: str) -> Optional[models.Location]:
+        last = await self.collection.find({"user_id": user_id})\
+            .sort("timestamp", -1).limit(1).to_list(length=1)
+        if last:
+            return await self._get_location_by_timestamp(user_id, last[0]["timestamp"])
+
+    async def _get_location_by_timestamp(self, user_id: str,
+                                         timestamp: str) -> Optional[models.Location]:
+        merged = await self._find_merged({"user_id": user_id, "timestamp": timestamp})
+        return merged[0] if merged else None
+
+    async def _get_range(self, user_id: str, start: Optional[datetime],
+                         end: Optional[datetime], after: Optional[datetime],
+                         limit: Optional[int]) -> AsyncIterator[models.Location]:
+        # The parts of a minute come one after the other, merged as they end
+        cursor = self.collection.find(_range_query(user_id, start, end, after),
+                                      batch_size=STREAM_BATCH_SIZE)\
+            .sort([("timestamp", 1), ("_id", 1)])
+        parts: List[models.Location] = []
+        minutes = 0
+        try:
+            async for document in cursor:
+                location = self._to_location(document)
+                if parts and location.timestamp != parts[0].timestamp:
+                    yield merge_duplicates(parts)[0]
+                    minutes += 1
+                    if minutes == limit:
+                        return
+                    parts = []
+                parts.append(location)
+            if parts:
+                yield merge_duplicates(parts)[0]
+        finally:
+            await cursor.close()
+
+    async def _get_in_bbox(self, min_lat: float, min_long: float, max_lat: float,
+                           max_long: float, start: Optional[datetime],
+                           end: Optional[datetime],
+                           limit: Optional[int]) -> List[models.Location]:
+        # The minutes with a part in the box, kept if merged they still are
+        cursor = self.collection.find(
+            _bbox_query(min_lat, min_long, max_lat, max_long, start, end),
+            {"user_id": 1, "timestamp": 1})
+        keys = {(document["user_id"], document["timestamp"]) async for document in cursor}
+        merged = []
+        for chunk in chunks([{"user_id": user_id, "timestamp": timestamp}
+                             for user_id, timestamp in keys]):
+            merged.extend(await self._find_merged({"$or": chunk}))
+        merged = sorted((location for location in merged
+                         if geo.in_bbox(location.lat, location.long,
+                                        min_lat, min_long, max_lat, max_long)),
+                        key=lambda location: (location.timestamp, location.user_id))
+        return merged[:limit]
+
+
+def _range_query(user_id: Optional[str], start: Optional[datetime],
+                 end: Optional[datetime], after: Optional[datetime]) -> dict:
+    timestamp = {}
+    if start is not None:
+        timestamp["$gte"] = start
+    if end is not None:
+        timestamp["$lt"] = end
+    if after is not None:
+        timestamp["$gt"] = after
+    query = {} if user_id is None else {"user_id": user_id}
+    if timestamp:
+        query["timestamp"] = timestamp
+    return query
+
+
+def _bbox_query(min_lat: float, min_long: float, max_lat: float, max_long: float,
+                start: Optional[datetime], end: Optional[datetime]) -> dict:
+    # The polygon is for the 2dsphere index, lat and long match the box
+    query = _range_query(None, start, end, None)
+    query.update({
+        "position": {"$geoWithin": {"$geometry": geo.bbox_polygon(
+            min_lat, min_long, max_lat, max_long)}},
+        "lat": {"$gte": min_lat, "$lte": max_lat},
+        "long": {"$gte": min_long, "$lte": max_long},
+    })
+    return query
+
+
+def nearest(locations: Iterable[models.Location], lat: float, long: float,
+            radius: float, since: Optional[datetime] = None,
+            limit: Optional[int] = None) -> List[Tuple[models.Location, float]]:
+    """The locations within `radius` meters of the point and since `since`,
+    with their distance, nearest first."""
+    near = [(location, rollup_math.haversine(lat, long, location.lat, location.long))
+            for location in locations
+            if since is None or location.timestamp >= since]
+    return sorted((i for i in near if i[1] <= radius), key=lambda i: i[1])[:limit]
@@ -0,0 +1,78 @@
+"""Rebuilds the rollups of api.utils.rollups from the stored minutes.
+
+    python -m api.backfill                      # every user
+    python -m api.backfill --user-id a1 b2      # some of them
+
+A user's rollups are deleted and summed again from their minutes, read
+`--chunk-size` at a time in timestamp order, one transaction per chunk.
+Minutes only keep mean speeds and positions, so max speed and distance
+come from those rather than from the points. Stop the ingest for the
+users being rebuilt, minutes flushed meanwhile would be counted twice.
+"""
+import argparse
+import asyncio
+import logging
+from typing import List, Optional
+
+from api import bootstrap
+from api.service_layer import unit_of_work
+from api.utils.rollups import rollups_of
+
+logger = logging.getLogger(__name__)
+
+
+async def backfill_user(uow: unit_of_work.AbstractUnitOfWork, user_id: str,
+                        chunk_size: int = 10_000) -> int:
+    """Rebuilds the rollups of one user, returning the minutes read."""
+    async with uow:
+        await uow.locations.delete_rollups(user_id)
+        await uow.commit()
+    cursor, minutes = None, 0
+    while True:
+        async with uow:
+            page = [location async for location in uow.locations.get_range(
+                user_id, after=cursor, limit=chunk_size)]
+            await uow.locations.upsert_rollups(rollups_of(
+                {"user_id": location.user_id, "timestamp": location.timestamp,
+                 "lat": location.lat, "long": location.long,
+                 "speed": location.speed, "samples": location.samples}
+                for location in page))
+            await uow.commit()
+        minutes += len(page)
+        if len(page) < chunk_size:
+            return minutes
+        cursor = page[-1].timestamp
+
+
+async def backfill(uow: unit_of_work.AbstractUnitOfWork,
+                   user_ids: Optional[List[str]] = None, chunk_size: int = 10_000):
+    if not user_ids:
+        async with uow.read_only():
+            user_ids = await uow.locations.get_user_ids()
+    for user_id in user_ids:
+        minutes = await backfill_user(uow, user_id, chunk_size)
+        logger.info("Rebuilt the rollups of %s from %s minutes", user_id, minutes)
+
+
+async def run(user_ids: List[str], chunk_size: int):
+    uow = bootstrap.default_uow(start_orm=True)
+    await uow.connect()
+    try:
+        await backfill(uow, user_ids, chunk_size)
+    finally:
+        await unit_of_work.dispose()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--user-id', nargs='*', default=[],
+                        help="users to rebuild, all of them by default")
+    parser.add_argument('--chunk-size', type=int, default=10_000,
+                        help="minutes read and summed per transaction")
+    args = parser.parse_args()
+    bootstrap.configure_logging()
+    asyncio.run(run(args.user_id, args.chunk_size))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,36 +1,54 @@
+import functools
 import inspect
-from typing import Awaitable, Callable
+import logging.config
+from pathlib import Path
 
+from api.adapters import buffer as location_buffer
 from api.adapters import orm, redis_eventpublisher
+from api.adapters.ingest_queue import RedisIngestQueue
+from api.adapters.dead_letters import (INGEST_DEAD_LETTERS_KEY, AbstractDeadLetters,
+                                       RedisDeadLetters)
 from api.adapters.notifications import AbstractNotifications, EmailNotifications
-from api.domain import events
 from api.service_layer import handlers, messagebus, unit_of_work
+from api.service_layer.flusher import Flusher
+from api.utils.timezone import TimezoneResolver
+from api.utils.user_state import UserStateCache
+from api import config
 import logging
 import os
 logger = logging.getLogger(__name__)
 
+LOGGING_CONFIG = Path(__file__).parent.parent / "logging.conf"
+
+
+def configure_logging():
+    # logfmt-style lines from logging.conf, LOG_LEVEL=DEBUG shows every message
+    logging.config.fileConfig(LOGGING_CONFIG, disable_existing_loggers=False)
+    logging.getLogger().setLevel(config.get_log_level())
+
 
 def bootstrap(
     start_orm: bool = True,
     uow: unit_of_work.AbstractUnitOfWork = None,
     notifications: AbstractNotifications = None,
-    publish: Callable[[str, events.Event],
-                      Awaitable] = redis_eventpublisher.publish,
+    publish: redis_eventpublisher.AbstractPublisher = None,
+    buffer: location_buffer.AbstractBuffer = None,
+    timezones: TimezoneResolver = None,
+    dead_letters: AbstractDeadLetters = None,
 ) -> messagebus.MessageBus:
     if notifications is None:
         notifications = EmailNotifications()
-    print(os.getenv("UOW"))
-    if os.getenv("UOW") == "sqlalchemy":
-        logger.info("Starting ORM")
-        logger.info("Using UOW: %s", uow.__class__)
-        if start_orm:
-            orm.start_mappers()
-        uow = unit_of_work.SqlAlchemyUnitOfWork()
-    else:
-        logger.info("Using UOW: %s", uow.__class__)
-        uow = unit_of_work.MongoDBUnitOfWork()
+    if publish is None:
+        publish = redis_eventpublisher.create_publisher()
+    if buffer is None:
+        buffer = default_buffer()
+    if timezones is None:
+        timezones = TimezoneResolver(**config.get_timezone_cache_config())
+    if dead_letters is None:
+        dead_letters = RedisDeadLetters(location_buffer.create_client())
+    uow = default_uow(start_orm, uow)
 
-    dependencies = {"uow": uow,
+    dependencies = {"uow": uow, "buffer": buffer, "timezones": timezones,
                     "notifications": notifications, "publish": publish}
 
     injected_event_handlers = {
@@ -48,12 +66,71 @@ def bootstrap(
         uow=uow,
         event_handlers=injected_event_handlers,
         command_handlers=injected_command_handlers,
+        dead_letters=dead_letters,
+        **config.get_bus_config(),
     )
 
 
+def bootstrap_flusher(
+    start_orm: bool = True,
+    uow: unit_of_work.AbstractUnitOfWork = None,
+    buffer: location_buffer.AbstractBuffer = None,
+    publish: redis_eventpublisher.AbstractPublisher = None,
+) -> Flusher:
+    # The flusher gets its own unit of work, it runs next to the requests
+    if buffer is None:
+        buffer = default_buffer()
+    if publish is None:
+        publish = redis_eventpublisher.create_publisher()
+    return Flusher(default_uow(start_orm, uow), buffer, publish,
+                   **config.get_flusher_config())
+
+
+def default_buffer(state: UserStateCache = None,
+                   write_behind: bool = None) -> location_buffer.AbstractBuffer:
+    if write_behind is None:
+        write_behind = config.get_flush_mode() != "inline"
+    if config.get_buffer_layout() == "compact":
+        return location_buffer.CompactRedisBuffer(
+            location_buffer.create_client(decode_responses=False),
+            write_behind=write_behind, state=state)
+    return location_buffer.RedisBuffer(location_buffer.create_client(),
+                                       write_behind=write_behind, state=state)
+
+
+def default_ingest_queue() -> RedisIngestQueue:
+    return RedisIngestQueue(location_buffer.create_client(),
+                            **config.get_ingest_queue_config())
+
+
+def default_ingest_dead_letters() -> RedisDeadLetters:
+    return RedisDeadLetters(location_buffer.create_client(), key=INGEST_DEAD_LETTERS_KEY)
+
+
+def default_uow(start_orm: bool,
+                uow: unit_of_work.AbstractUnitOfWork = None) -> unit_of_work.AbstractUnitOfWork:
+    if uow is not None:
+        logger.info("Using UOW: %s", uow.__class__)
+        return uow
+    if os.getenv("UOW") == "sqlalchemy":
+        logger.info("Starting ORM")
+        if start_orm:
+            orm.start_mappers()
+        uow = unit_of_work.SqlAlchemyUnitOfWork()
+    else:
+        uow = unit_of_work.MongoDBUnitOfWork(**config.get_mongo_mode_config(),
+                                             geo=config.get_geo_index())
+    logger.info("Using UOW: %s", uow.__class__)
+    return uow
+
+
 def inject_dependencies(handler, dependencies):
     params = inspect.signature(handler).parameters
     deps = {
         name: dependency for name, dependency in dependencies.items() if name in params
     }
-    return lambda message: handler(message, **deps)
+
+    @functools.wraps(handler)
+    def injected(message):
+        return handler(message, **deps)
+    return injected
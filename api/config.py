@@ -10,6 +10,45 @@ def get_postgres_uri():
     user, db_name = "postgres", "locations"
     return f"postgresql+asyncpg://{user}:{password}@{host}:{port}/{db_name}"
 
+
+def get_log_level():
+    return os.environ.get("LOG_LEVEL", "INFO").upper()
+
+
+def get_sql_echo():
+    # Logs every statement, only meant for debugging
+    return os.environ.get("SQL_ECHO", "false").lower() in ("1", "true", "yes")
+
+
+def get_postgres_pool_config():
+    # Pool per API worker. pre_ping checks connections before handing them
+    # out, set DB_STATEMENT_CACHE_SIZE=0 behind pgbouncer in transaction mode
+    statement_cache_size = int(os.environ.get("DB_STATEMENT_CACHE_SIZE", 100))
+    return {
+        "pool_size": int(os.environ.get("DB_POOL_SIZE", 10)),
+        "max_overflow": int(os.environ.get("DB_MAX_OVERFLOW", 10)),
+        "pool_timeout": float(os.environ.get("DB_POOL_TIMEOUT", 30)),
+        "pool_recycle": int(os.environ.get("DB_POOL_RECYCLE", 1800)),
+        "pool_pre_ping": os.environ.get("DB_POOL_PRE_PING", "true").lower()
+        in ("1", "true", "yes"),
+        "connect_args": {
+            "statement_cache_size": statement_cache_size,
+            "prepared_statement_cache_size": statement_cache_size,
+        },
+    }
+
+
+def get_postgres_layout_config():
+    # POSTGRES_LAYOUT: plain, partitioned (daily range partitions) or
+    # timescale (TimescaleDB hypertable with daily chunks). PARTITION_DAYS_AHEAD
+    # is how many days of partitions are made in advance, RETENTION_DAYS how
+    # many days are kept, 0 keeps everything
+    return {
+        "layout": os.environ.get("POSTGRES_LAYOUT", "plain"),
+        "days_ahead": int(os.environ.get("PARTITION_DAYS_AHEAD", 7)),
+        "retention_days": int(os.environ.get("RETENTION_DAYS", 0)),
+    }
+
 # For creating initial tables. not used in docker
 
 
@@ -27,6 +66,120 @@ def get_redis_host_and_port():
     return {"host": host, "port": port}
 
 
+def get_redis_pool_config():
+    # Handlers wait up to `timeout` seconds for a free connection
+    return {
+        "max_connections": int(os.environ.get("REDIS_POOL_SIZE", 50)),
+        "timeout": float(os.environ.get("REDIS_POOL_TIMEOUT", 5)),
+    }
+
+
+def get_event_sink_config():
+    # pubsub: PUBLISH to the channel, subscribers that are down miss events
+    # stream: XADD to the stream events:{channel}, trimmed to about
+    #         EVENT_STREAM_MAXLEN entries
+    if os.environ.get("EVENT_SINK", "pubsub") == "stream":
+        return {"stream_maxlen": int(os.environ.get("EVENT_STREAM_MAXLEN", 100_000))}
+    return {"stream_maxlen": None}
+
+
+def get_event_queue_size():
+    # Batches of events waiting for a background task to send them, 0 sends
+    # them from the request
+    return int(os.environ.get("EVENT_QUEUE_SIZE", 0))
+
+
+def get_bus_config():
+    # Event handlers are retried with backoff doubling from EVENT_RETRY_BACKOFF
+    # seconds, then stored as dead letters
+    return {
+        "max_concurrency": int(os.environ.get("EVENT_HANDLER_CONCURRENCY", 10)),
+        "retries": int(os.environ.get("EVENT_RETRIES", 3)),
+        "backoff": float(os.environ.get("EVENT_RETRY_BACKOFF", 0.1)),
+    }
+
+
+def get_geo_index():
+    # Indexed positions for the bounding box and nearby users queries: a
+    # PostGIS column added by manage_postgres_tables.py, or a GeoJSON field
+    # with a 2dsphere index on mongo, filled on write. Needs to be on for the
+    # API and for the scripts making the tables
+    return os.environ.get("GEO_INDEX", "false").lower() in ("1", "true", "yes")
+
+
+def get_timezone_cache_config():
+    return {
+        "maxsize": int(os.environ.get("TZ_CACHE_SIZE", 4096)),
+        "precision": int(os.environ.get("TZ_CACHE_PRECISION", 2)),
+        "user_maxsize": int(os.environ.get("TZ_USER_CACHE_SIZE", 100_000)),
+    }
+
+
+def get_user_state_cache_config():
+    # What each worker knows of the users' buffers, to turn away duplicate
+    # and out of order points without calling redis. 0 users turns it off
+    return {
+        "maxsize": int(os.environ.get("USER_STATE_CACHE_SIZE", 100_000)),
+        "ttl": float(os.environ.get("USER_STATE_CACHE_TTL", 60)),
+    }
+
+
+def get_user_actors_config():
+    # PUT /location points of a user are stored by one task per user, which
+    # batches those that arrived together. 0 points per batch turns it off
+    return {
+        "max_batch": int(os.environ.get("USER_ACTOR_BATCH_SIZE", 0)),
+        "ttl": float(os.environ.get("USER_ACTOR_TTL", 5)),
+    }
+
+
+def get_buffer_layout():
+    # json: a list of JSON points and a set of their timestamps per user
+    # compact: a sorted set of packed points per user, scored by timestamp
+    return os.environ.get("BUFFER_LAYOUT", "json")
+
+
+def get_flush_mode():
+    # inline: the request that closes a minute writes it
+    # background: a flusher task in every API worker writes closed minutes
+    # external: closed minutes are left to `python -m api.flusher`
+    return os.environ.get("FLUSH_MODE", "inline")
+
+
+def get_flusher_config():
+    return {
+        "interval": float(os.environ.get("FLUSH_INTERVAL", 1.0)),
+        "batch_size": int(os.environ.get("FLUSH_BATCH_SIZE", 500)),
+    }
+
+
+def get_ingest_mode():
+    # request: PUT /location stores the point before answering
+    # stream: points are validated and queued on redis streams, to be
+    #         stored by `python -m api.worker`
+    return os.environ.get("INGEST_MODE", "request")
+
+
+def get_ingest_queue_config():
+    # Points are spread over INGEST_PARTITIONS streams by user id. Changing it
+    # while points are queued can store some of a user's points out of order
+    return {"partitions": int(os.environ.get("INGEST_PARTITIONS", 16))}
+
+
+def get_ingest_worker_config():
+    # A worker reads up to INGEST_READ_COUNT batches per partition at a time,
+    # waiting INGEST_BLOCK_MS for new ones, and every INGEST_CLAIM_INTERVAL
+    # seconds takes over batches left pending for INGEST_CLAIM_IDLE_MS. A batch
+    # failing after INGEST_MAX_DELIVERIES reads goes to the ingest:dead list
+    return {
+        "count": int(os.environ.get("INGEST_READ_COUNT", 100)),
+        "block_ms": int(os.environ.get("INGEST_BLOCK_MS", 1000)),
+        "claim_idle_ms": int(os.environ.get("INGEST_CLAIM_IDLE_MS", 60_000)),
+        "claim_interval": float(os.environ.get("INGEST_CLAIM_INTERVAL", 30)),
+        "max_deliveries": int(os.environ.get("INGEST_MAX_DELIVERIES", 5)),
+    }
+
+
 def get_repo_orm():
     return 'sqlalchemy'
 
@@ -41,7 +194,27 @@ def get_mongo_collection():
 def get_mongo_client():
     host = os.environ.get("MONGO_HOST", "localhost")
     port = 27017
-    return MongoDBClient(f"mongodb://{host}:{port}/")
+    return MongoDBClient(f"mongodb://{host}:{port}/", **get_mongo_pool_config())
+
+
+def get_mongo_mode_config():
+    # MONGO_TRANSACTIONS=false writes without a session and transaction,
+    # MONGO_TIMESERIES=true is for a time series collection made by
+    # manage_mongo_collections.py with the same setting
+    return {
+        "transactions": os.environ.get("MONGO_TRANSACTIONS", "true").lower()
+        in ("1", "true", "yes"),
+        "timeseries": os.environ.get("MONGO_TIMESERIES", "false").lower()
+        in ("1", "true", "yes"),
+    }
+
+
+def get_mongo_pool_config():
+    return {
+        "maxPoolSize": int(os.environ.get("MONGO_MAX_POOL_SIZE", 100)),
+        "minPoolSize": int(os.environ.get("MONGO_MIN_POOL_SIZE", 0)),
+        "waitQueueTimeoutMS": int(os.environ.get("MONGO_POOL_TIMEOUT_MS", 5000)),
+    }
 
 def get_mongo_connection_string():
     host = os.environ.get("MONGO_HOST", "localhost")
@@ -1,6 +1,10 @@
-from pymongo import MongoClient
+import argparse
+
+from pymongo import ASCENDING, MongoClient
 from api.config import get_mongo_connection_string
 from api.config import get_mongo_collection
+from api.config import get_mongo_mode_config
+from api.config import get_geo_index
 from logging import getLogger
 
 logger = getLogger(__name__)
@@ -31,16 +35,24 @@ schema = {
                     "description": "must be a double and is required"
                 },
                 "accuracy": {
-                    "bsonType": "double",
-                    "description": "must be a double and is required"
+                    "bsonType": ["double", "null"],
+                    "description": "mean of the minute, null when no point had one"
                 },
                 "speed": {
-                    "bsonType": "double",
-                    "description": "must be a double and is required"
+                    "bsonType": ["double", "null"],
+                    "description": "mean of the minute, null when no point had one"
                 },
                 "user_id": {
                     "bsonType": "string",
                     "description": "must be a string and is required"
+                },
+                "samples": {
+                    "bsonType": ["int", "long"],
+                    "description": "number of points averaged into the minute"
+                },
+                "position": {
+                    "bsonType": "object",
+                    "description": "GeoJSON point of lat and long, with GEO_INDEX=true"
                 }
             }
         }
@@ -48,15 +60,64 @@ schema = {
 def drop_collections():
     logger.info("Dropping collections")
     db.locations.drop()
+    db.locations_rollups.drop()
     logger.info("Collections dropped")
 
 
-# Create collection with validator schema
-def create_collections():
+# Create the missing collections, locations with validator schema, or as a
+# time series collection with MONGO_TIMESERIES=true. An existing locations
+# collection gets the current schema, changing it to or from a time series
+# needs --drop
+def create_collections(timeseries=False):
     logger.info("Creating collections")
-    db.create_collection("locations", validator=schema)
+    existing = {info["name"]: info for info in db.list_collections()}
+    if "locations" not in existing:
+        if timeseries:
+            db.create_collection("locations", timeseries={
+                "timeField": "timestamp",
+                "metaField": "user_id",
+                "granularity": "minutes",
+            })
+        else:
+            db.create_collection("locations", validator=schema)
+    elif (existing["locations"]["type"] == "timeseries") != timeseries:
+        raise ValueError("MONGO_TIMESERIES doesn't match the locations collection, "
+                         "run with --drop to change it")
+    elif not timeseries:
+        db.command("collMod", "locations", validator=schema)
+    if "locations_rollups" not in existing:
+        db.create_collection("locations_rollups")
     logger.info("Collections created")
 
+
+# The repository finds minutes by user_id and timestamp. Time series
+# collections take no unique index, their minutes are merged when read.
+# With GEO_INDEX=true positions get a 2dsphere index
+def create_indexes(timeseries=False, geo=False):
+    logger.info("Creating indexes")
+    db.locations.create_index([("user_id", ASCENDING), ("timestamp", ASCENDING)],
+                              name="user_id_timestamp", unique=not timeseries)
+    db.locations.create_index("id", name="id")
+    if geo:
+        db.locations.create_index([("position", "2dsphere")], name="position")
+    db.locations_rollups.create_index(
+        [("user_id", ASCENDING), ("resolution", ASCENDING), ("bucket", ASCENDING)],
+        name="user_id_resolution_bucket", unique=True)
+    logger.info("Indexes created")
+
+
+def main(drop=False):
+    timeseries = get_mongo_mode_config()["timeseries"]
+    if drop:
+        drop_collections()
+    create_collections(timeseries)
+    create_indexes(timeseries, get_geo_index())
+
+
 if __name__ == "__main__":
-    drop_collections()
-    create_collections()
+    parser = argparse.ArgumentParser(description="Manage mongo collections.")
+    parser.add_argument('--drop', action='store_true',
+                        help='Drop the collections and their data first')
+    args = parser.parse_args()
+
+    main(drop=args.drop)
@@ -1,22 +1,34 @@
 import argparse
-from api.adapters.orm import create_tables, drop_tables
-from api.config import get_sync_postgres_uri
+from datetime import date
+from api.adapters.orm import (create_positions, create_tables, drop_tables,
+                              maintain_partitions, migrate_tables)
+from api.config import (get_geo_index, get_postgres_layout_config,
+                        get_sync_postgres_uri)
 from sqlalchemy import create_engine
 import time
 
 
-def main(drop):
+def main(drop, maintain, start=None):
     # This is mostly for postgres
-    time.sleep(5)
+    config = get_postgres_layout_config()
     connection_string = get_sync_postgres_uri()
 
     engine = create_engine(connection_string)
 
-    if drop:
-        drop_tables(engine)
-        print("Tables dropped.")
-    create_tables(engine)
-    print("Tables created.")
+    if not maintain:
+        time.sleep(5)
+        if drop:
+            drop_tables(engine)
+            print("Tables dropped.")
+        create_tables(engine, config["layout"], config["retention_days"])
+        migrate_tables(engine)
+        if get_geo_index():
+            create_positions(engine)
+        print("Tables created.")
+    if config["layout"] == "partitioned":
+        maintain_partitions(engine, config["days_ahead"], config["retention_days"],
+                            start=start)
+        print("Partitions updated.")
 
     engine.dispose()
 
@@ -25,6 +37,12 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Manage database tables.")
     parser.add_argument('--drop', action='store_true',
                         help='Drop tables if given')
+    parser.add_argument('--maintain', action='store_true',
+                        help='Only create upcoming partitions and drop expired ones, '
+                             'meant to run daily')
+    parser.add_argument('--start', type=date.fromisoformat,
+                        help='First day to create a partition for (YYYY-MM-DD), '
+                             'before loading older data')
     args = parser.parse_args()
 
-    main(drop=args.drop)
+    main(drop=args.drop, maintain=args.maintain, start=args.start)
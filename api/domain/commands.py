@@ -1,5 +1,6 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from datetime import datetime
+from typing import List
 class Command:
     pass
 
@@ -14,6 +15,11 @@ class PutLocation(Command):
     user_id: str
 
 
+@dataclass
+class PutLocations(Command):
+    locations: List[PutLocation] = field(default_factory=list)
+
+
 @dataclass
 class HealthCheck(Command):
     pass
@@ -1,5 +1,6 @@
 from dataclasses import dataclass
 from datetime import date
+from typing import Optional
 
 
 class Event:
@@ -11,6 +12,6 @@ class LocationAdded(Event):
     timestamp: date
     lat: float
     long: float
-    accuracy: float
-    speed: float
+    accuracy: Optional[float]
+    speed: Optional[float]
     user_id: str
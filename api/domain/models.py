@@ -16,10 +16,13 @@ class Location():
     timestamp: datetime
     lat: float
     long: float
-    accuracy: float
-    speed: float
+    # None when no point of the minute had one
+    accuracy: Optional[float]
+    speed: Optional[float]
     user_id: str
     id: Optional[str] = None
+    # Number of points averaged into this minute
+    samples: int = 1
     _events: List[events.Event] = field(default_factory=list)
 
     def __post_init__(self):
@@ -44,3 +47,32 @@ class Location():
 
     def __repr__(self):
         return f"<Location {self.id}>"
+
+
+@dataclass
+class Rollup:
+    """Running totals of a user's points over a bucket of `resolution`
+    starting at `bucket`, kept as sums so partial rollups add up exactly.
+    `distance` is in meters along the points of the bucket."""
+    user_id: str
+    resolution: str
+    bucket: datetime
+    points: int
+    sum_lat: float
+    sum_long: float
+    max_speed: Optional[float]
+    distance: float
+    first_timestamp: datetime
+    first_lat: float
+    first_long: float
+    last_timestamp: datetime
+    last_lat: float
+    last_long: float
+
+    @property
+    def lat(self) -> float:
+        return self.sum_lat / self.points
+
+    @property
+    def long(self) -> float:
+        return self.sum_long / self.points
@@ -1,15 +1,67 @@
-from fastapi import FastAPI, HTTPException
+from contextlib import asynccontextmanager
+from datetime import datetime
+from typing import Optional
+from fastapi import FastAPI, HTTPException, Query, Request, Response
+from fastapi.responses import StreamingResponse
 from api.entrypoints import schemas
 from api.domain import commands
-from api import bootstrap
+from api import bootstrap, config, views
+from api.adapters import redis_eventpublisher
+from api.service_layer import unit_of_work
+from api.utils import metrics
+from api.utils.rollups import RESOLUTIONS
+from api.utils.timezone import TimezoneResolver
+from api.service_layer.user_actors import UserActors
+from api.utils.user_state import UserStateCache
+import asyncio
+import contextlib
+import json
 import logging
 import uvicorn
 
-print("calling bootstrap")
-bus = bootstrap.bootstrap()
+bootstrap.configure_logging()
 logger = logging.getLogger(__name__)
+logger.info("Bootstrapping the message bus")
+timezones = TimezoneResolver(**config.get_timezone_cache_config())
+publisher = redis_eventpublisher.create_publisher()
+user_state_config = config.get_user_state_cache_config()
+user_state = UserStateCache(**user_state_config) if user_state_config["maxsize"] else None
+bus = bootstrap.bootstrap(timezones=timezones, publish=publisher,
+                          buffer=bootstrap.default_buffer(user_state))
+# With INGEST_MODE=stream points are queued for `python -m api.worker`
+ingest_queue = (bootstrap.default_ingest_queue()
+                if config.get_ingest_mode() == "stream" else None)
+geo_index = config.get_geo_index()
+# Looks up bus when called, tests swap it
+user_actors_config = config.get_user_actors_config()
+user_actors = (UserActors(lambda cmd: bus.handle(cmd), **user_actors_config)
+               if user_actors_config["max_batch"] else None)
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await bus.uow.connect()
+    if ingest_queue:
+        await ingest_queue.create_groups()
+    flusher_task = None
+    if config.get_flush_mode() == "background":
+        flusher = bootstrap.bootstrap_flusher(publish=publisher)
+        flusher_task = asyncio.create_task(flusher.run())
+    yield
+    if flusher_task:
+        flusher_task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await flusher_task
+        # The requests are over, write every buffer they closed
+        try:
+            await flusher.drain()
+        except Exception:
+            logger.exception("Exception draining the closed buffers")
+    await publisher.close()
+    await unit_of_work.dispose()
+
+
+app = FastAPI(lifespan=lifespan)
 
 
 @app.get("/ping")
@@ -27,6 +79,44 @@ async def health():
         raise HTTPException(status_code=500, detail="Unhealthy")
 
 
+@app.get("/stats/timezones")
+async def timezone_stats():
+    return timezones.stats()
+
+
+@app.get("/stats/users")
+async def user_state_stats():
+    return user_state.stats() if user_state else {}
+
+
+@app.get("/stats/actors")
+async def user_actors_stats():
+    return user_actors.stats() if user_actors else {}
+
+
+@app.get("/stats/ingest")
+async def ingest_queue_stats():
+    return await ingest_queue.stats() if ingest_queue else {}
+
+
+@app.get("/metrics")
+async def prometheus_metrics():
+    # Values are per worker process, but for the shared ingest queue
+    for stat, value in timezones.stats().items():
+        metrics.TIMEZONE_CACHE.labels(stat).set(value)
+    if user_state:
+        for stat, value in user_state.stats().items():
+            metrics.USER_STATE_CACHE.labels(stat).set(value)
+    if user_actors:
+        for stat, value in user_actors.stats().items():
+            metrics.USER_ACTORS.labels(stat).set(value)
+    if ingest_queue:
+        for partition, stats in (await ingest_queue.stats()).items():
+            for stat, value in stats.items():
+                metrics.INGEST_QUEUE.labels(str(partition), stat).set(value)
+    return Response(metrics.REGISTRY.render(), media_type=metrics.CONTENT_TYPE)
+
+
 @app.put("/location", responses={
     200: {"model": schemas.SuccessResponse},
     400: {"model": schemas.ErrorResponse},
@@ -42,11 +132,200 @@ async def put_location(location: schemas.PutLocation):
         location.user_id,
     )
     try:
-        await bus.handle(cmd)
+        if ingest_queue:
+            await ingest_queue.enqueue([cmd])
+        elif user_actors:
+            await user_actors.put(cmd)
+        else:
+            await bus.handle(cmd)
     # We shouldn't get any exceptions here, but if we do, we want to log them
-    except Exception as e:
-        logger.error(e)
+    except Exception:
+        logger.exception("Exception storing a location")
         raise HTTPException(status_code=500, detail="Server error")
 
+
+NDJSON_CONTENT_TYPES = ("application/x-ndjson", "application/ndjson")
+
+
+async def read_location_items(request: Request):
+    # NDJSON bodies are consumed as they arrive, arrays are decoded at once
+    content_type = request.headers.get("content-type", "").split(";")[0].strip()
+    if content_type in NDJSON_CONTENT_TYPES:
+        pending = b""
+        async for chunk in request.stream():
+            pending += chunk
+            *lines, pending = pending.split(b"\n")
+            for line in lines:
+                if line.strip():
+                    yield line
+        if pending.strip():
+            yield pending
+    else:
+        body = await request.json()
+        if not isinstance(body, list):
+            raise ValueError("Expected a JSON array")
+        for item in body:
+            yield item
+
+
+def parse_location(item) -> commands.PutLocation:
+    if isinstance(item, bytes):
+        item = json.loads(item)
+    if not isinstance(item, dict):
+        raise ValueError("Expected a JSON object")
+    location = schemas.PutLocation(**item)
+    return commands.PutLocation(
+        location.timestamp,
+        location.lat,
+        location.long,
+        location.accuracy,
+        location.speed,
+        location.user_id,
+    )
+
+
+@app.put("/locations", response_model=schemas.PutLocationsResponse, responses={
+    400: {"model": schemas.ErrorResponse},
+    500: {"model": schemas.ServerErrorResponse},
+})
+async def put_locations(request: Request):
+    """Stores a batch of locations sent as a JSON array or as NDJSON."""
+    cmd = commands.PutLocations()
+    indexes = []
+    results = []
+    index = 0
+    try:
+        async for item in read_location_items(request):
+            try:
+                cmd.locations.append(parse_location(item))
+                indexes.append(index)
+            except ValueError as e:
+                results.append(schemas.LocationResult(
+                    index=index, status="invalid", detail=str(e)))
+            index += 1
+    except ValueError:
+        raise HTTPException(status_code=400,
+                            detail="Invalid or malformatted data.")
+
+    if cmd.locations:
+        try:
+            if ingest_queue:
+                await ingest_queue.enqueue(cmd.locations)
+                statuses = ["queued"] * len(cmd.locations)
+            else:
+                statuses = await bus.handle(cmd)
+        except Exception:
+            logger.exception("Exception storing %s locations", len(cmd.locations))
+            raise HTTPException(status_code=500, detail="Server error")
+        results.extend(schemas.LocationResult(index=i, status=status)
+                       for i, status in zip(indexes, statuses))
+
+    results.sort(key=lambda result: result.index)
+    accepted = sum(result.status == "accepted" for result in results)
+    queued = sum(result.status == "queued" for result in results)
+    return schemas.PutLocationsResponse(accepted=accepted,
+                                        rejected=len(results) - accepted - queued,
+                                        queued=queued, results=results)
+
+
+# Pages are streamed, so they can be as long as a day of minutes or more
+MAX_PAGE_SIZE = 100_000
+
+
+@app.get("/users/{user_id}/locations")
+async def get_user_locations(
+        user_id: str,
+        start: Optional[datetime] = Query(None, alias="from"),
+        end: Optional[datetime] = Query(None, alias="to"),
+        limit: int = Query(1440, ge=1, le=MAX_PAGE_SIZE),
+        cursor: Optional[datetime] = None,
+):
+    """Streams the stored minutes of a user from `from` up to `to` as NDJSON,
+    oldest first. For the next page pass the timestamp of the last line as
+    `cursor`, a page shorter than `limit` is the last one."""
+    async def lines():
+        try:
+            async for location in views.user_locations(
+                    user_id, bus.uow, start, end, cursor, limit):
+                yield json.dumps(location) + "\n"
+        except Exception:
+            # Too late for an error status, the response is cut short
+            logger.exception("Exception streaming locations of %s", user_id)
+            raise
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+
+@app.get("/users/{user_id}/rollups")
+async def get_user_rollups(
+        user_id: str,
+        resolution: str = Query("1h", description="5m, 1h or 1d"),
+        start: Optional[datetime] = Query(None, alias="from"),
+        end: Optional[datetime] = Query(None, alias="to"),
+):
+    """Point count, mean position, max speed and distance in meters of a
+    user per bucket of `resolution`, for the buckets from `from` up to `to`."""
+    if resolution not in RESOLUTIONS:
+        raise HTTPException(status_code=400,
+                            detail=f"resolution must be one of {', '.join(RESOLUTIONS)}")
+    try:
+        return await views.user_rollups(user_id, resolution, bus.uow, start, end)
+    except Exception:
+        logger.exception("Exception reading rollups of %s", user_id)
+        raise HTTPException(status_code=500, detail="Server error")
+
+
+# Most minutes or users a geospatial query answers with
+MAX_GEO_RESULTS = 10_000
+
+
+def check_geo_index():
+    if not geo_index:
+        raise HTTPException(status_code=404,
+                            detail="Geospatial queries need GEO_INDEX=true")
+
+
+@app.get("/locations/bbox")
+async def get_locations_in_bbox(
+        min_lat: float = Query(..., ge=-90, le=90),
+        min_long: float = Query(..., ge=-180, le=180),
+        max_lat: float = Query(..., ge=-90, le=90),
+        max_long: float = Query(..., ge=-180, le=180),
+        start: Optional[datetime] = Query(None, alias="from"),
+        end: Optional[datetime] = Query(None, alias="to"),
+        limit: int = Query(1000, ge=1, le=MAX_GEO_RESULTS),
+):
+    """Stored minutes of every user within the box, edges included, from
+    `from` up to `to`, oldest first. Boxes don't cross the antimeridian."""
+    check_geo_index()
+    if min_lat > max_lat or min_long > max_long:
+        raise HTTPException(status_code=400,
+                            detail="min_lat and min_long can't be above the max ones")
+    try:
+        return await views.locations_in_bbox(bus.uow, min_lat, min_long, max_lat,
+                                             max_long, start, end, limit)
+    except Exception:
+        logger.exception("Exception reading locations in a box")
+        raise HTTPException(status_code=500, detail="Server error")
+
+
+@app.get("/users/near")
+async def get_users_near(
+        lat: float = Query(..., ge=-90, le=90),
+        long: float = Query(..., ge=-180, le=180),
+        radius: float = Query(1000, gt=0, description="In meters"),
+        since: Optional[datetime] = None,
+        limit: int = Query(100, ge=1, le=MAX_GEO_RESULTS),
+):
+    """Users whose last stored minute, if after `since`, is within `radius`
+    meters of the point, with that minute and its distance, nearest first."""
+    check_geo_index()
+    try:
+        return await views.users_near(bus.uow, lat, long, radius, since, limit)
+    except Exception:
+        logger.exception("Exception reading users near a point")
+        raise HTTPException(status_code=500, detail="Server error")
+
+
 if __name__ == '__main__':
     uvicorn.run(app, host="0.0.0.0", port=5000)
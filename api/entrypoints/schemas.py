@@ -1,5 +1,6 @@
 from pydantic import BaseModel, Field
 from datetime import datetime
+from typing import List, Optional
 
 
 class PutLocation(BaseModel):
@@ -31,3 +32,17 @@ class ErrorResponse(ResponseData):
 class ServerErrorResponse(ResponseData):
     message: str = "Any other unexpected errors."
     status_code: int = 500
+
+
+class LocationResult(BaseModel):
+    index: int = Field(..., description="Position of the item in the request.")
+    status: str = Field(
+        ..., description="accepted, duplicate, out_of_order, invalid or queued.")
+    detail: Optional[str] = None
+
+
+class PutLocationsResponse(BaseModel):
+    accepted: int
+    rejected: int
+    queued: int = 0
+    results: List[LocationResult]
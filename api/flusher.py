@@ -0,0 +1,31 @@
+"""Runs the write-behind flusher on its own, for FLUSH_MODE=external.
+
+    python -m api.flusher
+"""
+import asyncio
+
+from api import bootstrap
+from api.service_layer import unit_of_work
+
+
+async def run():
+    flusher = bootstrap.bootstrap_flusher()
+    await flusher.uow.connect()
+    try:
+        await flusher.run()
+    finally:
+        # What was closed before the stop is written before leaving
+        try:
+            await flusher.drain()
+        finally:
+            await flusher.publish.close()
+            await unit_of_work.dispose()
+
+
+def main():
+    bootstrap.configure_logging()
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    main()
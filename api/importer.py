@@ -0,0 +1,211 @@
+"""Loads CSV files of points straight into the database, without the API.
+
+    python -m api.importer simulation/data/*.csv [--processes 4] [--chunk-size 10000]
+
+The points go through the steps of PUT /location, one at a time: validation,
+conversion to UTC, the buffer's duplicate and order rules against the newest
+stored minute of each user, and the means per minute of every closed buffer,
+whose parts are merged the way the repository merges them. Rows are taken in
+file order, like a device sending them would. Users are shared out between
+processes by user id, each process reading every file for its own users.
+
+New minutes are bulk loaded, with COPY on postgres and an unordered
+insert_many on mongo, the newest minute of a user that was stored before is
+upserted. At the end each user's open buffer is written as if a later point
+had closed it, `--keep-open` leaves them out, like the API until the next
+point. No events are published. Stop the ingest for the users being imported.
+"""
+import argparse
+import asyncio
+import csv
+import json
+import logging
+import zlib
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from api import bootstrap, config
+from api.adapters.buffer import MemoryBuffer
+from api.adapters.repository import merge_duplicates
+from api.domain import commands, models
+from api.entrypoints import schemas
+from api.service_layer import handlers, unit_of_work
+from api.utils.rollups import RESOLUTIONS, rollups_of
+from api.utils.timezone import TimezoneResolver
+
+logger = logging.getLogger(__name__)
+
+CSV_FIELDS = ("timestamp", "lat", "long", "accuracy", "speed", "user_id")
+
+MINUTE = timedelta(minutes=1)
+
+
+def owner_of(user_id: str, slots: int) -> int:
+    return zlib.crc32(user_id.encode()) % slots
+
+
+def parse_row(row: Dict[str, str]) -> commands.PutLocation:
+    # Validated like a request body, empty cells are left out of it
+    location = schemas.PutLocation(**{field: row[field] for field in CSV_FIELDS
+                                      if row.get(field)})
+    return commands.PutLocation(location.timestamp, location.lat, location.long,
+                                location.accuracy, location.speed, location.user_id)
+
+
+def read_chunks(paths: List[str], slot: int, slots: int, chunk_size: int,
+                counts: Counter) -> Iterator[List[commands.PutLocation]]:
+    """The valid points of the users of `slot`, `chunk_size` at a time."""
+    chunk = []
+    for path in paths:
+        with open(path, newline="") as f:
+            for row in csv.DictReader(f):
+                if owner_of(row.get("user_id") or "", slots) != slot:
+                    continue
+                try:
+                    chunk.append(parse_row(row))
+                except ValueError:
+                    counts["invalid"] += 1
+                    continue
+                if len(chunk) == chunk_size:
+                    yield chunk
+                    chunk = []
+    if chunk:
+        yield chunk
+
+
+class Importer:
+    """Replays points through a MemoryBuffer. The minutes and rollups of the
+    closed buffers are held back until no later point can add to them, and
+    then written merged, once per chunk."""
+
+    def __init__(self, uow: unit_of_work.AbstractUnitOfWork,
+                 timezones: TimezoneResolver, keep_open: bool = False):
+        self.uow = uow
+        self.timezones = timezones
+        self.keep_open = keep_open
+        self.buffer = MemoryBuffer()
+        # Newest minute of each user stored before the import, None if none
+        self.floors: Dict[str, Optional[datetime]] = {}
+        self.minutes: Dict[Tuple[str, datetime], List[models.Location]] = {}
+        self.rollups: Dict[Tuple[str, str, datetime], List[models.Rollup]] = {}
+        self.counts: Counter = Counter()
+
+    async def add(self, locations: List[commands.PutLocation]):
+        utc_times = self.timezones.convert_many([i.timestamp for i in locations],
+                                                [i.lat for i in locations],
+                                                [i.long for i in locations],
+                                                [i.user_id for i in locations])
+        entries = [handlers.buffer_entry(location, utc_time)
+                   for location, utc_time in zip(locations, utc_times)]
+        async with self.uow:
+            users = {entry["user_id"] for entry in entries} - self.floors.keys()
+            if users:
+                current = await self.uow.locations.get_last_locations_for_users(users)
+                self.floors.update({user_id: current[user_id].timestamp
+                                    if user_id in current else None
+                                    for user_id in users})
+            for status, flushed in await self.buffer.append_many(entries, self.floors):
+                self.counts[status] += 1
+                if flushed:
+                    self._close(flushed)
+            await self._write(final=False)
+            await self.uow.commit()
+
+    async def finish(self):
+        async with self.uow:
+            if not self.keep_open:
+                for buffer in self.buffer.buffers.values():
+                    if buffer:
+                        self._close(buffer)
+                self.buffer.buffers.clear()
+            await self._write(final=True)
+            await self.uow.commit()
+
+    def _close(self, buffer: List[dict]):
+        # What one flush of the API would upsert, in the order it would
+        for location in handlers.aggregate_buffer(buffer):
+            self.minutes.setdefault(
+                (location.user_id, location.timestamp), []).append(location)
+        for rollup in rollups_of(buffer):
+            self.rollups.setdefault(
+                (rollup.user_id, rollup.resolution, rollup.bucket), []).append(rollup)
+
+    def _done(self, user_id: str, end: datetime) -> bool:
+        # Later points of the user are newer than the oldest one buffered
+        oldest = self.buffer.oldest(user_id)
+        return oldest is None or end <= oldest
+
+    async def _write(self, final: bool):
+        keys = [key for key in self.minutes if final or self._done(key[0], key[1] + MINUTE)]
+        loaded = []
+        for key in keys:
+            parts = self.minutes.pop(key)
+            if key[1] == self.floors.get(key[0]):
+                # Stored before, merged into part by part like the API does
+                for part in parts:
+                    await self.uow.locations.upsert(part)
+            else:
+                loaded.extend(merge_duplicates(parts))
+        await self.uow.locations.load_many(loaded)
+        self.counts["minutes"] += len(keys)
+        keys = [key for key in self.rollups
+                if final or self._done(key[0], key[2] + RESOLUTIONS[key[1]])]
+        await self.uow.locations.upsert_rollups(
+            [part for key in keys for part in self.rollups.pop(key)])
+
+
+async def import_files(uow: unit_of_work.AbstractUnitOfWork, paths: List[str],
+                       slot: int = 0, slots: int = 1, chunk_size: int = 10_000,
+                       keep_open: bool = False) -> Counter:
+    """Imports the points of the users of `slot`, returning the number of
+    points per buffer status, of invalid rows and of minutes written."""
+    importer = Importer(uow, TimezoneResolver(**config.get_timezone_cache_config()),
+                        keep_open)
+    invalid: Counter = Counter()
+    for chunk in read_chunks(paths, slot, slots, chunk_size, invalid):
+        await importer.add(chunk)
+    await importer.finish()
+    return importer.counts + invalid
+
+
+async def run(paths: List[str], slot: int, slots: int, chunk_size: int,
+              keep_open: bool) -> Counter:
+    uow = bootstrap.default_uow(start_orm=True)
+    await uow.connect()
+    try:
+        return await import_files(uow, paths, slot, slots, chunk_size, keep_open)
+    finally:
+        await unit_of_work.dispose()
+
+
+def run_process(paths: List[str], slot: int, slots: int, chunk_size: int,
+                keep_open: bool) -> Counter:
+    bootstrap.configure_logging()
+    counts = asyncio.run(run(paths, slot, slots, chunk_size, keep_open))
+    logger.info("Process %s of %s imported %s", slot + 1, slots, dict(counts))
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("paths", nargs="+", help="CSV files with a header row")
+    parser.add_argument("--processes", type=int, default=1)
+    parser.add_argument("--chunk-size", type=int, default=10_000,
+                        help="points per transaction")
+    parser.add_argument("--keep-open", action="store_true",
+                        help="leave out each user's last, still open buffer")
+    args = parser.parse_args()
+    if args.processes == 1:
+        counts = run_process(args.paths, 0, 1, args.chunk_size, args.keep_open)
+    else:
+        with ProcessPoolExecutor(args.processes) as pool:
+            counts = sum(pool.map(run_process, *zip(*[
+                (args.paths, slot, args.processes, args.chunk_size, args.keep_open)
+                for slot in range(args.processes)])), Counter())
+    print(json.dumps(dict(counts)))
+
+
+if __name__ == "__main__":
+    main()
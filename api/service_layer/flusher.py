@@ -0,0 +1,64 @@
+from __future__ import annotations
+import asyncio
+import logging
+
+from api.adapters.buffer import AbstractBuffer
+from api.adapters.redis_eventpublisher import AbstractPublisher
+from api.service_layer import handlers, unit_of_work
+
+logger = logging.getLogger(__name__)
+
+
+class Flusher:
+    """Writes the buffers closed in write-behind mode to the repository.
+
+    Every `interval` seconds, up to `batch_size` closed buffers are taken off
+    the queue and written in one transaction. The queue is drained without
+    waiting while full batches keep coming. Buffers of a batch that failed,
+    or was cancelled, go back to the queue; call `drain` on shutdown.
+    """
+
+    def __init__(self, uow: unit_of_work.AbstractUnitOfWork, buffer: AbstractBuffer,
+                 publish: AbstractPublisher, interval: float = 1.0,
+                 batch_size: int = 500):
+        self.uow = uow
+        self.buffer = buffer
+        self.interval = interval
+        self.batch_size = batch_size
+        self.publish = publish
+
+    async def flush_once(self) -> int:
+        buffers = await self.buffer.pop_closed(self.batch_size)
+        if not buffers:
+            return 0
+        try:
+            async with self.uow:
+                locations = await handlers.flush_buffer(
+                    [entry for buffer in buffers for entry in buffer], self.uow)
+                await self.uow.commit()
+        except BaseException:
+            # Cancelled too, a shutdown in the middle of a batch loses nothing
+            await self.buffer.requeue_closed(buffers)
+            raise
+        await handlers.publish_locations_added(locations, self.publish)
+        logger.debug("Flushed %s buffers into %s minutes", len(buffers), len(locations))
+        return len(buffers)
+
+    async def drain(self) -> int:
+        """Flushes until the queue is empty, returning the buffers flushed."""
+        flushed = 0
+        while count := await self.flush_once():
+            flushed += count
+        return flushed
+
+    async def run(self):
+        logger.info("Flushing every %ss, %s buffers at a time",
+                    self.interval, self.batch_size)
+        while True:
+            try:
+                flushed = await self.flush_once()
+            except Exception:
+                logger.exception("Exception flushing buffers")
+                flushed = 0
+            if flushed < self.batch_size:
+                await asyncio.sleep(self.interval)
@@ -0,0 +1,126 @@
+from __future__ import annotations
+import asyncio
+import logging
+from typing import List, Optional
+
+from api.adapters.dead_letters import AbstractDeadLetters, DeadLetter
+from api.adapters.ingest_queue import AbstractIngestQueue, QueuedBatch
+from api.domain import commands
+from api.service_layer.messagebus import MessageBus
+from api.utils import metrics
+
+logger = logging.getLogger(__name__)
+
+
+def partitions_of(slot: int, slots: int, partitions: int) -> List[int]:
+    """The partitions read by worker `slot` of `slots`."""
+    return list(range(slot, partitions, slots))
+
+
+class IngestWorker:
+    """Stores the points queued on `partitions` with INGEST_MODE=stream.
+
+    A partition is read by one worker only, so the points of a user are
+    stored in the order they were queued, without locks. Each read of up to
+    `count` batches per partition goes to the bus as one PutLocations and is
+    acked once handled. A read that failed stays pending and is read again
+    before anything new; points buffered the first time are turned away by
+    the buffer as duplicates.
+
+    The bus's buffer has to be write-behind: the minutes a batch closes are
+    queued by the same redis call that empties their buffer, and written by
+    a Flusher, which requeues them when that fails. Flushed inline, a failed
+    write would lose them, the batch read again being turned away.
+
+    `consumer` should stay the same across restarts, so a restarted worker
+    picks up what it had read. Every `claim_interval` seconds, batches other
+    consumers left pending on these partitions for `claim_idle_ms` are taken
+    over, for when the partitions were shared out differently before.
+
+    Batches read again are handled one at a time. One that fails after
+    being read `max_deliveries` times goes to `dead_letters` and is acked,
+    so it stops holding up its partition.
+    """
+
+    def __init__(self, bus: MessageBus, queue: AbstractIngestQueue,
+                 partitions: List[int], consumer: str, count: int = 100,
+                 block_ms: int = 1000, claim_idle_ms: int = 60_000,
+                 claim_interval: float = 30.0, retry_interval: float = 1.0,
+                 max_deliveries: int = 5,
+                 dead_letters: Optional[AbstractDeadLetters] = None):
+        self.bus = bus
+        self.queue = queue
+        self.partitions = partitions
+        self.consumer = consumer
+        self.count = count
+        self.block_ms = block_ms
+        self.claim_idle_ms = claim_idle_ms
+        self.claim_interval = claim_interval
+        self.retry_interval = retry_interval
+        self.max_deliveries = max_deliveries
+        self.dead_letters = dead_letters
+
+    async def handle(self, batches: List[QueuedBatch]) -> int:
+        cmd = commands.PutLocations(
+            [location for batch in batches for location in batch.locations])
+        if cmd.locations:
+            await self.bus.handle(cmd)
+        await self.queue.ack(batches)
+        logger.debug("%s stored %s points from %s batches",
+                     self.consumer, len(cmd.locations), len(batches))
+        return len(cmd.locations)
+
+    async def recover(self) -> int:
+        """Handles the batches this consumer read and didn't ack, then the
+        ones it claims from other consumers."""
+        handled = 0
+        while batches := await self.queue.read(self.partitions, self.consumer,
+                                               self.count, pending=True):
+            handled += await self.retry(batches)
+        for partition in self.partitions:
+            while batches := await self.queue.claim(partition, self.consumer,
+                                                    self.claim_idle_ms, self.count):
+                handled += await self.retry(batches)
+        return handled
+
+    async def retry(self, batches: List[QueuedBatch]) -> int:
+        handled = 0
+        for batch in batches:
+            try:
+                handled += await self.handle([batch])
+            except Exception as e:
+                if batch.deliveries < self.max_deliveries:
+                    raise
+                await self.dead_letter(batch, e)
+        return handled
+
+    async def dead_letter(self, batch: QueuedBatch, error: Exception):
+        logger.error("%s giving up on batch %s of partition %s after %s reads: %r",
+                     self.consumer, batch.id, batch.partition, batch.deliveries, error)
+        metrics.DEAD_LETTERS.inc()
+        if self.dead_letters is not None:
+            await self.dead_letters.add(DeadLetter(
+                commands.PutLocations(batch.locations), type(self).__name__,
+                repr(error), batch.deliveries))
+        await self.queue.ack([batch])
+
+    async def run_once(self) -> int:
+        batches = await self.queue.read(self.partitions, self.consumer, self.count,
+                                        block_ms=self.block_ms)
+        return await self.handle(batches) if batches else 0
+
+    async def run(self):
+        logger.info("%s reading partitions %s", self.consumer, self.partitions)
+        loop = asyncio.get_running_loop()
+        next_claim = 0.0
+        while True:
+            try:
+                if loop.time() >= next_claim:
+                    await self.recover()
+                    next_claim = loop.time() + self.claim_interval
+                await self.run_once()
+            except Exception:
+                logger.exception("Exception storing queued locations")
+                # What failed is pending, it goes first on the next round
+                next_claim = 0.0
+                await asyncio.sleep(self.retry_interval)
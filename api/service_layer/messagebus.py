@@ -1,8 +1,12 @@
 from __future__ import annotations
+import asyncio
 import logging
-from typing import TYPE_CHECKING, List, Optional, Union, Type, Dict, Callable
+from collections import deque
+from typing import TYPE_CHECKING, Deque, List, Optional, Union, Type, Dict, Callable
 
+from api.adapters.dead_letters import AbstractDeadLetters, DeadLetter
 from api.domain import commands, events
+from api.utils import metrics
 
 if TYPE_CHECKING:
     from . import unit_of_work
@@ -13,45 +17,132 @@ Message = Union[commands.Command, events.Event]
 
 
 class MessageBus:
+    """Handles a command and then the events it raises.
+
+    Every call to `handle` has its own queue, so one bus can serve concurrent
+    requests. The handlers of an event run concurrently, at most
+    `max_concurrency` at a time across the bus. A failing event handler is
+    retried `retries` times, waiting `backoff` seconds and doubling that each
+    time, and then goes to `dead_letters`. Failing commands raise.
+    """
+
     def __init__(
             self,
             uow: unit_of_work.AbstractUnitOfWork,
             event_handlers: Dict[Type[events.Event], List[Callable]],
             command_handlers: Dict[Type[commands.Command], Callable],
+            dead_letters: Optional[AbstractDeadLetters] = None,
+            max_concurrency: int = 10,
+            retries: int = 3,
+            backoff: float = 0.1,
     ):
         self.uow = uow
         self.event_handlers = event_handlers
         self.command_handlers = command_handlers
+        self.dead_letters = dead_letters
+        self.max_concurrency = max_concurrency
+        self.retries = retries
+        self.backoff = backoff
+        self._slots: Optional[asyncio.Semaphore] = None
+
+    @property
+    def slots(self) -> asyncio.Semaphore:
+        # Created on first use, to belong to the loop handling the requests
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_concurrency)
+        return self._slots
 
-    # Implement dead letter queue
     async def handle(self, message: Message):
-        self.queue = [message]
-        while self.queue:
-            message = self.queue.pop(0)
+        """Handles the message and everything it leads to, returning the
+        result of the command handler."""
+        queue: Deque[Message] = deque([message])
+        result = None
+        while queue:
+            message = queue.popleft()
             if isinstance(message, events.Event):
-                await self.handle_event(message)
+                await self.handle_event(message, queue)
             elif isinstance(message, commands.Command):
-                return await self.handle_command(message)
+                result = await self.handle_command(message, queue)
             else:
                 raise Exception(f"{message} was not an Event or Command")
+        return result
 
-    async def handle_event(self, event: events.Event):
-        for handler in self.event_handlers[type(event)]:
+    async def handle_event(self, event: events.Event, queue: Deque[Message]):
+        handlers = self.event_handlers[type(event)]
+        if len(handlers) == 1:
+            new_events = [await self._run_event_handler(handlers[0], event)]
+        else:
+            new_events = await asyncio.gather(*[
+                self._run_event_handler(handler, event) for handler in handlers])
+        for raised in new_events:
+            queue.extend(raised)
+
+    async def _run_event_handler(self, handler: Callable,
+                                 event: events.Event) -> List[events.Event]:
+        name = type(event).__name__
+        handler_name = _name_of(handler)
+        for attempt in range(self.retries + 1):
             try:
-                logger.debug(f"Handling event {event} with handler {handler}")
-                await handler(event)
-                self.queue.extend(self.uow.collect_new_events())
-            except Exception:
-                logger.exception(f"Exception handling event {event}")
-                continue
-
-    async def handle_command(self, command: commands.Command):
-        logger.debug(f"Handling command {command}")
+                logger.debug("Handling event %s with handler %s", event, handler_name)
+                async with self.slots:
+                    with metrics.MESSAGE_SECONDS.labels("event", name).time():
+                        await handler(event)
+                # Collected here, the unit of work keeps what the handler saw
+                # in this task
+                return list(self.uow.collect_new_events())
+            except Exception as e:
+                metrics.MESSAGE_ERRORS.labels("event", name).inc()
+                if attempt < self.retries:
+                    logger.warning("Retrying event %s with handler %s: %r",
+                                   event, handler_name, e)
+                    await asyncio.sleep(self.backoff * 2 ** attempt)
+                    continue
+                logger.exception("Exception handling event %s with handler %s",
+                                 event, handler_name)
+                await self._dead_letter(event, handler_name, e, attempt + 1)
+        return []
+
+    async def _dead_letter(self, event: events.Event, handler_name: str,
+                           error: Exception, attempts: int):
+        metrics.DEAD_LETTERS.inc()
+        if self.dead_letters is None:
+            return
+        try:
+            await self.dead_letters.add(DeadLetter(event, handler_name, repr(error),
+                                                   attempts))
+        except Exception:
+            logger.exception("Exception storing dead letter for event %s", event)
+
+    async def handle_command(self, command: commands.Command,
+                             queue: Deque[Message] = None):
+        name = type(command).__name__
+        logger.debug("Handling command %s", command)
         try:
             handler = self.command_handlers[type(command)]
-            result = await handler(command)
-            self.queue.extend(self.uow.collect_new_events())
+            with metrics.MESSAGE_SECONDS.labels("command", name).time():
+                result = await handler(command)
+            if queue is not None:
+                queue.extend(self.uow.collect_new_events())
             return result
         except Exception:
-            logger.exception(f"Exception handling command {command}")
+            metrics.MESSAGE_ERRORS.labels("command", name).inc()
+            logger.exception("Exception handling command %s", command)
             raise
+
+    async def redrive_dead_letters(self, count: int = 100) -> int:
+        """Runs up to `count` dead lettered events through the handler that
+        failed them again, returning how many were taken off the store.
+        Those failing again go back to it."""
+        if self.dead_letters is None:
+            return 0
+        letters = await self.dead_letters.pop(count)
+        for letter in letters:
+            for handler in self.event_handlers.get(type(letter.event), []):
+                if _name_of(handler) == letter.handler:
+                    for raised in await self._run_event_handler(handler, letter.event):
+                        await self.handle(raised)
+        return len(letters)
+
+
+def _name_of(handler: Callable) -> str:
+    return getattr(handler, "__name__", repr(handler))
@@ -1,8 +1,11 @@
 from __future__ import annotations
 import abc
+import contextvars
+from typing import Optional
+
 import api.config as config
 from api.adapters import repository
-from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, create_async_engine
 from sqlalchemy.ext.asyncio import async_sessionmaker
 from motor.motor_asyncio import AsyncIOMotorClient
 from motor.motor_asyncio import AsyncIOMotorCollection
@@ -11,8 +14,37 @@ from motor.motor_asyncio import AsyncIOMotorDatabase
 MongoDBClient = AsyncIOMotorClient
 
 
+class task_local:
+    """Unit of work attribute kept per asyncio task.
+
+    One unit of work is shared by every request of a worker, so its session
+    and repository can't live on the instance. Values are copied on write so
+    child tasks never change what their parent sees.
+    """
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, uow, owner=None):
+        if uow is None:
+            return self
+        try:
+            return uow._task_state.get()[self.name]
+        except KeyError:
+            raise AttributeError(self.name) from None
+
+    def __set__(self, uow, value):
+        uow._task_state.set(dict(uow._task_state.get(), **{self.name: value}))
+
+
 class AbstractUnitOfWork(abc.ABC):
-    locations: repository.AbstractRepository
+    locations: repository.AbstractRepository = task_local()
+    # Entered with read_only(): no transaction is started, commit is a no-op
+    is_read_only: bool = task_local()
+
+    def __init__(self):
+        self._task_state = contextvars.ContextVar(f"uow-{id(self)}", default={})
+        self.is_read_only = False
 
     async def __aenter__(self) -> AbstractUnitOfWork:
         return self
@@ -20,14 +52,28 @@ class AbstractUnitOfWork(abc.ABC):
     async def __aexit__(self, *args):
         await self._rollback()
 
+    def read_only(self) -> ReadOnly:
+        """Enters the unit of work without a transaction, for commands that
+        only read, like HealthCheck."""
+        return ReadOnly(self)
+
     async def commit(self):
-        await self._commit()
+        if not self.is_read_only:
+            await self._commit()
 
     def collect_new_events(self):
-        for loc in self.locations.seen:
+        try:
+            seen = self.locations.seen
+        except AttributeError:
+            # Not entered in this task
+            return
+        for loc in seen:
             while loc._events:
                 yield loc._events.pop(0)
 
+    async def connect(self):
+        """Opens the connection pools, otherwise opened on first use."""
+
     @abc.abstractmethod
     async def _commit(self):
         raise NotImplementedError
@@ -41,30 +87,89 @@ class AbstractUnitOfWork(abc.ABC):
         raise NotImplementedError
 
 
-def create_engine():
+class ReadOnly:
+    def __init__(self, uow: AbstractUnitOfWork):
+        self.uow = uow
+
+    async def __aenter__(self) -> AbstractUnitOfWork:
+        self.uow.is_read_only = True
+        try:
+            return await self.uow.__aenter__()
+        except BaseException:
+            self.uow.is_read_only = False
+            raise
+
+    async def __aexit__(self, *args):
+        try:
+            await self.uow.__aexit__(*args)
+        finally:
+            self.uow.is_read_only = False
+
+
+# Created on first use, or by the app lifespan, and shared by every unit of
+# work of the process
+_engine: Optional[AsyncEngine] = None
+_session_factory: Optional[async_sessionmaker] = None
+_mongo_client: Optional[MongoDBClient] = None
+
+
+def create_engine() -> AsyncEngine:
     return create_async_engine(
         config.get_postgres_uri(),
         future=True,
-        echo=True,
+        echo=config.get_sql_echo(),
+        **config.get_postgres_pool_config(),
     )
 
 
-DEFAULT_SESSION_FACTORY = async_sessionmaker(
-    create_engine(),
-    expire_on_commit=False,
-    class_=AsyncSession,
-    future=True,
-)
+def get_session_factory() -> async_sessionmaker:
+    global _engine, _session_factory
+    if _session_factory is None:
+        _engine = create_engine()
+        _session_factory = async_sessionmaker(
+            _engine,
+            expire_on_commit=False,
+            class_=AsyncSession,
+            future=True,
+        )
+    return _session_factory
+
+
+def get_mongo_client() -> MongoDBClient:
+    global _mongo_client
+    if _mongo_client is None:
+        _mongo_client = config.get_mongo_client()
+    return _mongo_client
+
 
-MONGO_CONFIG = config.mongo_config()
+async def dispose():
+    """Closes the shared engine and mongo client, if they were created."""
+    global _engine, _session_factory, _mongo_client
+    if _engine is not None:
+        await _engine.dispose()
+        _engine = _session_factory = None
+    if _mongo_client is not None:
+        _mongo_client.close()
+        _mongo_client = None
 
 
 class SqlAlchemyUnitOfWork(AbstractUnitOfWork):
-    def __init__(self, session_factory=DEFAULT_SESSION_FACTORY):
+    session: AsyncSession = task_local()
+
+    def __init__(self, session_factory=None):
+        super().__init__()
         self.session_factory = session_factory
 
+    async def connect(self):
+        if self.session_factory is None:
+            self.session_factory = get_session_factory()
+
     async def __aenter__(self):
-        self.session: AsyncSession = self.session_factory()
+        await self.connect()
+        # Sessions only check out a connection, and begin, on their first
+        # statement, so read-only units of work that never query stay off
+        # the pool
+        self.session = self.session_factory()
         self.locations = repository.SqlAlchemyRepository(self.session)
         return await super().__aenter__()
 
@@ -82,48 +187,43 @@ class SqlAlchemyUnitOfWork(AbstractUnitOfWork):
         return f"<SqlAlchemyUnitOfWork(session={self.session})>"
 
 
-# class MongoDBUnitOfWork(AbstractUnitOfWork):
-# def __init__(self, db: MongoDBClient = MONGO_CONFIG["client"]):
-# self.db = db
-##
-# async def __aenter__(self):
-# self.session = await self.db.start_session()
-# self.session.start_transaction()
-# self.locations = repository.MongoDBRepository(self.db,
-# MONGO_CONFIG["collection"],
-# MONGO_CONFIG["collection"],
-# self.session)
-# return await super().__aenter__()
-##
-# async def __aexit__(self, *args):
-# await super().__aexit__(*args)
-# await self.session.end_session()
-##
-# async def _commit(self):
-# await self.session.commit_transaction()
-##
-# async def _rollback(self):
-# await self.session.abort_transaction()
-##
-# async def __repr__(self):
-# return f"<MongoDBUnitOfWork(db={self.db})>"
-##
-
 class MongoDBUnitOfWork(AbstractUnitOfWork):
-    def __init__(self, client: MongoDBClient = MONGO_CONFIG["client"],
-                 db_name: str = "locations", collection_name: str = "locations"):
+    """With `transactions` off no session is started, each write stands on
+    its own. `timeseries` is for a time series collection, see
+    MongoDBTimeSeriesRepository, `geo` stores GeoJSON positions."""
+    session = task_local()
+    transaction_started: bool = task_local()
+
+    def __init__(self, client: MongoDBClient = None,
+                 db_name: str = "locations", collection_name: str = "locations",
+                 transactions: bool = True, timeseries: bool = False,
+                 geo: bool = False):
+        super().__init__()
         self.client = client
         self.db_name = db_name
         self.collection_name = collection_name
+        self.transactions = transactions
+        self.geo = geo
+        self.repository_class = repository.MongoDBTimeSeriesRepository if timeseries \
+            else repository.MongoDBRepository
         self.session = None
         self.transaction_started = False
 
+    async def connect(self):
+        if self.client is None:
+            self.client = get_mongo_client()
+
     async def __aenter__(self):
-        self.session = await self.client.start_session()
-        self.session.start_transaction()
-        self.transaction_started = True
-        self.locations = repository.MongoDBRepository(self.client, self.db_name,
-                                                      self.collection_name, self.session)
+        await self.connect()
+        self.session = None
+        self.transaction_started = False
+        if self.transactions and not self.is_read_only:
+            self.session = await self.client.start_session()
+            self.session.start_transaction()
+            self.transaction_started = True
+        self.locations = self.repository_class(self.client, self.db_name,
+                                               self.collection_name, self.session,
+                                               geo=self.geo)
         return self
 
     async def __aexit__(self, exc_type, exc_val, exc_tb):
@@ -136,7 +236,8 @@ class MongoDBUnitOfWork(AbstractUnitOfWork):
                 await self.session.commit_transaction()
                 self.transaction_started = False
 
-        await self.session.end_session()
+        if self.session is not None:
+            await self.session.end_session()
 
     async def _commit(self):
         if self.transaction_started:
@@ -149,4 +250,4 @@ class MongoDBUnitOfWork(AbstractUnitOfWork):
             self.transaction_started = False
 
     async def __repr__(self):
-        return f"<MongoDBUnitOfWork(db={self.db})>"
+        return f"<MongoDBUnitOfWork(client={self.client})>"
@@ -0,0 +1,94 @@
+from __future__ import annotations
+import asyncio
+import logging
+from typing import Awaitable, Callable, Dict, List, Set, Tuple
+
+from api.domain import commands
+
+logger = logging.getLogger(__name__)
+
+Handle = Callable[[commands.PutLocations], Awaitable[List[str]]]
+
+
+class UserActors:
+    """Stores the points of each user one batch at a time, in arrival order.
+
+    A point goes to its user's mailbox, read by a single task per user. The
+    task takes everything waiting, up to `max_batch` points, and hands it to
+    `handle` as one PutLocations: one round trip to the buffer and at most
+    one flush, instead of concurrent requests racing on the same buffer and
+    row. Points arriving while a batch is stored make up the next one, so a
+    lone point waits for nothing.
+
+    A task stays `ttl` seconds after its mailbox emptied and then ends, so
+    only users seen lately cost memory. The mailboxes belong to the event
+    loop that put the first point.
+    """
+
+    def __init__(self, handle: Handle, max_batch: int = 100, ttl: float = 5.0):
+        self.handle = handle
+        self.max_batch = max_batch
+        self.ttl = ttl
+        self.mailboxes: Dict[str, asyncio.Queue] = {}
+        # The loop only keeps weak references to its tasks
+        self.tasks: Set[asyncio.Task] = set()
+        self.points = 0
+        self.batches = 0
+        self.evicted = 0
+
+    async def put(self, cmd: commands.PutLocation) -> str:
+        """Stores the point with the others of its batch, returning its
+        buffer status. Raises what storing the batch raised."""
+        mailbox = self.mailboxes.get(cmd.user_id)
+        if mailbox is None:
+            mailbox = self.mailboxes[cmd.user_id] = asyncio.Queue()
+            task = asyncio.create_task(self._run(cmd.user_id, mailbox))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+        result = asyncio.get_running_loop().create_future()
+        mailbox.put_nowait((cmd, result))
+        return await result
+
+    async def _run(self, user_id: str, mailbox: asyncio.Queue):
+        try:
+            while True:
+                try:
+                    first = await asyncio.wait_for(mailbox.get(), self.ttl)
+                except asyncio.TimeoutError:
+                    # Nothing can be put between here and the del below
+                    if mailbox.empty():
+                        self.evicted += 1
+                        return
+                    continue
+                batch = [first]
+                while len(batch) < self.max_batch and not mailbox.empty():
+                    batch.append(mailbox.get_nowait())
+                await self._store(batch)
+        finally:
+            del self.mailboxes[user_id]
+
+    async def _store(self, batch: List[Tuple[commands.PutLocation, asyncio.Future]]):
+        self.points += len(batch)
+        self.batches += 1
+        try:
+            statuses = await self.handle(commands.PutLocations([cmd for cmd, _ in batch]))
+        except Exception as e:
+            logger.debug("Batch of %s points of %s failed: %r",
+                         len(batch), batch[0][0].user_id, e)
+            for _, result in batch:
+                if not result.done():
+                    result.set_exception(e)
+            return
+        for (_, result), status in zip(batch, statuses):
+            # Done already when the request was cancelled
+            if not result.done():
+                result.set_result(status)
+
+    def stats(self) -> dict:
+        return {
+            "actors": len(self.mailboxes),
+            "points": self.points,
+            "batches": self.batches,
+            "points_per_batch": self.points / self.batches if self.batches else 0.0,
+            "evicted": self.evicted,
+        }
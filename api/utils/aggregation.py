@@ -0,0 +1,76 @@
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Tuple
+
+FIELDS = ("lat", "long", "accuracy", "speed")
+
+
+def minute_of(timestamp: datetime) -> datetime:
+    return timestamp.replace(second=0, microsecond=0)
+
+
+class RunningMean:
+    """Mean of a stream of floats, skipping missing values.
+
+    Sums with Kahan compensation, the way pandas' groupby mean does, so the
+    result matches `resample('1T').mean()` for values fed in timestamp order.
+    """
+    __slots__ = ("total", "compensation", "count")
+
+    def __init__(self):
+        self.total = 0.0
+        self.compensation = 0.0
+        self.count = 0
+
+    def add(self, value):
+        if value is None or value != value:
+            return
+        self.count += 1
+        y = value - self.compensation
+        t = self.total + y
+        self.compensation = t - self.total - y
+        if self.compensation != self.compensation:
+            self.compensation = 0.0
+        self.total = t
+
+    @property
+    def mean(self) -> Optional[float]:
+        # None when every value was missing, stored as NULL
+        return self.total / self.count if self.count else None
+
+
+def weighted_mean(current: Optional[float], current_samples: int,
+                  other: Optional[float], other_samples: int) -> Optional[float]:
+    """Mean of two means of `samples` points each, a missing one left out."""
+    if current is None:
+        return other
+    if other is None:
+        return current
+    samples = current_samples + other_samples
+    return (current * current_samples + other * other_samples) / samples
+
+
+class MinuteAggregator:
+    """Running means of the location fields per (user_id, minute) bucket."""
+
+    def __init__(self):
+        self.buckets: Dict[Tuple[str, datetime], Dict[str, RunningMean]] = {}
+
+    def add(self, entry: dict):
+        key = (entry["user_id"], minute_of(entry["timestamp"]))
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = {field: RunningMean() for field in FIELDS}
+        for field in FIELDS:
+            bucket[field].add(entry[field])
+
+    def add_many(self, entries: Iterable[dict]):
+        for entry in entries:
+            self.add(entry)
+
+    def results(self) -> List[dict]:
+        """Returns one entry per bucket, ordered by user and minute, with the
+        number of points averaged in `samples`."""
+        return [dict({field: bucket[field].mean for field in FIELDS},
+                     user_id=user_id, timestamp=minute,
+                     samples=bucket["lat"].count)
+                for (user_id, minute), bucket in sorted(self.buckets.items())]
@@ -0,0 +1,52 @@
+import math
+from typing import List, Tuple
+
+from api.utils.rollups import EARTH_RADIUS_M
+
+# Meters per degree of latitude
+METERS_PER_DEGREE = math.pi * EARTH_RADIUS_M / 180
+
+# How far the great circle edges of bbox_polygon may stray from the
+# parallels between two vertices, in degrees, with a wide safety margin
+POLYGON_STEP = 1.0
+POLYGON_MARGIN = 0.01
+
+
+def point(lat: float, long: float) -> dict:
+    """GeoJSON point, longitude first."""
+    return {"type": "Point", "coordinates": [long, lat]}
+
+
+def in_bbox(lat: float, long: float, min_lat: float, min_long: float,
+            max_lat: float, max_long: float) -> bool:
+    return min_lat <= lat <= max_lat and min_long <= long <= max_long
+
+
+def degrees_around(lat: float, radius: float) -> Tuple[float, float]:
+    """Latitude and longitude degrees holding a circle of `radius` meters
+    around a point at `lat`, for a box to look in before measuring."""
+    dlat = radius / METERS_PER_DEGREE
+    if abs(lat) + dlat >= 90:
+        return dlat, 180.0
+    return dlat, min(180.0, dlat / math.cos(math.radians(abs(lat) + dlat)))
+
+
+def bbox_polygon(min_lat: float, min_long: float, max_lat: float,
+                 max_long: float) -> dict:
+    """GeoJSON polygon holding the box, to look in with a 2dsphere index.
+
+    Polygon edges are great circles, which bend towards the poles away from
+    the parallels of the box. The edges along parallels are cut in steps of
+    POLYGON_STEP degrees and the box is widened by POLYGON_MARGIN, so the
+    polygon holds all of it; match the exact box on lat and long as well.
+    """
+    south = max(-90.0, min_lat - POLYGON_MARGIN)
+    north = min(90.0, max_lat + POLYGON_MARGIN)
+    west = max(-180.0, min_long - POLYGON_MARGIN)
+    east = min(180.0, max_long + POLYGON_MARGIN)
+    steps = max(1, math.ceil((east - west) / POLYGON_STEP))
+    longs = [west + (east - west) * i / steps for i in range(steps + 1)]
+    ring: List[List[float]] = [[long, south] for long in longs]
+    ring += [[long, north] for long in reversed(longs)]
+    ring.append(ring[0])
+    return {"type": "Polygon", "coordinates": [ring]}
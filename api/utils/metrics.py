@@ -0,0 +1,232 @@
+"""Counters and histograms rendered in the Prometheus text format.
+
+Kept in-process and without locks: they are only touched from the event
+loop, and an observation is a couple of dict lookups and additions, cheap
+enough to leave on under load. Each worker process has its own values.
+"""
+import bisect
+import math
+import time
+from typing import Dict, List, Sequence, Tuple
+
+# Seconds, from a cached timezone lookup to a slow database round trip
+LATENCY_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", r"\\").replace("\n", r"\n").replace('"', r'\"')
+
+
+def _labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    type = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 registry: "Registry" = None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.children: Dict[Tuple[str, ...], object] = {}
+        if not self.labelnames:
+            self.children[()] = self._child()
+        (registry if registry is not None else REGISTRY).register(self)
+
+    def labels(self, *values: str):
+        """The child for these label values, bind it once on hot paths."""
+        child = self.children.get(values)
+        if child is None:
+            values = tuple(str(value) for value in values)
+            child = self.children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f"{self.name} takes labels {self.labelnames}")
+            child = self.children[values] = self._child()
+        return child
+
+    def _child(self):
+        raise NotImplementedError
+
+    def samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.documentation}",
+                f"# TYPE {self.name} {self.type}"] + self.samples()
+
+
+class _CounterChild:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def _child(self):
+        return _CounterChild()
+
+    def inc(self, amount: float = 1):
+        self.children[()].inc(amount)
+
+    def samples(self) -> List[str]:
+        return [f"{self.name}{_labels(self.labelnames, values)} {_number(child.value)}"
+                for values, child in self.children.items()]
+
+
+class _GaugeChild(_CounterChild):
+    __slots__ = ()
+
+    def set(self, value: float):
+        self.value = value
+
+
+class Gauge(Counter):
+    type = "gauge"
+
+    def _child(self):
+        return _GaugeChild()
+
+    def set(self, value: float):
+        self.children[()].set(value)
+
+
+class _Timer:
+    __slots__ = ("histogram", "started")
+
+    def __init__(self, histogram: "_HistogramChild"):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.histogram.observe(time.perf_counter() - self.started)
+
+
+class _HistogramChild:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def time(self) -> _Timer:
+        return _Timer(self)
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS, registry: "Registry" = None):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames, registry)
+
+    def _child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value: float):
+        self.children[()].observe(value)
+
+    def time(self) -> _Timer:
+        return self.children[()].time()
+
+    def samples(self) -> List[str]:
+        lines = []
+        for values, child in self.children.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), child.counts):
+                cumulative += count
+                le = 'le="' + _number(bound) + '"'
+                lines.append(f"{self.name}_bucket"
+                             f"{_labels(self.labelnames, values, le)} {cumulative}")
+            labels = _labels(self.labelnames, values)
+            lines.append(f"{self.name}_sum{labels} {_number(child.sum)}")
+            lines.append(f"{self.name}_count{labels} {child.count}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric):
+        if metric.name in self.metrics:
+            raise ValueError(f"{metric.name} is already registered")
+        self.metrics[metric.name] = metric
+
+    def render(self) -> str:
+        return "\n".join(line for metric in self.metrics.values()
+                         for line in metric.render()) + "\n"
+
+
+REGISTRY = Registry()
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+MESSAGE_SECONDS = Histogram(
+    "twosense_message_handle_seconds", "Time handling a message on the bus",
+    ["kind", "message"])
+MESSAGE_ERRORS = Counter(
+    "twosense_message_errors_total", "Messages whose handler raised",
+    ["kind", "message"])
+DEAD_LETTERS = Counter(
+    "twosense_dead_letters_total",
+    "Events and queued batches given up on after retrying them")
+REDIS_SECONDS = Histogram(
+    "twosense_redis_seconds", "Time per round trip to redis", ["operation"])
+REPOSITORY_SECONDS = Histogram(
+    "twosense_repository_seconds", "Time per repository call", ["operation"])
+TIMEZONE_SECONDS = Histogram(
+    "twosense_timezone_conversion_seconds",
+    "Time converting the timestamps of a request to UTC")
+RESAMPLE_SECONDS = Histogram(
+    "twosense_resample_seconds", "Time averaging flushed buffers into minutes")
+PUBLISH_SECONDS = Histogram(
+    "twosense_publish_seconds", "Time publishing an event")
+EVENTS_PUBLISHED = Counter(
+    "twosense_events_published_total", "Events sent to redis")
+EVENTS_DROPPED = Counter(
+    "twosense_events_dropped_total", "Events lost because sending them failed")
+POINTS = Counter(
+    "twosense_points_total",
+    "Points sent to the buffer, by outcome (accepted, duplicate, out_of_order)",
+    ["status"])
+MINUTES_FLUSHED = Counter(
+    "twosense_minutes_flushed_total", "Minutes written to the repository")
+TIMEZONE_CACHE = Gauge(
+    "twosense_timezone_cache", "TimezoneResolver.stats(), as of the scrape", ["stat"])
+USER_STATE_CACHE = Gauge(
+    "twosense_user_state_cache", "UserStateCache.stats(), as of the scrape", ["stat"])
+USER_ACTORS = Gauge(
+    "twosense_user_actors", "UserActors.stats(), as of the scrape", ["stat"])
+INGEST_QUEUE = Gauge(
+    "twosense_ingest_queue",
+    "Ingest queue batches per partition (length, pending, lag, oldest_seconds), "
+    "as of the scrape", ["partition", "stat"])
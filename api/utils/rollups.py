@@ -0,0 +1,121 @@
+import math
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from api.domain import models
+
+# Resolution names and their bucket length
+RESOLUTIONS = {
+    "5m": timedelta(minutes=5),
+    "1h": timedelta(hours=1),
+    "1d": timedelta(days=1),
+}
+
+EARTH_RADIUS_M = 6_371_008.8
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def bucket_of(timestamp: datetime, length: timedelta) -> datetime:
+    return timestamp - (timestamp - EPOCH) % length
+
+
+def haversine(lat1: float, long1: float, lat2: float, long2: float) -> float:
+    """Great circle distance in meters."""
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    a = (math.sin((phi2 - phi1) / 2) ** 2
+         + math.cos(phi1) * math.cos(phi2)
+         * math.sin(math.radians(long2 - long1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_M * math.asin(min(1.0, math.sqrt(a)))
+
+
+def _max(a: Optional[float], b: Optional[float]) -> Optional[float]:
+    if a is None or a != a:
+        return None if b != b else b
+    if b is None or b != b:
+        return a
+    return max(a, b)
+
+
+def merge(current: models.Rollup, other: models.Rollup) -> models.Rollup:
+    """Adds `other` to `current`, the way the repositories do it. The path
+    from the last point of `current` to the first of `other` counts towards
+    the distance when `other` starts after it."""
+    gap = 0.0
+    if other.first_timestamp > current.last_timestamp:
+        gap = haversine(current.last_lat, current.last_long,
+                        other.first_lat, other.first_long)
+    first = other if other.first_timestamp < current.first_timestamp else current
+    last = other if other.last_timestamp > current.last_timestamp else current
+    return models.Rollup(
+        user_id=current.user_id,
+        resolution=current.resolution,
+        bucket=current.bucket,
+        points=current.points + other.points,
+        sum_lat=current.sum_lat + other.sum_lat,
+        sum_long=current.sum_long + other.sum_long,
+        max_speed=_max(current.max_speed, other.max_speed),
+        distance=current.distance + other.distance + gap,
+        first_timestamp=first.first_timestamp,
+        first_lat=first.first_lat,
+        first_long=first.first_long,
+        last_timestamp=last.last_timestamp,
+        last_lat=last.last_lat,
+        last_long=last.last_long,
+    )
+
+
+class RollupAggregator:
+    """Rollups of every resolution from points or minutes fed in timestamp
+    order per user. Entries with `samples` count as that many points."""
+
+    def __init__(self):
+        self.rollups: Dict[Tuple[str, str, datetime], models.Rollup] = {}
+
+    def add(self, entry: dict):
+        user_id, timestamp = entry["user_id"], entry["timestamp"]
+        lat, long = entry["lat"], entry["long"]
+        samples = entry.get("samples", 1)
+        speed = _max(None, entry["speed"])
+        # Distance from the previous point, the same for every resolution
+        step, step_from = 0.0, None
+        for resolution, length in RESOLUTIONS.items():
+            bucket = bucket_of(timestamp, length)
+            key = (user_id, resolution, bucket)
+            rollup = self.rollups.get(key)
+            if rollup is None:
+                self.rollups[key] = models.Rollup(
+                    user_id=user_id, resolution=resolution, bucket=bucket,
+                    points=samples, sum_lat=lat * samples, sum_long=long * samples,
+                    max_speed=speed, distance=0.0,
+                    first_timestamp=timestamp, first_lat=lat, first_long=long,
+                    last_timestamp=timestamp, last_lat=lat, last_long=long)
+                continue
+            rollup.points += samples
+            rollup.sum_lat += lat * samples
+            rollup.sum_long += long * samples
+            rollup.max_speed = _max(rollup.max_speed, speed)
+            if timestamp > rollup.last_timestamp:
+                if step_from != rollup.last_timestamp:
+                    step = haversine(rollup.last_lat, rollup.last_long, lat, long)
+                    step_from = rollup.last_timestamp
+                rollup.distance += step
+                rollup.last_timestamp, rollup.last_lat, rollup.last_long = \
+                    timestamp, lat, long
+            elif timestamp < rollup.first_timestamp:
+                rollup.first_timestamp, rollup.first_lat, rollup.first_long = \
+                    timestamp, lat, long
+
+    def add_many(self, entries: Iterable[dict]):
+        for entry in entries:
+            self.add(entry)
+
+    def results(self) -> List[models.Rollup]:
+        return [self.rollups[key] for key in sorted(self.rollups)]
+
+
+def rollups_of(entries: Iterable[dict]) -> List[models.Rollup]:
+    aggregator = RollupAggregator()
+    aggregator.add_many(sorted(entries, key=lambda entry: (entry["user_id"],
+                                                           entry["timestamp"])))
+    return aggregator.results()
@@ -1,22 +1,154 @@
+import math
+from collections import OrderedDict
+from datetime import datetime, tzinfo
+from typing import Dict, Iterable, List, Optional, Tuple
+
 from timezonefinder import TimezoneFinder
 import pytz
 
-tf = TimezoneFinder()
+Cell = Tuple[int, int]
+
+# Cached for cells a timezone border goes through
+BORDER = object()
+
+
+def _is_naive(timestamp: datetime) -> bool:
+    return timestamp.tzinfo is None or timestamp.tzinfo.utcoffset(timestamp) is None
+
+
+def _to_utc(timestamp: datetime) -> datetime:
+    return timestamp.astimezone(pytz.UTC).replace(tzinfo=None)
+
+
+class TimezoneResolver:
+    """Converts device local timestamps to naive UTC.
+
+    Timezones are cached per cell of a lat/long grid with `precision` decimal
+    places (0.01 degrees is about a kilometre). A cell is only cached when its
+    four corners are in the same timezone as the point; points in cells a
+    border goes through are always looked up exactly. Each user's last cell
+    is remembered too, since users barely move between timezones.
+    """
+
+    def __init__(self, maxsize: int = 4096, precision: int = 2,
+                 user_maxsize: int = 100_000, finder: TimezoneFinder = None):
+        self.finder = finder or TimezoneFinder()
+        self.scale = 10 ** precision
+        self.maxsize = maxsize
+        self.user_maxsize = user_maxsize
+        self.cells: OrderedDict[Cell, tzinfo] = OrderedDict()
+        self.users: OrderedDict[str, Tuple[Cell, tzinfo]] = OrderedDict()
+        self.lookups = 0
+        self.user_hits = 0
+        self.hits = 0
+        self.misses = 0
+        self.border_lookups = 0
+
+    def cell_of(self, lat: float, long: float) -> Cell:
+        return math.floor(lat * self.scale), math.floor(long * self.scale)
+
+    def timezone_at(self, lat: float, long: float,
+                    user_id: Optional[str] = None) -> tzinfo:
+        self.lookups += 1
+        tz = self._cell_timezone(lat, long, self.cell_of(lat, long), user_id)
+        return self._exact(lat, long) if tz is BORDER else tz
+
+    def _cell_timezone(self, lat: float, long: float, cell: Cell,
+                       user_id: Optional[str] = None):
+        """The cached timezone of the cell, BORDER if points in it have to be
+        looked up exactly."""
+        if user_id is not None:
+            last = self.users.get(user_id)
+            if last is not None and last[0] == cell:
+                self.user_hits += 1
+                return last[1]
+
+        tz = self.cells.get(cell)
+        if tz is None:
+            self.misses += 1
+            tz = self._resolve(lat, long, cell)
+        else:
+            self.cells.move_to_end(cell)
+            if tz is not BORDER:
+                self.hits += 1
+        if tz is not BORDER and user_id is not None:
+            self._remember(user_id, cell, tz)
+        return tz
+
+    def _remember(self, user_id: str, cell: Cell, tz: tzinfo):
+        self.users[user_id] = (cell, tz)
+        self.users.move_to_end(user_id)
+        if len(self.users) > self.user_maxsize:
+            self.users.popitem(last=False)
+
+    def _exact(self, lat: float, long: float) -> tzinfo:
+        self.border_lookups += 1
+        return pytz.timezone(self.finder.timezone_at(lng=long, lat=lat))
+
+    def _resolve(self, lat: float, long: float, cell: Cell):
+        """Looks up and caches the timezone of a cell, BORDER if it has none."""
+        tz_str = self.finder.timezone_at(lng=long, lat=lat)
+        lat_min, long_min = cell[0] / self.scale, cell[1] / self.scale
+        lat_max, long_max = (cell[0] + 1) / self.scale, (cell[1] + 1) / self.scale
+        tz = pytz.timezone(tz_str)
+        for corner_lat, corner_long in ((lat_min, long_min), (lat_min, long_max),
+                                        (lat_max, long_min), (lat_max, long_max)):
+            if self.finder.timezone_at(lng=corner_long, lat=corner_lat) != tz_str:
+                tz = BORDER
+                break
+        self.cells[cell] = tz
+        if len(self.cells) > self.maxsize:
+            self.cells.popitem(last=False)
+        return tz
+
+    def convert(self, timestamp: datetime, lat: float, long: float,
+                user_id: Optional[str] = None) -> datetime:
+        if _is_naive(timestamp):
+            timestamp = self.timezone_at(lat, long, user_id).localize(timestamp)
+        return _to_utc(timestamp)
 
+    def convert_many(self, timestamps: Iterable[datetime], lats: Iterable[float],
+                     longs: Iterable[float],
+                     user_ids: Iterable[Optional[str]] = None) -> List[datetime]:
+        """Converts aligned sequences (lists or numpy arrays) of points at once.
 
-def convert_to_utc(timestamp, lat, long):
-    print("Converting to UTC, timestamp: ", timestamp)
-    print("coordinates: ", lat, long)
-    tz_str = tf.timezone_at(lng=long, lat=lat)
-    local_tz = pytz.timezone(tz_str)
+        Naive points are grouped by grid cell and each cell is looked up once,
+        counting as a single lookup in the stats; only the points of cells a
+        border goes through are looked up one by one.
+        """
+        timestamps = list(timestamps)
+        lats = [float(lat) for lat in lats]
+        longs = [float(long) for long in longs]
+        user_ids = [None] * len(timestamps) if user_ids is None else list(user_ids)
+        utc: List[Optional[datetime]] = [None] * len(timestamps)
+        cells: Dict[Cell, List[int]] = {}
+        for i, timestamp in enumerate(timestamps):
+            if _is_naive(timestamp):
+                cells.setdefault(self.cell_of(lats[i], longs[i]), []).append(i)
+            else:
+                utc[i] = _to_utc(timestamp)
 
-    if timestamp.tzinfo is None or timestamp.tzinfo.utcoffset(timestamp) is None:
-        local_time = local_tz.localize(timestamp)
-    else:
-        local_time = timestamp
+        for cell, points in cells.items():
+            first = points[0]
+            self.lookups += 1
+            tz = self._cell_timezone(lats[first], longs[first], cell, user_ids[first])
+            for i in points:
+                point_tz = self._exact(lats[i], longs[i]) if tz is BORDER else tz
+                utc[i] = _to_utc(point_tz.localize(timestamps[i]))
+            if tz is not BORDER:
+                for user_id in {user_ids[i] for i in points} - {None, user_ids[first]}:
+                    self._remember(user_id, cell, tz)
+        return utc
 
-    utc_time = local_time.astimezone(pytz.UTC)
-    print(utc_time)
-    print(utc_time.tzinfo)
-    utc_time = utc_time.replace(tzinfo=None)
-    return utc_time
+    def stats(self) -> dict:
+        lookups = self.lookups
+        return {
+            "lookups": lookups,
+            "user_hits": self.user_hits,
+            "cell_hits": self.hits,
+            "misses": self.misses,
+            "border_lookups": self.border_lookups,
+            "hit_rate": (self.user_hits + self.hits) / lookups if lookups else 0.0,
+            "cells": len(self.cells),
+            "users": len(self.users),
+        }
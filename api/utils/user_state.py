@@ -0,0 +1,100 @@
+import time
+from collections import OrderedDict
+from typing import Callable, Optional, Set
+
+# Same rule as APPEND_SCRIPT: a point this long after the oldest buffered one
+# closes the buffer
+MINUTE_US = 60_000_000
+
+
+class UserState:
+    __slots__ = ("newest", "oldest", "timestamps", "expires_at")
+
+    def __init__(self, timestamp: int, expires_at: float):
+        self.newest = timestamp
+        self.oldest = timestamp
+        self.timestamps: Set[int] = {timestamp}
+        self.expires_at = expires_at
+
+
+class UserStateCache:
+    """What a worker last saw of each user's buffer, to turn away duplicate
+    and out of order points without asking redis.
+
+    A user's newest accepted timestamp only grows, whichever worker appends,
+    so a point that isn't newer than the one this worker knows of is turned
+    away by redis too. Points that might be accepted always go to redis.
+    The buffered timestamps tell duplicates from out of order points; after
+    another worker closed the buffer, a point of the closed buffer is still
+    called a duplicate, where redis would say out of order.
+
+    Entries last `ttl` seconds. `epoch` is compared with a value kept in
+    redis, which changes when redis lost its data, to drop every entry.
+    """
+
+    def __init__(self, maxsize: int = 100_000, ttl: float = 60.0,
+                 clock: Callable[[], float] = time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self.users: OrderedDict[str, UserState] = OrderedDict()
+        self.epoch: Optional[str] = None
+        self.lookups = 0
+        self.duplicates = 0
+        self.out_of_order = 0
+        self.expired = 0
+        self.evicted = 0
+        self.resets = 0
+
+    def check(self, user_id: str, timestamp: int) -> Optional[str]:
+        """Returns "duplicate" or "out_of_order" when the point would be
+        turned away, None when it has to go to redis."""
+        self.lookups += 1
+        state = self.users.get(user_id)
+        if state is None:
+            return None
+        if state.expires_at <= self.clock():
+            del self.users[user_id]
+            self.expired += 1
+            return None
+        if timestamp > state.newest:
+            return None
+        if timestamp in state.timestamps:
+            self.duplicates += 1
+            return "duplicate"
+        self.out_of_order += 1
+        return "out_of_order"
+
+    def accepted(self, user_id: str, timestamp: int):
+        """Records a point redis accepted, closing the buffer like it did."""
+        state = self.users.get(user_id)
+        expires_at = self.clock() + self.ttl
+        if state is None or timestamp - state.oldest >= MINUTE_US:
+            self.users[user_id] = UserState(timestamp, expires_at)
+        else:
+            state.newest = max(state.newest, timestamp)
+            state.timestamps.add(timestamp)
+            state.expires_at = expires_at
+        self.users.move_to_end(user_id)
+        if len(self.users) > self.maxsize:
+            self.users.popitem(last=False)
+            self.evicted += 1
+
+    def check_epoch(self, epoch: str):
+        if self.epoch is not None and epoch != self.epoch:
+            self.users.clear()
+            self.resets += 1
+        self.epoch = epoch
+
+    def stats(self) -> dict:
+        hits = self.duplicates + self.out_of_order
+        return {
+            "lookups": self.lookups,
+            "duplicates": self.duplicates,
+            "out_of_order": self.out_of_order,
+            "hit_rate": hits / self.lookups if self.lookups else 0.0,
+            "users": len(self.users),
+            "expired": self.expired,
+            "evicted": self.evicted,
+            "resets": self.resets,
+        }
@@ -0,0 +1,91 @@
+import math
+from datetime import datetime, timezone
+from typing import AsyncIterator, List, Optional
+
+from api.domain import models
+from api.service_layer import unit_of_work
+
+
+def as_utc(timestamp: Optional[datetime]) -> Optional[datetime]:
+    # Locations are stored as naive UTC
+    if timestamp is None or timestamp.tzinfo is None:
+        return timestamp
+    return timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+
+
+def mean_or_none(mean: Optional[float]) -> Optional[float]:
+    # Minutes without any value stored before the means were NULL hold NaN,
+    # which isn't JSON
+    return None if mean is None or math.isnan(mean) else mean
+
+
+def location_view(location: models.Location) -> dict:
+    return {
+        "timestamp": location.timestamp.isoformat(),
+        "lat": location.lat,
+        "long": location.long,
+        "accuracy": mean_or_none(location.accuracy),
+        "speed": mean_or_none(location.speed),
+        "samples": location.samples,
+    }
+
+
+async def user_locations(user_id: str, uow: unit_of_work.AbstractUnitOfWork,
+                         start: Optional[datetime] = None,
+                         end: Optional[datetime] = None,
+                         cursor: Optional[datetime] = None,
+                         limit: Optional[int] = None) -> AsyncIterator[dict]:
+    """The stored minutes of a user, oldest first. `cursor` is the timestamp
+    of the last minute of the previous page."""
+    async with uow.read_only():
+        async for location in uow.locations.get_range(
+                user_id, as_utc(start), as_utc(end), as_utc(cursor), limit):
+            yield location_view(location)
+
+
+async def locations_in_bbox(uow: unit_of_work.AbstractUnitOfWork,
+                            min_lat: float, min_long: float, max_lat: float,
+                            max_long: float, start: Optional[datetime] = None,
+                            end: Optional[datetime] = None,
+                            limit: Optional[int] = None) -> List[dict]:
+    """The stored minutes of every user within the box, oldest first."""
+    async with uow.read_only():
+        locations = await uow.locations.get_in_bbox(
+            min_lat, min_long, max_lat, max_long, as_utc(start), as_utc(end), limit)
+    return [dict(location_view(location), user_id=location.user_id)
+            for location in locations]
+
+
+async def users_near(uow: unit_of_work.AbstractUnitOfWork, lat: float, long: float,
+                     radius: float, since: Optional[datetime] = None,
+                     limit: Optional[int] = None) -> List[dict]:
+    """The last minute of the users last seen near the point, nearest first."""
+    async with uow.read_only():
+        near = await uow.locations.get_users_near(lat, long, radius, as_utc(since),
+                                                  limit)
+    return [dict(location_view(location), user_id=location.user_id, distance=distance)
+            for location, distance in near]
+
+
+def rollup_view(rollup: models.Rollup) -> dict:
+    return {
+        "bucket": rollup.bucket.isoformat(),
+        "points": rollup.points,
+        "lat": rollup.lat,
+        "long": rollup.long,
+        "max_speed": rollup.max_speed,
+        "distance": rollup.distance,
+        "first_timestamp": rollup.first_timestamp.isoformat(),
+        "last_timestamp": rollup.last_timestamp.isoformat(),
+    }
+
+
+async def user_rollups(user_id: str, resolution: str,
+                       uow: unit_of_work.AbstractUnitOfWork,
+                       start: Optional[datetime] = None,
+                       end: Optional[datetime] = None) -> List[dict]:
+    """The rollups of a user at `resolution`, oldest bucket first."""
+    async with uow.read_only():
+        rollups = await uow.locations.get_rollups(user_id, resolution,
+                                                  as_utc(start), as_utc(end))
+    return [rollup_view(rollup) for rollup in rollups]
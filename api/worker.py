@@ -0,0 +1,88 @@
+"""Stores the points queued with INGEST_MODE=stream.
+
+    python -m api.worker [--processes 2] [--tasks 4]
+
+The INGEST_PARTITIONS partitions are shared out between processes * tasks
+workers, each reading its own partitions. Run a single command per
+deployment, two of them would read the same partitions.
+
+Closed minutes are queued whatever FLUSH_MODE is, and written by a flusher
+in each process, or by `python -m api.flusher` with FLUSH_MODE=external.
+"""
+import argparse
+import asyncio
+import multiprocessing
+from typing import List
+
+from api import bootstrap, config
+from api.adapters import redis_eventpublisher
+from api.service_layer import unit_of_work
+from api.service_layer.ingest_worker import IngestWorker, partitions_of
+from api.utils.user_state import UserStateCache
+
+
+async def run(slots: List[int], workers: int):
+    publisher = redis_eventpublisher.create_publisher()
+    # A user's points all go to one worker, which keeps its state cached
+    user_state_config = config.get_user_state_cache_config()
+    user_state = UserStateCache(**user_state_config) if user_state_config["maxsize"] else None
+    # Always write-behind: an inline flush that failed after the buffer was
+    # closed would lose the minute, its points being turned away when the
+    # batch is read again
+    buffer = bootstrap.default_buffer(user_state, write_behind=True)
+    bus = bootstrap.bootstrap(publish=publisher, buffer=buffer)
+    queue = bootstrap.default_ingest_queue()
+    dead_letters = bootstrap.default_ingest_dead_letters()
+    await bus.uow.connect()
+    await queue.create_groups()
+    worker_config = config.get_ingest_worker_config()
+    tasks = [asyncio.create_task(IngestWorker(
+        bus, queue, partitions_of(slot, workers, queue.partitions),
+        f"worker-{slot}", dead_letters=dead_letters, **worker_config).run())
+        for slot in slots]
+    # Unless `python -m api.flusher` writes the closed minutes
+    flusher = None
+    if config.get_flush_mode() != "external":
+        flusher = bootstrap.bootstrap_flusher(buffer=buffer, publish=publisher)
+        tasks.append(asyncio.create_task(flusher.run()))
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        try:
+            if flusher is not None:
+                await flusher.drain()
+        finally:
+            await publisher.close()
+            await unit_of_work.dispose()
+
+
+def run_process(slots: List[int], workers: int):
+    bootstrap.configure_logging()
+    asyncio.run(run(slots, workers))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--processes", type=int, default=1)
+    parser.add_argument("--tasks", type=int, default=1,
+                        help="Workers per process, as asyncio tasks")
+    args = parser.parse_args()
+    workers = args.processes * args.tasks
+    partitions = config.get_ingest_queue_config()["partitions"]
+    if workers > partitions:
+        parser.error(f"{workers} workers for {partitions} partitions")
+    slots = [list(range(i * args.tasks, (i + 1) * args.tasks))
+             for i in range(args.processes)]
+    if args.processes == 1:
+        run_process(slots[0], workers)
+        return
+    processes = [multiprocessing.Process(target=run_process, args=(process_slots, workers))
+                 for process_slots in slots]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""Compare the minute aggregator with the pandas resample it replaced.
+
+Replays simulation/data/*.csv as the buffers put_location flushes (points
+until one is a minute or more after the first) and times both ways of
+averaging them.
+
+    python -m benchmarks.aggregation
+"""
+import argparse
+import timeit
+from pathlib import Path
+
+import pandas as pd
+
+from api.utils.aggregation import MinuteAggregator
+from api.utils.data_resampling import mean_df_resample
+
+DATA_DIR = Path(__file__).parent.parent / 'simulation' / 'data'
+
+
+def read_buffers():
+    buffers = []
+    for file in sorted(DATA_DIR.glob('*.csv')):
+        data = pd.read_csv(file, parse_dates=['timestamp'])
+        buffer = []
+        for entry in data.to_dict('records'):
+            entry['timestamp'] = entry['timestamp'].to_pydatetime()
+            if buffer and (entry['timestamp'] - buffer[0]['timestamp']).total_seconds() >= 60:
+                buffers.append(buffer)
+                buffer = []
+            buffer.append(entry)
+        if buffer:
+            buffers.append(buffer)
+    return buffers
+
+
+def pandas_means(buffer):
+    # What put_location used to do per flush
+    df_resampled = mean_df_resample(pd.DataFrame(buffer))
+    return [(timestamp, row["lat"], row["long"], row["accuracy"], row["speed"])
+            for timestamp, row in df_resampled.iterrows()]
+
+
+def aggregator_means(buffer):
+    aggregator = MinuteAggregator()
+    aggregator.add_many(buffer)
+    return [(row["timestamp"], row["lat"], row["long"], row["accuracy"], row["speed"])
+            for row in aggregator.results()]
+
+
+def main(repeat):
+    buffers = read_buffers()
+    mismatches = sum(pandas_means(buffer) != aggregator_means(buffer)
+                     for buffer in buffers)
+    print(f"{len(buffers)} buffers, {sum(map(len, buffers))} points, "
+          f"{mismatches} mismatches")
+    for name, means in (("pandas", pandas_means), ("aggregator", aggregator_means)):
+        elapsed = min(timeit.repeat(lambda: [means(buffer) for buffer in buffers],
+                                    number=1, repeat=repeat))
+        print(f"{name:>10}: {elapsed:.3f}s total, "
+              f"{elapsed / len(buffers) * 1e6:.1f}us per flush")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=3)
+    main(parser.parse_args().repeat)
@@ -0,0 +1,128 @@
+"""Time per bounding box and nearby users query of SqlAlchemyRepository,
+on the bare lat and long columns and then on the GEO_INDEX position column.
+
+Needs postgres with PostGIS, the locations table is dropped and filled with
+`--users * --minutes` synthetic minutes around New York:
+
+    python -m benchmarks.geo_queries --uri postgresql+asyncpg://... --users 10000 --minutes 300
+"""
+import argparse
+import asyncio
+import random
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import exists, text
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy.future import select
+
+from api.adapters import orm, repository
+from api.domain import models
+from api.utils import geo
+
+START = datetime(2017, 7, 30)
+
+# Users stay within about 500 m of a home point somewhere in the area
+FILL = f"""
+INSERT INTO {orm.location.name} (timestamp, id, lat, long, accuracy, speed, user_id, samples)
+SELECT CAST(:start AS timestamp) + m * INTERVAL '1 minute', 'u' || home.u || '-' || m,
+       home.lat + (random() - 0.5) * 0.01, home.long + (random() - 0.5) * 0.01,
+       10.0, 0.0, 'u' || home.u, 1
+FROM (SELECT u, 40.5 + random() * 0.4 AS lat, -74.2 + random() * 0.5 AS long
+      FROM generate_series(0, CAST(:users AS integer) - 1) AS u) AS home,
+     generate_series(0, CAST(:minutes AS integer) - 1) AS m
+"""
+
+
+async def scan_in_bbox(session, min_lat, min_long, max_lat, max_long, start, end, limit):
+    # What finding the minutes in a box takes without the position column
+    table = orm.location
+    result = await session.execute(
+        select(table).where(table.c.lat.between(min_lat, max_lat),
+                            table.c.long.between(min_long, max_long),
+                            table.c.timestamp >= start, table.c.timestamp < end)
+        .order_by(table.c.timestamp, table.c.user_id).limit(limit))
+    return [models.Location(**dict(row._mapping)) for row in result]
+
+
+async def scan_users_near(session, lat, long, radius, limit):
+    table = orm.location
+    newer = table.alias("newer")
+    dlat, dlong = geo.degrees_around(lat, radius)
+    result = await session.execute(
+        select(table).where(table.c.lat.between(lat - dlat, lat + dlat),
+                            table.c.long.between(long - dlong, long + dlong),
+                            ~exists().where(newer.c.user_id == table.c.user_id,
+                                            newer.c.timestamp > table.c.timestamp)))
+    return repository.nearest([models.Location(**dict(row._mapping)) for row in result],
+                              lat, long, radius, limit=limit)
+
+
+async def timed(session_factory, queries, run):
+    rows = 0
+    started = time.perf_counter()
+    for query in queries:
+        async with session_factory() as session:
+            rows += len(await run(session, *query))
+    elapsed = time.perf_counter() - started
+    return f"{elapsed / len(queries) * 1e3:.1f}ms per query, {rows / len(queries):.0f} rows"
+
+
+async def main(uri, users, minutes, queries, box, radius):
+    orm.start_mappers()
+    engine = create_async_engine(uri)
+    async with engine.begin() as connection:
+        await connection.run_sync(orm.metadata.drop_all)
+        await connection.run_sync(orm.metadata.create_all)
+        await connection.execute(text(FILL), {"start": START, "users": users,
+                                              "minutes": minutes})
+        await connection.exec_driver_sql(f"ANALYZE {orm.location.name}")
+
+    rng = random.Random(0)
+    boxes = []
+    for _ in range(queries):
+        lat, long = 40.5 + rng.random() * 0.4, -74.2 + rng.random() * 0.5
+        start = START + timedelta(minutes=rng.randrange(max(1, minutes - 60)))
+        boxes.append((lat, long, lat + box, long + box, start,
+                      start + timedelta(hours=1), 1000))
+    points = [(40.5 + rng.random() * 0.4, -74.2 + rng.random() * 0.5, radius, 100)
+              for _ in range(queries)]
+
+    session_factory = async_sessionmaker(engine, expire_on_commit=False,
+                                         class_=AsyncSession)
+    print(f"{users * minutes} rows, {queries} queries of each, "
+          f"{box} degree boxes over an hour, {radius:.0f}m radius")
+    print(f"  bbox scan: {await timed(session_factory, boxes, scan_in_bbox)}")
+    print(f"  near scan: {await timed(session_factory, points, scan_users_near)}")
+
+    started = time.perf_counter()
+    async with engine.begin() as connection:
+        for statement in orm.position_statements():
+            await connection.exec_driver_sql(statement)
+        await connection.exec_driver_sql(f"ANALYZE {orm.location.name}")
+    print(f"position column and index: {time.perf_counter() - started:.1f}s")
+
+    async def in_bbox(session, *query):
+        return await repository.SqlAlchemyRepository(session).get_in_bbox(*query)
+
+    async def users_near(session, lat, long, radius, limit):
+        return await repository.SqlAlchemyRepository(session).get_users_near(
+            lat, long, radius, limit=limit)
+
+    print(f" bbox index: {await timed(session_factory, boxes, in_bbox)}")
+    print(f" near index: {await timed(session_factory, points, users_near)}")
+    await engine.dispose()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--uri', required=True, help="postgres with PostGIS")
+    parser.add_argument('--users', type=int, default=10_000)
+    parser.add_argument('--minutes', type=int, default=300)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--box', type=float, default=0.01,
+                        help="Side of the boxes in degrees")
+    parser.add_argument('--radius', type=float, default=500.0, help="In meters")
+    args = parser.parse_args()
+    asyncio.run(main(args.uri, args.users, args.minutes, args.queries, args.box,
+                     args.radius))
@@ -0,0 +1,188 @@
+"""Per-stage cost of the ingest pipeline, checked against a stored baseline.
+
+Replays simulation/data/*.csv as PutLocation commands through
+MessageBus.handle, with the in-memory fakes of tests.fakes standing in
+for the database, redis and the event publisher. Every stage is then timed
+on its own with the same points:
+
+      tz  TimezoneResolver.convert, cold cache
+  buffer  appends, with the floor reads of empty buffers
+resample  averaging the flushed buffers into minutes
+  rollup  summing the flushed buffers into rollups and upsert_rollups
+    repo  upsert_many of the minutes and the commit
+ publish  LocationAdded events, encoded like the redis publisher does
+   total  MessageBus.handle end to end
+
+Times are microseconds per point, the best of --repeat runs.
+
+    python -m benchmarks.ingest            # print the timings
+    python -m benchmarks.ingest --check    # exit 1 if a stage got slower
+    python -m benchmarks.ingest --save     # store the timings as the baseline
+
+Baselines depend on the machine, save one before comparing branches.
+"""
+import argparse
+import asyncio
+import json
+import platform
+import sys
+import time
+from pathlib import Path
+
+import pandas as pd
+from timezonefinder import TimezoneFinder
+
+from api import bootstrap
+from api.domain import commands
+from api.service_layer import handlers
+from api.utils.rollups import rollups_of
+from api.utils.timezone import TimezoneResolver
+from tests.fakes import (FakeBuffer, FakeDeadLetters, FakeNotifications,
+                         FakePublisher, FakeUnitOfWork)
+
+DATA_DIR = Path(__file__).parent.parent / 'simulation' / 'data'
+BASELINE = Path(__file__).parent / 'baselines' / 'ingest.json'
+STAGES = ("tz", "buffer", "resample", "rollup", "repo", "publish", "total")
+
+
+def read_commands():
+    data = pd.concat([pd.read_csv(file, parse_dates=['timestamp'])
+                      for file in sorted(DATA_DIR.glob('*.csv'))])
+    data = data.sort_values(by='timestamp', kind='stable')
+    return [commands.PutLocation(row.timestamp.to_pydatetime(), row.lat, row.long,
+                                 row.accuracy, row.speed, row.user_id)
+            for row in data.itertuples()]
+
+
+def stored_rows(uow: FakeUnitOfWork):
+    return sorted((i.user_id, i.timestamp, i.lat, i.long, i.accuracy, i.speed, i.samples)
+                  for i in uow.rows.values()), sorted(uow.rollups.items())
+
+
+async def run_stages(cmds, finder):
+    """Runs the stages one after the other, returning their times and the
+    unit of work holding what was stored."""
+    times = {}
+    uow, buffer, publish = FakeUnitOfWork(), FakeBuffer(), FakePublisher()
+
+    timezones = TimezoneResolver(finder=finder)
+    started = time.perf_counter()
+    utc_times = [timezones.convert(cmd.timestamp, cmd.lat, cmd.long, cmd.user_id)
+                 for cmd in cmds]
+    times["tz"] = time.perf_counter() - started
+
+    entries = [handlers.buffer_entry(cmd, utc_time)
+               for cmd, utc_time in zip(cmds, utc_times)]
+    started = time.perf_counter()
+    flushed = []
+    for entry in entries:
+        async with uow:
+            [(_, buffered)] = await handlers.append_to_buffer([entry], uow, buffer)
+        if buffered:
+            flushed.append(buffered)
+    times["buffer"] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    minutes = [handlers.aggregate_buffer(buffered) for buffered in flushed]
+    times["resample"] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    for buffered in flushed:
+        async with uow:
+            await uow.locations.upsert_rollups(rollups_of(buffered))
+    times["rollup"] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    stored = []
+    for locations in minutes:
+        async with uow:
+            stored.append(await uow.locations.upsert_many(locations))
+            await uow.commit()
+    times["repo"] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    for locations in stored:
+        await handlers.publish_locations_added(locations, publish)
+    times["publish"] = time.perf_counter() - started
+    return times, uow
+
+
+async def run_bus(cmds, finder):
+    uow = FakeUnitOfWork()
+    bus = bootstrap.bootstrap(start_orm=False, uow=uow, buffer=FakeBuffer(),
+                              publish=FakePublisher(),
+                              notifications=FakeNotifications(),
+                              dead_letters=FakeDeadLetters(),
+                              timezones=TimezoneResolver(finder=finder))
+    started = time.perf_counter()
+    for cmd in cmds:
+        await bus.handle(cmd)
+    return time.perf_counter() - started, uow
+
+
+async def measure(cmds, repeat):
+    finder = TimezoneFinder()
+    best = {}
+    for _ in range(repeat):
+        times, stages_uow = await run_stages(cmds, finder)
+        times["total"], bus_uow = await run_bus(cmds, finder)
+        if stored_rows(stages_uow) != stored_rows(bus_uow):
+            raise AssertionError("The stages stored something else than the bus")
+        for stage, elapsed in times.items():
+            best[stage] = min(best.get(stage, elapsed), elapsed)
+    return {stage: best[stage] / len(cmds) * 1e6 for stage in STAGES}, len(bus_uow.rows)
+
+
+def compare(timings, baseline, tolerance):
+    """Prints the timings next to the baseline, returning the regressed stages."""
+    regressions = []
+    for stage in STAGES:
+        line = f"{stage:>8}: {timings[stage]:8.2f}us per point"
+        if stage in baseline:
+            change = timings[stage] / baseline[stage] - 1
+            line += f"   baseline {baseline[stage]:8.2f}us  {change:+7.1%}"
+            if change > tolerance:
+                line += "  REGRESSION"
+                regressions.append(stage)
+        print(line)
+    return regressions
+
+
+def main(repeat, check, save, tolerance):
+    cmds = read_commands()
+    timings, minutes = asyncio.run(measure(cmds, repeat))
+    baseline = json.loads(BASELINE.read_text()) if BASELINE.exists() else {}
+    if baseline and baseline["points"] != len(cmds):
+        print(f"The baseline was taken with {baseline['points']} points, "
+              f"not {len(cmds)}, save a new one", file=sys.stderr)
+        sys.exit(2)
+
+    print(f"{len(cmds)} points into {minutes} minutes")
+    regressions = compare(timings, baseline.get("us_per_point", {}), tolerance)
+
+    if save:
+        BASELINE.parent.mkdir(exist_ok=True)
+        BASELINE.write_text(json.dumps({
+            "points": len(cmds),
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "us_per_point": {stage: round(timings[stage], 2) for stage in STAGES},
+        }, indent=2) + "\n")
+        print(f"Saved the baseline to {BASELINE}")
+    elif check and regressions:
+        print(f"{', '.join(regressions)} more than {tolerance:.0%} slower than "
+              f"the baseline", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--check', action='store_true',
+                        help="exit 1 if a stage is slower than the baseline")
+    parser.add_argument('--save', action='store_true',
+                        help="store the timings as the new baseline")
+    parser.add_argument('--tolerance', type=float, default=0.3,
+                        help="slowdown allowed by --check, 0.3 is 30%%")
+    args = parser.parse_args()
+    main(args.repeat, args.check, args.save, args.tolerance)
@@ -0,0 +1,93 @@
+"""Queries and time per read of SqlAlchemyRepository, before and after
+dropping the ORM select + refresh + expunge read path.
+
+Runs against an in-memory SQLite database by default (needs `aiosqlite`),
+or against postgres with --uri.
+
+    python -m benchmarks.repository_reads
+    python -m benchmarks.repository_reads --uri postgresql+asyncpg://...
+"""
+import argparse
+import asyncio
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import event, insert
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy.future import select
+from sqlalchemy.orm import joinedload
+
+from api.adapters import orm, repository
+from api.domain import models
+
+START = datetime(2017, 7, 30)
+
+
+async def legacy_select_one(session, stmt):
+    # What every SqlAlchemyRepository getter used to do
+    result = await session.execute(stmt.options(joinedload('*')))
+    location = result.scalars().one_or_none()
+    if location:
+        await session.refresh(location)
+        session.expunge(location)
+    return location
+
+
+async def legacy_reads(session, user_id, timestamp):
+    await legacy_select_one(session, select(models.Location)
+                            .filter_by(user_id=user_id)
+                            .order_by(models.Location.timestamp.desc())
+                            .limit(1))
+    await legacy_select_one(session, select(models.Location)
+                            .filter_by(user_id=user_id, timestamp=timestamp))
+
+
+async def repository_reads(session, user_id, timestamp):
+    locations = repository.SqlAlchemyRepository(session)
+    await locations.get_last_location_for_user(user_id)
+    await locations.get_location_by_timestamp(user_id, timestamp)
+
+
+async def main(uri, users, minutes, requests):
+    orm.start_mappers()
+    engine = create_async_engine(uri)
+    queries = 0
+
+    def count(*_):
+        nonlocal queries
+        queries += 1
+    event.listen(engine.sync_engine, "before_cursor_execute", count)
+
+    async with engine.begin() as connection:
+        await connection.run_sync(orm.metadata.drop_all)
+        await connection.run_sync(orm.metadata.create_all)
+        await connection.execute(insert(orm.location), [
+            {"id": f"{user}-{minute}", "timestamp": START + timedelta(minutes=minute),
+             "lat": 40.7, "long": -73.9, "accuracy": 10.0, "speed": 0.0,
+             "user_id": f"u{user}", "samples": 1}
+            for user in range(users) for minute in range(minutes)])
+
+    session_factory = async_sessionmaker(engine, expire_on_commit=False,
+                                         class_=AsyncSession)
+    print(f"{users * minutes} rows, {requests} requests of two reads each")
+    for name, reads in (("before", legacy_reads), ("after", repository_reads)):
+        queries = 0
+        started = time.perf_counter()
+        for i in range(requests):
+            async with session_factory() as session:
+                await reads(session, f"u{i % users}",
+                            START + timedelta(minutes=i % minutes))
+        elapsed = time.perf_counter() - started
+        print(f"{name:>6}: {queries / requests:.1f} queries per request, "
+              f"{elapsed / requests * 1e6:.0f}us per request")
+    await engine.dispose()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--uri', default='sqlite+aiosqlite://')
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--minutes', type=int, default=500)
+    parser.add_argument('--requests', type=int, default=2000)
+    args = parser.parse_args()
+    asyncio.run(main(args.uri, args.users, args.minutes, args.requests))
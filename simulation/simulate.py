@@ -1,45 +1,173 @@
-"""Simulate sending location data to the API."""
+"""Load test the API with the recorded location data.
+
+Every user in `data` is replayed as `--users` users (ids suffixed with
+-0, -1, ...), each sending its points in timestamp order. All users send
+at once, with at most `--concurrency` requests in flight and at most `--rps`
+requests per second. With `--batch-size` points go in batches to
+PUT /locations instead of one by one to PUT /location.
+
+    API_HOST=http://localhost:5000 python -m simulation.simulate \\
+        --users 50 --concurrency 100 --rps 500 --output run.json
+
+The report is printed as JSON so runs can be compared.
+"""
+import argparse
+import asyncio
+import json
+import math
 import os
+import sys
+import time
+from collections import Counter
 from pathlib import Path
+from typing import Dict, List, Optional
 
+import httpx
 import pandas as pd
-import requests
-from pandas import Series, DataFrame
-from datetime import datetime
 
 DATA_DIR = Path(__file__).parent / 'data'
 
-API_HOST = os.environ.get('API_HOST')
-assert API_HOST, "API_HOST is not set"
 
+def read_user_data() -> Dict[str, List[dict]]:
+    """Returns the points of every user in the data files, in timestamp order."""
+    data = pd.concat([pd.read_csv(file) for file in sorted(DATA_DIR.glob('*.csv'))])
+    data = data.sort_values(by='timestamp', kind='stable')
+    return {user_id: rows.to_dict('records')
+            for user_id, rows in data.groupby('user_id', sort=True)}
+
+
+def fan_out(users: Dict[str, List[dict]], copies: int,
+            limit: Optional[int] = None) -> Dict[str, List[dict]]:
+    """Makes `copies` users out of each user, with at most `limit` points each."""
+    return {f"{user_id}-{copy}": [dict(row, user_id=f"{user_id}-{copy}")
+                                  for row in rows[:limit]]
+            for user_id, rows in users.items() for copy in range(copies)}
+
+
+def percentile(ordered: List[float], percent: float) -> float:
+    """Nearest-rank percentile of sorted values."""
+    if not ordered:
+        return 0.0
+    return ordered[max(math.ceil(percent / 100 * len(ordered)) - 1, 0)]
 
-def main():
-    """Run the simulation."""
-    location_data = read_user_data()
-    # Take elapsed time
-    start_time = datetime.now()
-    print("Sending location data to API...")
-    for _, row in location_data.iterrows():
-        send_to_api(row)
-    end_time = datetime.now()
 
-    print("DONE!")
-    print("Elapsed time: ", end_time - start_time)
+class RateLimiter:
+    """Spaces calls to `wait` evenly so they don't go over `rps` per second."""
 
+    def __init__(self, rps: float):
+        self.interval = 1 / rps if rps else 0.0
+        self.next_at = time.perf_counter()
 
-def read_user_data() -> DataFrame:
-    print("Reading user data...")
-    user_dataframes = []
-    for file in DATA_DIR.glob('*.csv'):
-        user_dataframes.append(pd.read_csv(file))
-    data = pd.concat(user_dataframes)
+    async def wait(self):
+        if not self.interval:
+            return
+        now = time.perf_counter()
+        at = max(self.next_at, now)
+        self.next_at = at + self.interval
+        if at > now:
+            await asyncio.sleep(at - now)
 
-    return data.sort_values(by='timestamp')
 
+class LoadTest:
+    def __init__(self, host: str, concurrency: int, rps: float, batch_size: int):
+        self.host = host
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.slots = asyncio.Semaphore(concurrency)
+        self.limiter = RateLimiter(rps)
+        self.latencies: List[float] = []
+        self.points = 0
+        self.rejected = 0
+        self.errors: Counter = Counter()
+
+    async def send(self, client: httpx.AsyncClient, rows: List[dict]):
+        await self.limiter.wait()
+        async with self.slots:
+            started = time.perf_counter()
+            try:
+                if self.batch_size:
+                    response = await client.put("/locations", json=rows)
+                else:
+                    response = await client.put("/location", json=rows[0])
+            except httpx.HTTPError as e:
+                self.errors[type(e).__name__] += 1
+                return
+            finally:
+                self.latencies.append(time.perf_counter() - started)
+        if response.status_code != 200:
+            self.errors[str(response.status_code)] += 1
+            return
+        self.points += len(rows)
+        if self.batch_size:
+            self.rejected += response.json()["rejected"]
+
+    async def replay(self, client: httpx.AsyncClient, rows: List[dict]):
+        # A user's requests go one after the other, like a device would send them
+        step = self.batch_size or 1
+        for i in range(0, len(rows), step):
+            await self.send(client, rows[i:i + step])
+
+    async def run(self, users: Dict[str, List[dict]]) -> dict:
+        limits = httpx.Limits(max_connections=self.concurrency,
+                              max_keepalive_connections=self.concurrency)
+        async with httpx.AsyncClient(base_url=self.host, limits=limits,
+                                     timeout=30) as client:
+            started = time.perf_counter()
+            await asyncio.gather(*[self.replay(client, rows) for rows in users.values()])
+            elapsed = time.perf_counter() - started
+        return self.report(elapsed)
+
+    def report(self, elapsed: float) -> dict:
+        latencies = sorted(self.latencies)
+        return {
+            "requests": len(latencies),
+            "points": self.points,
+            "rejected_points": self.rejected,
+            "errors": sum(self.errors.values()),
+            "errors_by_kind": dict(self.errors),
+            "elapsed_s": round(elapsed, 3),
+            "requests_per_s": round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+            "points_per_s": round(self.points / elapsed, 1) if elapsed else 0.0,
+            "latency_ms": {
+                "mean": round(sum(latencies) / len(latencies) * 1000, 2) if latencies else 0.0,
+                "p50": round(percentile(latencies, 50) * 1000, 2),
+                "p95": round(percentile(latencies, 95) * 1000, 2),
+                "p99": round(percentile(latencies, 99) * 1000, 2),
+                "max": round(latencies[-1] * 1000, 2) if latencies else 0.0,
+            },
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default=os.environ.get('API_HOST'),
+                        help="API url, defaults to $API_HOST")
+    parser.add_argument('--users', type=int, default=1,
+                        help="copies of each recorded user")
+    parser.add_argument('--concurrency', type=int, default=10,
+                        help="requests in flight at most")
+    parser.add_argument('--rps', type=float, default=0,
+                        help="requests per second at most, 0 for no limit")
+    parser.add_argument('--batch-size', type=int, default=0,
+                        help="points per PUT /locations, 0 to PUT /location")
+    parser.add_argument('--limit', type=int, default=None,
+                        help="points per user at most")
+    parser.add_argument('--output', type=Path, help="also write the report here")
+    args = parser.parse_args()
+    if not args.host:
+        parser.error("--host or API_HOST is required")
 
-def send_to_api(row: Series):
-    response = requests.put(F"{API_HOST}/location", json=row.to_dict())
-    assert response.status_code == 200, response.text
+    users = fan_out(read_user_data(), args.users, args.limit)
+    print(f"Sending {sum(map(len, users.values()))} points of {len(users)} users "
+          f"to {args.host}...", file=sys.stderr)
+    load_test = LoadTest(args.host, args.concurrency, args.rps, args.batch_size)
+    report = asyncio.run(load_test.run(users))
+    report["config"] = {key: value for key, value in vars(args).items()
+                        if key not in ('output',)}
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.output:
+        args.output.write_text(output + "\n")
 
 
 if __name__ == '__main__':
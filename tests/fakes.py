@@ -0,0 +1,276 @@
+"""In-memory stand-ins for the database, redis, the event publisher,
+notifications, dead letters and the ingest queue, so the ingest pipeline can
+run in-process, and a unit of work whose first transactions fail."""
+import itertools
+import time
+from collections import deque
+from dataclasses import replace
+from datetime import datetime
+from typing import Deque, Dict, List, Optional, Tuple
+
+from api.adapters import redis_eventpublisher
+# The Python version of the buffer ships with the API, for the importer
+from api.adapters.buffer import MemoryBuffer as FakeBuffer  # noqa: F401
+from api.adapters.dead_letters import AbstractDeadLetters, DeadLetter
+from api.adapters.ingest_queue import AbstractIngestQueue, QueuedBatch
+from api.adapters.notifications import AbstractNotifications
+from api.adapters.repository import MEAN_FIELDS, AbstractRepository, nearest
+from api.domain import commands, models
+from api.utils.aggregation import weighted_mean
+from api.service_layer.unit_of_work import AbstractUnitOfWork
+from api.utils.geo import in_bbox
+from api.utils.rollups import merge
+
+Key = Tuple[str, datetime]
+RollupKey = Tuple[str, str, datetime]
+
+
+class FakeRepository(AbstractRepository):
+    """Locations kept in dicts shared by every repository of a FakeUnitOfWork."""
+
+    def __init__(self, rows: Dict[Key, models.Location],
+                 last: Dict[str, models.Location],
+                 rollups: Dict[RollupKey, models.Rollup] = None):
+        super().__init__()
+        self.rows = rows
+        self.last = last
+        self.rollups = {} if rollups is None else rollups
+
+    def _store(self, location: models.Location):
+        self.rows[(location.user_id, location.timestamp)] = location
+        last = self.last.get(location.user_id)
+        if last is None or last.timestamp <= location.timestamp:
+            self.last[location.user_id] = location
+
+    async def _add(self, location: models.Location):
+        self._store(location)
+
+    async def _upsert(self, location: models.Location) -> models.Location:
+        current = self.rows.get((location.user_id, location.timestamp))
+        if current is not None:
+            # Same weighted mean as the ON CONFLICT update
+            samples = current.samples + location.samples
+            location = models.Location(
+                timestamp=current.timestamp,
+                user_id=current.user_id,
+                id=current.id,
+                samples=samples,
+                **{field: weighted_mean(getattr(current, field), current.samples,
+                                        getattr(location, field), location.samples)
+                   for field in MEAN_FIELDS},
+            )
+        self._store(location)
+        return location
+
+    async def _add_many(self, locations: List[models.Location]):
+        for location in locations:
+            self._store(location)
+
+    async def _upsert_many(self, locations: List[models.Location]) -> List[models.Location]:
+        return [await self._upsert(location) for location in locations]
+
+    async def _get_last_locations_for_users(
+            self, user_ids: List[str]) -> Dict[str, models.Location]:
+        return {user_id: self.last[user_id] for user_id in user_ids
+                if user_id in self.last}
+
+    async def _get(self, id: str) -> Optional[models.Location]:
+        return next((i for i in self.rows.values() if i.id == id), None)
+
+    async def _delete(self, location: models.Location):
+        self.rows.pop((location.user_id, location.timestamp), None)
+        if self.last.get(location.user_id) == location:
+            self.last.pop(location.user_id)
+
+    async def _get_user_id_and_timestamp(self, user_id: str,
+                                         timestamp) -> Optional[models.Location]:
+        return self.rows.get((user_id, timestamp))
+
+    async def _get_last_location_for_user(self, user_id: str) -> Optional[models.Location]:
+        return self.last.get(user_id)
+
+    async def _get_location_by_timestamp(self, user_id: str,
+                                         timestamp) -> Optional[models.Location]:
+        return self.rows.get((user_id, timestamp))
+
+    async def _upsert_rollups(self, rollups: List[models.Rollup]):
+        for rollup in rollups:
+            key = (rollup.user_id, rollup.resolution, rollup.bucket)
+            current = self.rollups.get(key)
+            self.rollups[key] = rollup if current is None else merge(current, rollup)
+
+    async def _get_rollups(self, user_id, resolution, start, end) -> List[models.Rollup]:
+        return [rollup for key, rollup in sorted(self.rollups.items())
+                if key[:2] == (user_id, resolution)
+                and (start is None or rollup.bucket >= start)
+                and (end is None or rollup.bucket < end)]
+
+    async def _delete_rollups(self, user_id: str):
+        for key in [key for key in self.rollups if key[0] == user_id]:
+            del self.rollups[key]
+
+    async def _get_user_ids(self) -> List[str]:
+        return sorted({user_id for user_id, _ in self.rows})
+
+    async def _get_range(self, user_id, start, end, after, limit):
+        rows = sorted((location for (row_user_id, _), location in self.rows.items()
+                       if row_user_id == user_id), key=lambda location: location.timestamp)
+        rows = [location for location in rows
+                if (start is None or location.timestamp >= start)
+                and (end is None or location.timestamp < end)
+                and (after is None or location.timestamp > after)]
+        for location in rows[:limit]:
+            yield location
+
+    async def _get_in_bbox(self, min_lat, min_long, max_lat, max_long, start, end,
+                           limit) -> List[models.Location]:
+        rows = sorted((location for location in self.rows.values()
+                       if in_bbox(location.lat, location.long,
+                                  min_lat, min_long, max_lat, max_long)
+                       and (start is None or location.timestamp >= start)
+                       and (end is None or location.timestamp < end)),
+                      key=lambda location: (location.timestamp, location.user_id))
+        return rows[:limit]
+
+    async def _get_users_near(self, lat, long, radius, since, limit):
+        return nearest(self.last.values(), lat, long, radius, since, limit)
+
+
+class FakeUnitOfWork(AbstractUnitOfWork):
+    def __init__(self):
+        super().__init__()
+        self.rows: Dict[Key, models.Location] = {}
+        self.last: Dict[str, models.Location] = {}
+        self.rollups: Dict[RollupKey, models.Rollup] = {}
+        self.commits = 0
+
+    async def __aenter__(self):
+        self.locations = FakeRepository(self.rows, self.last, self.rollups)
+        return await super().__aenter__()
+
+    async def _commit(self):
+        self.commits += 1
+
+    async def _rollback(self):
+        pass
+
+    async def __repr__(self):
+        return f"<FakeUnitOfWork(rows={len(self.rows)})>"
+
+
+class FailingRepository(FakeRepository):
+    async def _upsert_many(self, locations):
+        raise ConnectionError("postgres is down")
+
+
+class FlakyUnitOfWork(FakeUnitOfWork):
+    """Hands out `repository` for the next `failures` transactions."""
+
+    def __init__(self, repository=FailingRepository, failures=1):
+        super().__init__()
+        self.repository = repository
+        self.failures = failures
+
+    async def __aenter__(self):
+        result = await super().__aenter__()
+        if self.failures:
+            self.failures -= 1
+            self.locations = self.repository(self.rows, self.last, self.rollups)
+        return result
+
+
+class FakePublisher(redis_eventpublisher.AbstractPublisher):
+    """Records published events, encoded the way the redis publisher does."""
+
+    def __init__(self):
+        self.messages: List[Tuple[str, str]] = []
+
+    async def publish_many(self, messages: List[redis_eventpublisher.Message]):
+        self.messages.extend((channel, redis_eventpublisher.encode(event, data))
+                             for channel, event, data in messages)
+
+
+class FakeNotifications(AbstractNotifications):
+    def __init__(self):
+        self.sent: List[Tuple[str, str]] = []
+
+    async def publish(self, destination, message):
+        self.sent.append((destination, message))
+
+
+class FakeDeadLetters(AbstractDeadLetters):
+    def __init__(self):
+        self.letters: Deque[DeadLetter] = deque()
+
+    async def add(self, letter: DeadLetter):
+        self.letters.append(letter)
+
+    async def pop(self, count: int) -> List[DeadLetter]:
+        return [self.letters.popleft() for _ in range(min(count, len(self.letters)))]
+
+
+class FakeIngestQueue(AbstractIngestQueue):
+    """Batches per partition in queued order, with the consumer that read
+    each one, when and how many times, until they are acked."""
+
+    def __init__(self, partitions: int = 16, clock=time.monotonic):
+        super().__init__(partitions)
+        self.clock = clock
+        self.ids = itertools.count(1)
+        self.batches: Dict[int, List[QueuedBatch]] = {i: [] for i in range(partitions)}
+        # Read and not acked: batch id -> (consumer, read at)
+        self.pending: Dict[str, Tuple[str, float]] = {}
+        self.delivered = set()
+        self.deliveries: Dict[str, int] = {}
+
+    async def _add(self, batches: Dict[int, List[commands.PutLocation]]):
+        for partition, locations in batches.items():
+            self.batches[partition].append(
+                QueuedBatch(partition, f"{next(self.ids)}-0", list(locations)))
+
+    async def read(self, partitions: List[int], consumer: str, count: int,
+                   pending: bool = False, block_ms: int = 0) -> List[QueuedBatch]:
+        read = []
+        for partition in partitions:
+            if pending:
+                batches = [batch for batch in self.batches[partition]
+                           if self.pending.get(batch.id, ("",))[0] == consumer]
+            else:
+                batches = [batch for batch in self.batches[partition]
+                           if batch.id not in self.delivered]
+            for batch in batches[:count]:
+                self.delivered.add(batch.id)
+                self.pending[batch.id] = (consumer, self.clock())
+                read.append(self._deliver(batch))
+        return read
+
+    def _deliver(self, batch: QueuedBatch) -> QueuedBatch:
+        self.deliveries[batch.id] = self.deliveries.get(batch.id, 0) + 1
+        return replace(batch, deliveries=self.deliveries[batch.id])
+
+    async def claim(self, partition: int, consumer: str, min_idle_ms: int,
+                    count: int) -> List[QueuedBatch]:
+        now = self.clock()
+        claimed = [batch for batch in self.batches[partition]
+                   if batch.id in self.pending
+                   and (now - self.pending[batch.id][1]) * 1000 >= min_idle_ms][:count]
+        for batch in claimed:
+            self.pending[batch.id] = (consumer, now)
+        return [self._deliver(batch) for batch in claimed]
+
+    async def ack(self, batches: List[QueuedBatch]):
+        acked = {batch.id for batch in batches}
+        for partition in {batch.partition for batch in batches}:
+            self.batches[partition] = [batch for batch in self.batches[partition]
+                                       if batch.id not in acked]
+        for batch_id in acked:
+            self.pending.pop(batch_id, None)
+            self.deliveries.pop(batch_id, None)
+
+    async def stats(self) -> Dict[int, dict]:
+        stats = {}
+        for partition, batches in self.batches.items():
+            pending = sum(batch.id in self.pending for batch in batches)
+            stats[partition] = {"length": len(batches), "pending": pending,
+                                "lag": len(batches) - pending, "oldest_seconds": 0.0}
+        return stats
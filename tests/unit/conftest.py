@@ -0,0 +1,35 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from api import bootstrap
+from api.domain import commands
+from api.utils.timezone import TimezoneResolver
+from tests.fakes import (FakeBuffer, FakeDeadLetters, FakeNotifications,
+                         FakePublisher, FakeUnitOfWork)
+
+
+@pytest.fixture
+def make_bus():
+    """Builds message buses on the fakes, with those given in place of the
+    defaults."""
+
+    def make(uow=None, buffer=None, publish=None, timezones=None):
+        return bootstrap.bootstrap(start_orm=False, uow=uow or FakeUnitOfWork(),
+                                   buffer=buffer or FakeBuffer(),
+                                   publish=publish or FakePublisher(),
+                                   notifications=FakeNotifications(),
+                                   dead_letters=FakeDeadLetters(),
+                                   timezones=timezones or TimezoneResolver())
+    return make
+
+
+@pytest.fixture
+def points():
+    """Makes `count` points of a user 20 seconds apart, New York local time."""
+
+    def make(user_id, count, start=datetime(2017, 1, 1, 13, 5, 12)):
+        return [commands.PutLocation(start + timedelta(seconds=20 * i),
+                                     40.701 + i / 1000, -73.916, 11.3, 1.4, user_id)
+                for i in range(count)]
+    return make
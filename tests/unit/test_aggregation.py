@@ -0,0 +1,64 @@
+from datetime import datetime
+
+import pandas as pd
+
+from api.utils.aggregation import MinuteAggregator, RunningMean, weighted_mean
+from api.utils.data_resampling import mean_df_resample
+
+
+def location(timestamp, lat, speed=0.0, user_id="a1"):
+    return {"timestamp": datetime.fromisoformat(timestamp), "lat": lat,
+            "long": -73.9, "accuracy": 10.0, "speed": speed, "user_id": user_id}
+
+
+def test_running_mean_skips_missing_values():
+    mean = RunningMean()
+    for value in (1.0, None, float("nan"), 2.0):
+        mean.add(value)
+    assert mean.count == 2
+    assert mean.mean == 1.5
+    assert RunningMean().mean is None
+
+
+def test_aggregator_matches_pandas_resample():
+    entries = [
+        location("2017-07-30 00:18:08.919", 40.7563896179, 0.1),
+        location("2017-07-30 00:18:28.784", 40.7563896171, 0.3),
+        location("2017-07-30 00:18:48.100", 40.7564111111, 0.7),
+        location("2017-07-30 00:19:02.000", 40.7565, 1.1),
+    ]
+    aggregator = MinuteAggregator()
+    aggregator.add_many(entries)
+
+    expected = mean_df_resample(pd.DataFrame(entries))
+    results = aggregator.results()
+    assert [r["timestamp"] for r in results] == list(expected.index)
+    for result, (_, row) in zip(results, expected.iterrows()):
+        for field in ("lat", "long", "accuracy", "speed"):
+            assert result[field] == row[field]
+
+
+def test_aggregator_keeps_users_apart():
+    aggregator = MinuteAggregator()
+    aggregator.add(location("2017-07-30 00:18:08", 1.0, user_id="a1"))
+    aggregator.add(location("2017-07-30 00:18:10", 3.0, user_id="b2"))
+
+    results = aggregator.results()
+    assert [(r["user_id"], r["lat"]) for r in results] == [("a1", 1.0), ("b2", 3.0)]
+    assert all(r["timestamp"] == datetime(2017, 7, 30, 0, 18) for r in results)
+
+
+def test_minutes_without_any_accuracy_get_none():
+    aggregator = MinuteAggregator()
+    for seconds in ("08", "28"):
+        aggregator.add(dict(location(f"2017-07-30 00:18:{seconds}", 1.0), accuracy=None))
+
+    [result] = aggregator.results()
+    assert result["accuracy"] is None and result["speed"] == 0.0
+
+
+def test_weighted_mean_leaves_out_missing_means():
+    assert weighted_mean(1.0, 1, 4.0, 2) == 3.0
+    assert weighted_mean(None, 1, 4.0, 2) == 4.0
+    assert weighted_mean(1.0, 1, None, 2) == 1.0
+    assert weighted_mean(None, 1, None, 2) is None
@@ -1,7 +1,12 @@
+import json
+from datetime import datetime
+
 import pytest
 from fastapi.testclient import TestClient
 from httpx import AsyncClient
+from api.domain import models
 from api.entrypoints import app as main
+from tests.fakes import FakeIngestQueue
 
 
 @pytest.fixture
@@ -10,6 +15,13 @@ def client():
     return TestClient(app)
 
 
+@pytest.fixture
+def fake_bus(monkeypatch, make_bus):
+    bus = make_bus(timezones=main.timezones)
+    monkeypatch.setattr(main, "bus", bus)
+    return bus
+
+
 def test_healthcheck(client):
     response = client.get('/health')
     assert response.status_code == 200
@@ -28,8 +40,7 @@ def test_docs(client):
 
 
 @pytest.mark.asyncio
-@pytest.mark.skip(reason="Needs reimplementation")
-async def test_should_return_200_when_data_is_valid(client):
+async def test_should_return_200_when_data_is_valid(fake_bus):
     location = {
         "timestamp": "2017-01-01 13:05:12",
         "lat": 40.701,
@@ -61,3 +72,183 @@ async def test_should_return_422_when_missing_timestamp(client):
         response = await client.put('/location', json=location)
 
     assert response.status_code == 422
+
+
+def test_put_locations_should_return_400_when_body_is_not_a_list(client):
+    response = client.put('/locations', json={"user_id": "a1"})
+    assert response.status_code == 400
+
+
+def test_put_locations_should_reject_invalid_items(client):
+    locations = [
+        {"lat": 40.701, "long": -73.916, "user_id": "a1"},
+        "not a location",
+    ]
+    response = client.put('/locations', json=locations)
+
+    assert response.status_code == 200
+    body = response.json()
+    assert body["accepted"] == 0
+    assert body["rejected"] == 2
+    assert [r["index"] for r in body["results"]] == [0, 1]
+    assert all(r["status"] == "invalid" for r in body["results"])
+
+
+def test_put_locations_should_read_ndjson_lines(client):
+    content = b'{"lat": 40.701, "user_id": "a1"}\n\n{not json\n'
+    response = client.put('/locations', content=content,
+                          headers={"content-type": "application/x-ndjson"})
+
+    assert response.status_code == 200
+    body = response.json()
+    assert body["rejected"] == 2
+    assert [r["index"] for r in body["results"]] == [0, 1]
+
+
+def test_put_locations_should_store_closed_minutes(client, fake_bus):
+    locations = [
+        {"timestamp": "2017-01-01 13:05:12", "lat": 40.701, "long": -73.916,
+         "accuracy": 11.3, "speed": 1.4, "user_id": "a1"},
+        {"timestamp": "2017-01-01 13:06:30", "lat": 40.702, "long": -73.917,
+         "accuracy": 12.0, "speed": 1.5, "user_id": "a1"},
+    ]
+    response = client.put('/locations', json=locations)
+
+    assert response.status_code == 200
+    assert response.json()["accepted"] == 2
+    [location] = fake_bus.uow.rows.values()
+    assert (location.user_id, location.lat, location.samples) == ("a1", 40.701, 1)
+    assert location.timestamp.isoformat() == "2017-01-01T18:05:00"
+    assert fake_bus.uow.commits == 1
+
+
+def test_put_locations_should_queue_in_stream_mode(client, fake_bus, monkeypatch):
+    queue = FakeIngestQueue(partitions=4)
+    monkeypatch.setattr(main, "ingest_queue", queue)
+    locations = [
+        {"timestamp": "2017-01-01 13:05:12", "lat": 40.701, "long": -73.916,
+         "accuracy": 11.3, "speed": 1.4, "user_id": user_id}
+        for user_id in ("a1", "b2", "a1")
+    ]
+    response = client.put('/locations', json=locations + [{"lat": 1}])
+
+    assert response.status_code == 200
+    body = response.json()
+    assert (body["accepted"], body["queued"], body["rejected"]) == (0, 3, 1)
+    [a1] = queue.batches[queue.partition_of("a1")]
+    assert [i.user_id for i in a1.locations].count("a1") == 2
+    assert not fake_bus.uow.rows
+    response = client.get('/metrics')
+    assert f'twosense_ingest_queue{{partition="{a1.partition}",stat="lag"}} 1' \
+        in response.text
+
+
+def test_metrics(client):
+    client.get('/health')
+    response = client.get('/metrics')
+
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    assert 'twosense_message_handle_seconds_count{kind="command",message="HealthCheck"}' \
+        in response.text
+    assert 'twosense_timezone_cache{stat="lookups"}' in response.text
+    assert 'twosense_user_state_cache{stat="hit_rate"}' in response.text
+
+
+def test_timezone_stats(client):
+    response = client.get('/stats/timezones')
+    assert response.status_code == 200
+    assert {"lookups", "hit_rate", "cells"} <= set(response.json())
+
+
+def test_user_state_stats(client):
+    response = client.get('/stats/users')
+    assert response.status_code == 200
+    assert {"lookups", "hit_rate", "users"} <= set(response.json())
+
+
+def test_get_user_locations_pages_by_cursor(client, fake_bus):
+    for minute in range(3):
+        location = models.Location(timestamp=datetime(2017, 1, 1, 18, minute), lat=40.7,
+                                   long=-73.9, accuracy=10.0, speed=1.0, user_id="a1")
+        fake_bus.uow.rows[(location.user_id, location.timestamp)] = location
+
+    response = client.get('/users/a1/locations',
+                          params={"from": "2017-01-01T13:00:00-05:00", "limit": 2})
+
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/x-ndjson"
+    page = [json.loads(line) for line in response.text.splitlines()]
+    assert [line["timestamp"] for line in page] == ["2017-01-01T18:00:00",
+                                                    "2017-01-01T18:01:00"]
+
+    response = client.get('/users/a1/locations',
+                          params={"cursor": page[-1]["timestamp"], "limit": 2})
+
+    assert [json.loads(line)["timestamp"] for line in response.text.splitlines()] == [
+        "2017-01-01T18:02:00"]
+
+
+def test_minutes_without_accuracy_read_as_null(client, fake_bus, monkeypatch):
+    monkeypatch.setattr(main, "geo_index", True)
+    # Stored NULL, and NaN as before the means could be NULL
+    for minute, accuracy in ((0, None), (1, float("nan"))):
+        location = models.Location(timestamp=datetime(2017, 1, 1, 18, minute), lat=40.7,
+                                   long=-73.9, accuracy=accuracy, speed=1.0, user_id="a1")
+        fake_bus.uow.rows[(location.user_id, location.timestamp)] = location
+
+    response = client.get('/users/a1/locations')
+    assert [json.loads(line)["accuracy"] for line in response.text.splitlines()] == \
+        [None, None]
+
+    response = client.get('/locations/bbox', params={
+        "min_lat": 40.6, "min_long": -74.0, "max_lat": 40.75, "max_long": -73.8})
+    assert response.status_code == 200
+    assert [i["accuracy"] for i in response.json()] == [None, None]
+
+
+def test_get_user_rollups(client, fake_bus):
+    locations = [
+        {"timestamp": "2017-01-01 13:05:12", "lat": 40.701, "long": -73.916,
+         "accuracy": 11.3, "speed": 1.4, "user_id": "a1"},
+        {"timestamp": "2017-01-01 13:06:30", "lat": 40.702, "long": -73.917,
+         "accuracy": 12.0, "speed": 1.5, "user_id": "a1"},
+    ]
+    client.put('/locations', json=locations)
+
+    response = client.get('/users/a1/rollups', params={"resolution": "1d"})
+
+    assert response.status_code == 200
+    [day] = response.json()
+    assert (day["bucket"], day["points"], day["max_speed"]) == ("2017-01-01T00:00:00", 1, 1.4)
+    assert client.get('/users/a1/rollups', params={"resolution": "1w"}).status_code == 400
+
+
+def test_locations_in_bbox_and_users_near(client, fake_bus, monkeypatch):
+    monkeypatch.setattr(main, "geo_index", True)
+    for user_id, lat, minute in (("a1", 40.70, 0), ("a1", 40.80, 1), ("b2", 40.701, 0)):
+        location = models.Location(datetime(2017, 1, 1, 18, minute), lat, -73.9,
+                                   10.0, 1.0, user_id)
+        fake_bus.uow.rows[(user_id, location.timestamp)] = location
+        fake_bus.uow.last[user_id] = location
+
+    response = client.get('/locations/bbox', params={
+        "min_lat": 40.6, "min_long": -74.0, "max_lat": 40.75, "max_long": -73.8})
+    assert [(i["user_id"], i["lat"]) for i in response.json()] == \
+        [("a1", 40.70), ("b2", 40.701)]
+
+    # a1 was last seen 10 km away
+    response = client.get('/users/near',
+                          params={"lat": 40.7, "long": -73.9, "radius": 500})
+    assert [(i["user_id"], round(i["distance"])) for i in response.json()] == \
+        [("b2", 111)]
+
+    response = client.get('/locations/bbox', params={
+        "min_lat": 41, "min_long": -74.0, "max_lat": 40, "max_long": -73.8})
+    assert response.status_code == 400
+
+
+def test_geo_queries_need_the_index(client, monkeypatch):
+    monkeypatch.setattr(main, "geo_index", False)
+    response = client.get('/users/near', params={"lat": 40.7, "long": -73.9})
+    assert response.status_code == 404
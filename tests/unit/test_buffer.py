@@ -0,0 +1,93 @@
+from datetime import datetime, timedelta
+
+import fakeredis.aioredis
+import pytest
+
+from api.adapters.buffer import (POINT, CompactRedisBuffer, MemoryBuffer, RedisBuffer,
+                                 _header, _pack, _to_us, _unpack)
+from api.utils.user_state import UserStateCache
+
+START = datetime(2017, 1, 1, 13, 5, 12)
+
+
+def entry(user_id, seconds, accuracy=11.3):
+    return {"timestamp": START + timedelta(seconds=seconds), "lat": 40.701 + seconds / 1e4,
+            "long": -73.916, "accuracy": accuracy, "speed": 1.4, "user_id": user_id}
+
+
+# (entries, floors) of each call to append_many: unknown users, floors,
+# duplicates, out of order points and minutes closed within a call
+APPENDS = [
+    ([entry("a1", 0)], None),
+    ([entry("a1", 0)], {"a1": None}),
+    ([entry("a1", 0), entry("a1", 20, accuracy=None), entry("a1", 10), entry("a1", 30)],
+     None),
+    ([entry("b2", -20), entry("b2", 0)], {"b2": START.replace(second=0)}),
+    ([entry("b2", 60), entry("b2", 60), entry("a1", 65)], None),
+    ([entry("a1", 70), entry("a1", 20), entry("a1", 125), entry("a1", 130)], None),
+]
+
+REDIS_BUFFERS = {
+    "json": lambda write_behind: RedisBuffer(
+        fakeredis.aioredis.FakeRedis(decode_responses=True), write_behind),
+    "json_cached": lambda write_behind: RedisBuffer(
+        fakeredis.aioredis.FakeRedis(decode_responses=True), write_behind,
+        state=UserStateCache()),
+    "compact": lambda write_behind: CompactRedisBuffer(
+        fakeredis.aioredis.FakeRedis(), write_behind),
+    "compact_cached": lambda write_behind: CompactRedisBuffer(
+        fakeredis.aioredis.FakeRedis(), write_behind, state=UserStateCache()),
+}
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("write_behind", [False, True])
+@pytest.mark.parametrize("layout", REDIS_BUFFERS)
+async def test_redis_buffers_append_like_the_memory_buffer(layout, write_behind):
+    buffer, expected = REDIS_BUFFERS[layout](write_behind), MemoryBuffer(write_behind)
+
+    for entries, floors in APPENDS:
+        assert await buffer.append_many(entries, floors) == \
+            await expected.append_many(entries, floors)
+
+    closed = await buffer.pop_closed(10)
+    assert closed == await expected.pop_closed(10)
+    assert len(closed) == (3 if write_behind else 0)
+
+
+def test_packed_points_round_trip():
+    entries = [
+        {"timestamp": datetime(2017, 1, 1, 13, 5, 12, 250000), "lat": 40.701,
+         "long": -73.916, "accuracy": 12.5, "speed": 1.25, "user_id": "a1"},
+        {"timestamp": datetime(2017, 1, 1, 13, 5, 13), "lat": 40.702,
+         "long": -73.917, "accuracy": None, "speed": None, "user_id": "a1"},
+    ]
+    packed = b"".join(_pack(entry, _to_us(entry["timestamp"])) for entry in entries)
+
+    assert len(packed) == 2 * POINT.size
+    assert _unpack("a1", packed) == entries
+
+
+def test_header_holds_the_user_id():
+    header = _header("użytkownik")
+
+    assert header[2:].decode() == "użytkownik"
+    assert int.from_bytes(header[:2], "little") == len(header) - 2
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("layout", REDIS_BUFFERS)
+async def test_requeued_buffers_come_back_first(layout):
+    buffer, expected = REDIS_BUFFERS[layout](True), MemoryBuffer(True)
+    for entries, floors in APPENDS:
+        await buffer.append_many(entries, floors)
+        await expected.append_many(entries, floors)
+    closed = await expected.pop_closed(10)
+
+    # A flush of the first two failed
+    taken = await buffer.pop_closed(2)
+    await buffer.requeue_closed(taken)
+
+    assert taken == closed[:2]
+    assert await buffer.pop_closed(10) == closed
+    assert await buffer.pop_closed(10) == []
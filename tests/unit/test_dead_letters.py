@@ -0,0 +1,52 @@
+from datetime import datetime
+
+import fakeredis.aioredis
+import pytest
+
+from api.adapters.dead_letters import (DEAD_LETTERS_KEY, INGEST_DEAD_LETTERS_KEY,
+                                       DeadLetter, RedisDeadLetters)
+from api.domain import commands, events
+
+
+def letter(i):
+    event = events.LocationAdded(timestamp="2017-01-01T18:00:00", lat=40.7, long=-73.9,
+                                 accuracy=None, speed=1.0, user_id=f"u{i}")
+    return DeadLetter(event, "publish_location_added_event", "ConnectionError()", 4,
+                      failed_at=datetime(2017, 1, 1, 18, 0, i))
+
+
+@pytest.mark.asyncio
+async def test_dead_letters_round_trip_oldest_first():
+    letters = RedisDeadLetters(fakeredis.aioredis.FakeRedis(decode_responses=True))
+    for i in range(3):
+        await letters.add(letter(i))
+
+    assert await letters.pop(2) == [letter(0), letter(1)]
+    assert await letters.pop(2) == [letter(2)]
+    assert await letters.pop(2) == []
+
+
+@pytest.mark.asyncio
+async def test_dead_letters_drop_the_oldest_past_maxlen():
+    client = fakeredis.aioredis.FakeRedis(decode_responses=True)
+    letters = RedisDeadLetters(client, maxlen=2)
+    for i in range(5):
+        await letters.add(letter(i))
+
+    assert await client.llen(DEAD_LETTERS_KEY) == 2
+    assert await letters.pop(10) == [letter(3), letter(4)]
+
+
+@pytest.mark.asyncio
+async def test_queued_batches_round_trip_apart_from_events():
+    client = fakeredis.aioredis.FakeRedis(decode_responses=True)
+    letters = RedisDeadLetters(client, key=INGEST_DEAD_LETTERS_KEY)
+    batch = commands.PutLocations([
+        commands.PutLocation(datetime(2017, 1, 1, 13, 5, 12), 40.7, -73.9, None, 1.4, "u1"),
+        commands.PutLocation(datetime(2017, 1, 1, 13, 5, 32), 40.8, -73.9, 11.3, 1.4, "u1")])
+    await letters.add(DeadLetter(batch, "IngestWorker", "ValueError()", 5,
+                                 failed_at=datetime(2017, 1, 1, 18, 0)))
+
+    assert await client.llen(DEAD_LETTERS_KEY) == 0
+    assert await letters.pop(10) == [DeadLetter(batch, "IngestWorker", "ValueError()", 5,
+                                                failed_at=datetime(2017, 1, 1, 18, 0))]
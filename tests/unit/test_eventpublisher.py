@@ -0,0 +1,86 @@
+import asyncio
+import json
+
+import fakeredis.aioredis
+import pytest
+
+from api.adapters.redis_eventpublisher import QueuedPublisher, RedisPublisher, encode
+from tests.fakes import FakePublisher
+
+
+class SlowPublisher(FakePublisher):
+    def __init__(self):
+        super().__init__()
+        self.calls = 0
+        self.release = asyncio.Event()
+
+    async def publish_many(self, messages):
+        self.calls += 1
+        await self.release.wait()
+        await super().publish_many(messages)
+
+
+@pytest.mark.asyncio
+async def test_queued_publisher_sends_piled_up_events_at_once():
+    publisher = SlowPublisher()
+    queued = QueuedPublisher(publisher, maxsize=10)
+
+    await queued("locations", "LocationAdded", {"i": 0})
+    await asyncio.sleep(0)
+    for i in range(1, 4):
+        await queued("locations", "LocationAdded", {"i": i})
+    publisher.release.set()
+    await queued.close()
+
+    assert publisher.calls == 2
+    assert [message for _, message in publisher.messages] == [
+        encode("LocationAdded", {"i": i}) for i in range(4)]
+
+
+@pytest.mark.asyncio
+async def test_queued_publisher_waits_when_full():
+    publisher = SlowPublisher()
+    queued = QueuedPublisher(publisher, maxsize=1)
+
+    await queued("locations", "LocationAdded", {"i": 0})
+    await asyncio.sleep(0)
+    await queued("locations", "LocationAdded", {"i": 1})
+    blocked = asyncio.create_task(queued("locations", "LocationAdded", {"i": 2}))
+    await asyncio.sleep(0.01)
+    assert not blocked.done()
+
+    publisher.release.set()
+    await blocked
+    await queued.close()
+    assert len(publisher.messages) == 3
+
+
+@pytest.mark.asyncio
+async def test_redis_publisher_appends_to_streams_in_order():
+    client = fakeredis.aioredis.FakeRedis(decode_responses=True)
+    publisher = RedisPublisher(client, stream_maxlen=1000)
+
+    await publisher.publish_many([("locations", "LocationAdded", {"i": i}) for i in range(3)])
+    await publisher.publish_many([("locations", "LocationAdded", {"i": 3}),
+                                  ("users", "UserAdded", {"id": "a1"})])
+
+    entries = await client.xrange("events:locations")
+    assert [(fields["event"], json.loads(fields["data"])) for _, fields in entries] == \
+        [("LocationAdded", {"i": i}) for i in range(4)]
+    [(_, fields)] = await client.xrange("events:users")
+    assert fields == {"event": "UserAdded", "data": '{"id": "a1"}'}
+
+
+@pytest.mark.asyncio
+async def test_redis_publisher_publishes_to_channels():
+    client = fakeredis.aioredis.FakeRedis(decode_responses=True)
+    pubsub = client.pubsub()
+    await pubsub.subscribe("locations")
+    await pubsub.get_message(timeout=1)
+
+    await RedisPublisher(client).publish_many(
+        [("locations", "LocationAdded", {"i": i}) for i in range(2)])
+
+    messages = [await pubsub.get_message(timeout=1) for _ in range(2)]
+    assert [message["data"] for message in messages] == \
+        [encode("LocationAdded", {"i": i}) for i in range(2)]
@@ -0,0 +1,79 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+
+from api.service_layer.flusher import Flusher
+from tests.fakes import FakeBuffer, FakePublisher, FakeRepository, FlakyUnitOfWork
+
+START = datetime(2017, 1, 1, 18, 0)
+
+
+class StuckRepository(FakeRepository):
+    async def _upsert_many(self, locations):
+        await asyncio.Event().wait()
+
+
+async def closed_buffers(users):
+    # Two points per user, the second closing the buffer of the first
+    buffer = FakeBuffer(write_behind=True)
+    for user_id in users:
+        await buffer.append_many([
+            {"timestamp": START + timedelta(seconds=seconds), "lat": 40.7,
+             "long": -73.9, "accuracy": 10.0, "speed": 1.0, "user_id": user_id}
+            for seconds in (0, 60)], {user_id: None})
+    return buffer
+
+
+def stored(uow):
+    return sorted((user_id, location.samples)
+                  for (user_id, _), location in uow.rows.items())
+
+
+@pytest.mark.asyncio
+async def test_failed_flushes_requeue_the_buffers():
+    buffer = await closed_buffers(["a1", "b2"])
+    closed = list(buffer.closed)
+    uow, publish = FlakyUnitOfWork(), FakePublisher()
+    flusher = Flusher(uow, buffer, publish)
+
+    with pytest.raises(ConnectionError):
+        await flusher.flush_once()
+
+    assert list(buffer.closed) == closed
+    assert not uow.rows and not publish.messages
+
+
+@pytest.mark.asyncio
+async def test_requeued_buffers_are_stored_once():
+    buffer = await closed_buffers(["a1", "b2"])
+    uow, publish = FlakyUnitOfWork(), FakePublisher()
+    flusher = Flusher(uow, buffer, publish)
+    with pytest.raises(ConnectionError):
+        await flusher.flush_once()
+
+    assert await flusher.flush_once() == 2
+    assert await flusher.flush_once() == 0
+
+    assert stored(uow) == [("a1", 1), ("b2", 1)]
+    assert uow.commits == 1
+    assert len(publish.messages) == 2
+
+
+@pytest.mark.asyncio
+async def test_shutdown_drains_the_queue():
+    buffer = await closed_buffers(["a1", "b2", "c3"])
+    uow = FlakyUnitOfWork(StuckRepository)
+    flusher = Flusher(uow, buffer, FakePublisher(), interval=60, batch_size=2)
+    task = asyncio.create_task(flusher.run())
+    await asyncio.sleep(0.01)
+
+    # Cancelled in the middle of the first batch, which goes back
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+    assert len(buffer.closed) == 3
+
+    assert await flusher.drain() == 3
+    assert not buffer.closed
+    assert stored(uow) == [("a1", 1), ("b2", 1), ("c3", 1)]
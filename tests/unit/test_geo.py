@@ -0,0 +1,20 @@
+from api.utils.geo import POLYGON_STEP, bbox_polygon, degrees_around
+from api.utils.rollups import haversine
+
+
+def test_degrees_around_hold_the_circle():
+    dlat, dlong = degrees_around(60.0, 5000)
+
+    assert haversine(60.0, 10.0, 60.0 + dlat, 10.0) >= 4999.99
+    assert haversine(60.0, 10.0, 60.0, 10.0 + dlong) > 5000
+    assert degrees_around(89.99, 5000)[1] == 180.0
+
+
+def test_bbox_polygon_holds_the_box():
+    [ring] = bbox_polygon(40.5, -74.3, 40.9, -71.0)["coordinates"]
+
+    assert ring[0] == ring[-1]
+    longs = sorted({long for long, _ in ring})
+    assert longs[0] < -74.3 and longs[-1] > -71.0
+    assert min(lat for _, lat in ring) < 40.5 < 40.9 < max(lat for _, lat in ring)
+    assert max(b - a for a, b in zip(longs, longs[1:])) <= POLYGON_STEP
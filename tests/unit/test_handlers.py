@@ -0,0 +1,48 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from api.domain import commands
+from tests.fakes import FakePublisher, FakeUnitOfWork
+
+
+def point(seconds, lat=40.7):
+    # New York local time, 18:00 UTC
+    return commands.PutLocation(datetime(2017, 1, 1, 13, 0) + timedelta(seconds=seconds),
+                                lat, -73.9, 10.0, 1.0, "a1")
+
+
+@pytest.mark.asyncio
+async def test_put_location_flushes_the_minute_a_later_point_closes(make_bus):
+    publish = FakePublisher()
+    bus = make_bus(publish=publish)
+
+    for seconds, lat in ((0, 40.7), (20, 40.8), (40, 40.9)):
+        await bus.handle(point(seconds, lat))
+    assert not bus.uow.rows and not publish.messages
+
+    await bus.handle(point(60))
+
+    [((user_id, timestamp), location)] = bus.uow.rows.items()
+    assert (user_id, timestamp) == ("a1", datetime(2017, 1, 1, 18, 0))
+    assert location.samples == 3 and location.lat == pytest.approx(40.8)
+    assert bus.uow.commits == 1
+    [(channel, _)] = publish.messages
+    assert channel == "locations"
+
+
+@pytest.mark.asyncio
+async def test_an_empty_buffer_takes_points_from_the_stored_minute_on(make_bus):
+    uow = FakeUnitOfWork()
+    bus = make_bus(uow)
+    for seconds in (0, 60):
+        await bus.handle(point(seconds))
+
+    # A new buffer, as after redis lost the one above
+    bus = make_bus(uow)
+    for seconds in (-10, 10, 70, 130):
+        await bus.handle(point(seconds))
+
+    # 17:59:50 is turned away, 18:00:10 is merged into the stored minute
+    assert [(timestamp.minute, location.samples)
+            for (_, timestamp), location in sorted(uow.rows.items())] == [(0, 2), (1, 1)]
@@ -0,0 +1,109 @@
+import csv
+from datetime import datetime
+
+import pytest
+
+from api.domain import models
+from api.importer import import_files, parse_row
+from tests.fakes import FakeUnitOfWork
+
+FIELDS = ["timestamp", "lat", "long", "accuracy", "speed", "user_id"]
+
+ROWS = [
+    ["2017-01-01 13:05:12", "40.701", "-73.916", "11.3", "1.4", "a1"],
+    ["2017-01-01 13:05:12", "40.701", "-73.916", "11.3", "1.4", "a1"],
+    ["2017-01-01 13:05:41.5", "40.7023", "-73.9171", "", "", "a1"],
+    ["2017-01-01 13:05:30", "40.711", "-73.926", "9.0", "2.1", "a1"],
+    ["2017-01-01 13:05:05", "40.700", "-73.915", "9.0", "2.1", "a1"],
+    ["2017-01-01 13:06:20", "40.703", "-73.918", "12.0", "1.5", "b2"],
+    ["2017-01-01 13:06:20", "40.7031", "-73.9183", "10.7", "1.1", "a1"],
+    ["2017-01-01 13:06:33", "40.7042", "-73.9191", "8.1", "0.9", "a1"],
+    ["not a time", "40.7", "-73.9", "10", "1", "a1"],
+    ["2017-01-01 13:07:40", "40.705", "-73.920", "7.5", "3.2", "a1"],
+    ["2017-01-01 13:08:02", "40.706", "-73.921", "7.4", "3.0", "b2"],
+    ["2017-01-01 13:09:15", "40.707", "-73.922", "7.3", "2.8", "a1"],
+    ["2017-01-01 13:21:00", "40.708", "-73.923", "7.2", "2.6", "a1"],
+]
+
+
+def write_csv(path, rows):
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(FIELDS)
+        writer.writerows(rows)
+    return str(path)
+
+
+def stored(uow):
+    minutes = sorted((i.user_id, i.timestamp, i.lat, i.long, i.accuracy, i.speed,
+                      i.samples) for i in uow.rows.values())
+    return [tuple("nan" if value != value else value for value in minute)
+            for minute in minutes], sorted(uow.rollups.items())
+
+
+async def put_one_by_one(bus, rows):
+    for row in rows:
+        try:
+            cmd = parse_row(dict(zip(FIELDS, row)))
+        except ValueError:
+            continue
+        await bus.handle(cmd)
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("chunk_size", [1, 3, 100])
+async def test_import_stores_what_the_api_would(tmp_path, chunk_size, make_bus):
+    online = FakeUnitOfWork()
+    await put_one_by_one(make_bus(online), ROWS)
+    imported = FakeUnitOfWork()
+
+    counts = await import_files(imported, [write_csv(tmp_path / "points.csv", ROWS)],
+                                chunk_size=chunk_size, keep_open=True)
+
+    assert stored(imported) == stored(online)
+    assert (counts["accepted"], counts["duplicate"], counts["out_of_order"],
+            counts["invalid"]) == (9, 1, 2, 1)
+
+
+@pytest.mark.asyncio
+async def test_import_merges_into_the_newest_stored_minute(tmp_path, make_bus):
+    before = models.Location(datetime(2017, 1, 1, 18, 5), 40.7, -73.91, 10.0, 1.0,
+                             "a1", samples=2)
+    online, imported = FakeUnitOfWork(), FakeUnitOfWork()
+    for uow in (online, imported):
+        async with uow:
+            await uow.locations.upsert(models.Location(**{
+                field: getattr(before, field) for field in
+                ("timestamp", "lat", "long", "accuracy", "speed", "user_id", "samples")}))
+    rows = [row for row in ROWS if row[-1] == "a1"]
+    await put_one_by_one(make_bus(online), rows)
+
+    await import_files(imported, [write_csv(tmp_path / "a1.csv", rows)],
+                       chunk_size=2, keep_open=True)
+
+    assert stored(imported) == stored(online)
+
+
+@pytest.mark.asyncio
+async def test_open_buffers_are_written_at_the_end(tmp_path):
+    uow = FakeUnitOfWork()
+    paths = [write_csv(tmp_path / "points.csv", ROWS)]
+
+    counts = await import_files(uow, paths)
+
+    assert (uow.last["a1"].timestamp, uow.last["a1"].samples) == \
+        (datetime(2017, 1, 1, 18, 21), 1)
+    assert counts["minutes"] == len(uow.rows)
+
+
+@pytest.mark.asyncio
+async def test_users_are_shared_out_between_slots(tmp_path):
+    paths = [write_csv(tmp_path / "points.csv", ROWS)]
+    whole, parts = FakeUnitOfWork(), [FakeUnitOfWork(), FakeUnitOfWork()]
+    await import_files(whole, paths)
+
+    for slot, uow in enumerate(parts):
+        await import_files(uow, paths, slot=slot, slots=2)
+
+    assert sorted(stored(parts[0])[0] + stored(parts[1])[0]) == stored(whole)[0]
+    assert all(uow.rows for uow in parts)
@@ -0,0 +1,178 @@
+import zlib
+from datetime import datetime
+
+import fakeredis.aioredis
+import pytest
+
+from api.adapters.ingest_queue import RedisIngestQueue, stream_name
+from api.domain import commands
+from api.service_layer.flusher import Flusher
+from api.service_layer.ingest_worker import IngestWorker, partitions_of
+from tests.fakes import (FakeBuffer, FakeDeadLetters, FakeIngestQueue, FakePublisher,
+                         FlakyUnitOfWork)
+
+
+class FailingBuffer(FakeBuffer):
+    def __init__(self, failures: int):
+        super().__init__()
+        self.failures = failures
+
+    async def append_many(self, entries, floors=None):
+        if self.failures:
+            self.failures -= 1
+            raise ConnectionError("redis is down")
+        return await super().append_many(entries, floors)
+
+
+class PoisonBuffer(FakeBuffer):
+    """Always fails the points of `user_id`."""
+
+    def __init__(self, user_id: str):
+        super().__init__()
+        self.user_id = user_id
+
+    async def append_many(self, entries, floors=None):
+        if any(entry["user_id"] == self.user_id for entry in entries):
+            raise ValueError(f"can't store {self.user_id}")
+        return await super().append_many(entries, floors)
+
+
+def test_users_always_go_to_the_same_partition():
+    queue = FakeIngestQueue(partitions=8)
+
+    assert queue.partition_of("a1") == queue.partition_of("a1") == 3
+    assert {queue.partition_of(f"user{i}") for i in range(100)} == set(range(8))
+
+
+def test_partitions_are_shared_out_between_workers():
+    assert [partitions_of(slot, 3, 8) for slot in range(3)] == \
+        [[0, 3, 6], [1, 4, 7], [2, 5]]
+
+
+@pytest.mark.asyncio
+async def test_worker_stores_queued_points_in_order(make_bus, points):
+    queue = FakeIngestQueue(partitions=4)
+    bus = make_bus()
+    for point in points("a1", 6) + points("b2", 6):
+        await queue.enqueue([point])
+    worker = IngestWorker(bus, queue, list(range(4)), "worker-0", count=2)
+
+    while await worker.run_once():
+        pass
+
+    # Out of order points would have been turned away
+    assert sorted((i.user_id, i.samples) for i in bus.uow.rows.values()) == \
+        [("a1", 3), ("b2", 3)]
+    assert all(stats["length"] == 0 for stats in (await queue.stats()).values())
+
+
+@pytest.mark.asyncio
+async def test_failed_batches_stay_pending_and_are_read_again(make_bus, points):
+    queue = FakeIngestQueue(partitions=1)
+    bus = make_bus(buffer=FailingBuffer(failures=1))
+    await queue.enqueue(points("a1", 4))
+    worker = IngestWorker(bus, queue, [0], "worker-0")
+
+    with pytest.raises(ConnectionError):
+        await worker.run_once()
+    assert (await queue.stats())[0]["pending"] == 1
+    assert await worker.run_once() == 0
+
+    assert await worker.recover() == 4
+    assert (await queue.stats())[0]["length"] == 0
+    assert len(bus.uow.rows) == 1
+
+
+@pytest.mark.asyncio
+async def test_closed_minutes_survive_a_failed_write_and_redelivery(make_bus, points):
+    # As api.worker runs it, write-behind: the minute is queued by the
+    # append that closes it, and requeued when writing it fails
+    queue = FakeIngestQueue(partitions=1)
+    buffer = FakeBuffer(write_behind=True)
+    worker = IngestWorker(make_bus(buffer=buffer), queue, [0], "worker-0")
+    flusher = Flusher(FlakyUnitOfWork(), buffer, FakePublisher())
+    await queue.enqueue(points("a1", 4))
+
+    assert await worker.run_once() == 4
+    with pytest.raises(ConnectionError):
+        await flusher.flush_once()
+    # The same batch again, its points are all turned away
+    await queue.enqueue(points("a1", 4))
+    assert await worker.run_once() == 4
+    assert len(buffer.closed) == 1
+
+    assert await flusher.flush_once() == 1
+    assert [(i.user_id, i.timestamp, i.samples) for i in flusher.uow.rows.values()] == \
+        [("a1", datetime(2017, 1, 1, 18, 5), 3)]
+
+
+@pytest.mark.asyncio
+async def test_batches_left_pending_are_claimed_once_idle(make_bus, points):
+    now = [0.0]
+    queue = FakeIngestQueue(partitions=1, clock=lambda: now[0])
+    await queue.enqueue(points("a1", 4))
+    await queue.read([0], "worker-1", 10)
+    worker = IngestWorker(make_bus(), queue, [0], "worker-0", claim_idle_ms=60_000)
+
+    assert await worker.recover() == 0
+    now[0] = 60
+    assert await worker.recover() == 4
+    assert (await queue.stats())[0]["length"] == 0
+
+
+@pytest.mark.asyncio
+async def test_redis_queue_reads_claims_and_acks_batches(points):
+    client = fakeredis.aioredis.FakeRedis(decode_responses=True)
+    queue = RedisIngestQueue(client, partitions=8)
+    await queue.create_groups()
+    await queue.create_groups()
+
+    assert await queue.enqueue(points("a1", 2) + points("b2", 1) + points("a1", 1)) == 2
+    for user_id in ("a1", "b2"):
+        partition = zlib.crc32(user_id.encode()) % 8
+        assert partition == queue.partition_of(user_id)
+        assert await client.xlen(stream_name(partition)) == 1
+
+    a1 = queue.partition_of("a1")
+    read = await queue.read([a1], "worker-0", 10)
+    assert [(i.partition, i.locations, i.deliveries) for i in read] == \
+        [(a1, points("a1", 2) + points("a1", 1), 1)]
+    assert await queue.read([a1], "worker-0", 10) == []
+    assert [i.deliveries for i in await queue.read([a1], "worker-0", 10, pending=True)] == [2]
+    claimed = await queue.claim(a1, "worker-1", 0, 10)
+    assert [(i.id, i.deliveries) for i in claimed] == [(read[0].id, 3)]
+    assert await queue.read([a1], "worker-0", 10, pending=True) == []
+    assert (await queue.stats())[a1] == {"length": 1, "pending": 1, "lag": 0,
+                                         "oldest_seconds": pytest.approx(0, abs=5)}
+
+    await queue.ack(claimed)
+    assert (await queue.stats())[a1]["length"] == 0
+    assert await queue.read([a1], "worker-1", 10, pending=True) == []
+
+
+@pytest.mark.asyncio
+async def test_batches_failing_too_often_go_to_dead_letters(make_bus, points):
+    queue = RedisIngestQueue(fakeredis.aioredis.FakeRedis(decode_responses=True),
+                             partitions=1)
+    await queue.create_groups()
+    buffer = PoisonBuffer("a1")
+    bus = make_bus(buffer=buffer)
+    dead_letters = FakeDeadLetters()
+    for user_id in ("b2", "a1", "c3"):
+        await queue.enqueue(points(user_id, 2))
+    worker = IngestWorker(bus, queue, [0], "worker-0", count=10, max_deliveries=3,
+                          dead_letters=dead_letters)
+
+    with pytest.raises(ValueError):
+        await worker.run_once()
+    with pytest.raises(ValueError):
+        await worker.recover()
+    assert not dead_letters.letters
+
+    # The batch before it was stored on the first retry, the one after it
+    # waits for it to be given up on
+    assert await worker.recover() == 2
+    assert [(i.event, i.handler, i.attempts) for i in dead_letters.letters] == \
+        [(commands.PutLocations(points("a1", 2)), "IngestWorker", 3)]
+    assert (await queue.stats())[0]["length"] == 0
+    assert sorted(buffer.buffers) == ["b2", "c3"]
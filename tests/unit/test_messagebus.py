@@ -0,0 +1,131 @@
+import asyncio
+from dataclasses import dataclass
+
+import pytest
+
+from api.domain import commands, events
+from api.service_layer.messagebus import MessageBus
+from tests.fakes import FakeDeadLetters
+
+
+@dataclass
+class Echo(commands.Command):
+    value: int
+
+
+@dataclass
+class Happened(events.Event):
+    value: int
+
+
+class FakeUow:
+    """Hands out the events the handlers pretend to raise."""
+
+    def __init__(self):
+        self.pending = []
+
+    def collect_new_events(self):
+        while self.pending:
+            yield self.pending.pop(0)
+
+
+def make_bus(event_handlers=(), uow=None, **kwargs):
+    async def echo(cmd):
+        await asyncio.sleep(0.01 * (3 - cmd.value))
+        return cmd.value
+
+    return MessageBus(uow or FakeUow(), {Happened: list(event_handlers)},
+                      {Echo: echo}, **kwargs)
+
+
+@pytest.mark.asyncio
+async def test_concurrent_calls_get_their_own_results():
+    bus = make_bus()
+
+    results = await asyncio.gather(*[bus.handle(Echo(i)) for i in range(3)])
+
+    assert results == [0, 1, 2]
+
+
+@pytest.mark.asyncio
+async def test_events_raised_by_the_command_are_handled_before_returning():
+    uow = FakeUow()
+    handled = []
+
+    async def record(event):
+        handled.append(event.value)
+
+    bus = make_bus([record], uow=uow)
+    uow.pending.append(Happened(7))
+
+    assert await bus.handle(Echo(1)) == 1
+    assert handled == [7]
+
+
+@pytest.mark.asyncio
+async def test_event_handlers_run_concurrently_up_to_the_limit():
+    running = 0
+    most = 0
+
+    async def handler(event):
+        nonlocal running, most
+        running += 1
+        most = max(most, running)
+        await asyncio.sleep(0.01)
+        running -= 1
+
+    bus = make_bus([handler] * 5, max_concurrency=2)
+    await bus.handle(Happened(1))
+
+    assert most == 2
+
+
+@pytest.mark.asyncio
+async def test_failing_event_handlers_are_retried_then_dead_lettered():
+    attempts = []
+
+    async def flaky(event):
+        attempts.append(event.value)
+        raise RuntimeError("down")
+
+    dead_letters = FakeDeadLetters()
+    bus = make_bus([flaky], dead_letters=dead_letters, retries=2, backoff=0)
+    await bus.handle(Happened(3))
+
+    assert attempts == [3, 3, 3]
+    [letter] = dead_letters.letters
+    assert (letter.event, letter.handler, letter.attempts) == (Happened(3), "flaky", 3)
+
+
+@pytest.mark.asyncio
+async def test_redrive_runs_the_failed_handler_again():
+    fail = True
+    handled = []
+
+    async def flaky(event):
+        if fail:
+            raise RuntimeError("down")
+        handled.append(event.value)
+
+    async def other(event):
+        handled.append(-event.value)
+
+    dead_letters = FakeDeadLetters()
+    bus = make_bus([flaky, other], dead_letters=dead_letters, retries=0)
+    await bus.handle(Happened(4))
+    fail = False
+
+    assert await bus.redrive_dead_letters() == 1
+    assert handled == [-4, 4]
+    assert not dead_letters.letters
+
+
+@pytest.mark.asyncio
+async def test_failing_commands_raise():
+    async def broken(cmd):
+        raise ValueError("bad")
+
+    bus = MessageBus(FakeUow(), {}, {Echo: broken})
+
+    with pytest.raises(ValueError):
+        await bus.handle(Echo(1))
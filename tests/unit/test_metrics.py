@@ -0,0 +1,37 @@
+from api.utils.metrics import Counter, Gauge, Histogram, Registry
+
+
+def test_counter_renders_per_label():
+    registry = Registry()
+    points = Counter("points_total", "Points", ["status"], registry=registry)
+    points.labels("accepted").inc(3)
+    points.labels("duplicate").inc()
+
+    assert registry.render() == (
+        '# HELP points_total Points\n'
+        '# TYPE points_total counter\n'
+        'points_total{status="accepted"} 3\n'
+        'points_total{status="duplicate"} 1\n')
+
+
+def test_histogram_buckets_are_cumulative():
+    registry = Registry()
+    seconds = Histogram("seconds", "Time", buckets=(0.1, 1.0), registry=registry)
+    for value in (0.05, 0.1, 0.5, 2.0):
+        seconds.observe(value)
+
+    assert registry.render().splitlines()[2:] == [
+        'seconds_bucket{le="0.1"} 2',
+        'seconds_bucket{le="1.0"} 3',
+        'seconds_bucket{le="+Inf"} 4',
+        'seconds_sum 2.65',
+        'seconds_count 4',
+    ]
+
+
+def test_gauge_and_label_escaping():
+    registry = Registry()
+    cache = Gauge("cache", "Cache", ["stat"], registry=registry)
+    cache.labels('say "hi"').set(0.5)
+
+    assert registry.render().splitlines()[-1] == 'cache{stat="say \\"hi\\""} 0.5'
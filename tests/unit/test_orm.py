@@ -0,0 +1,31 @@
+from datetime import date
+
+from sqlalchemy import MetaData
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.schema import CreateTable
+
+from api.adapters import orm
+
+
+def test_partitioned_table_keys_hold_the_timestamp():
+    table = orm.location_table(MetaData(), partitioned=True,
+                               postgresql_partition_by="RANGE (timestamp)")
+    ddl = str(CreateTable(table).compile(dialect=postgresql.dialect()))
+
+    assert "PRIMARY KEY (timestamp, id)" in ddl
+    assert "PARTITION BY RANGE (timestamp)" in ddl
+    assert [index.name for index in table.indexes] == ["ix_locations_user_id_timestamp"]
+
+
+def test_create_partition_statement():
+    assert orm.create_partition_statement(date(2024, 2, 29)) == (
+        "CREATE TABLE IF NOT EXISTS locations_p20240229 PARTITION OF locations "
+        "FOR VALUES FROM ('2024-02-29') TO ('2024-03-01')")
+
+
+def test_expired_partitions():
+    names = ["locations_p20240103", "locations_default", "locations_p20240101",
+             "locations_p20240102", "other_p20240101"]
+
+    assert orm.expired_partitions(names, date(2024, 1, 3)) == [
+        "locations_p20240101", "locations_p20240102"]
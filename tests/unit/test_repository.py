@@ -0,0 +1,161 @@
+from datetime import datetime
+
+import pytest
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+
+from api.adapters import orm
+from api.adapters.repository import (MongoDBRepository, SqlAlchemyRepository, chunks,
+                                     merge_duplicates, nearest)
+from api.domain import models
+
+
+def location(lat, samples=1, user_id="a1", minute=0, accuracy=10.0):
+    return models.Location(timestamp=datetime(2017, 7, 30, 0, minute), lat=lat,
+                           long=-73.9, accuracy=accuracy, speed=0.0, user_id=user_id,
+                           samples=samples)
+
+
+def test_merge_duplicates_weights_means_with_samples():
+    merged = merge_duplicates([location(1.0), location(3.0, samples=3),
+                               location(5.0, user_id="b2"), location(7.0, minute=1)])
+
+    assert [(m.user_id, m.timestamp.minute, m.lat, m.samples) for m in merged] == [
+        ("a1", 0, 2.5, 4), ("b2", 0, 5.0, 1), ("a1", 1, 7.0, 1)]
+
+
+def test_merge_duplicates_leaves_out_missing_means():
+    [merged] = merge_duplicates([location(1.0), location(3.0, samples=3, accuracy=None)])
+
+    assert (merged.lat, merged.accuracy, merged.samples) == (2.5, 10.0, 4)
+
+
+async def sqlite_sessions():
+    # SQLite takes the same INSERT .. ON CONFLICT .. RETURNING as postgres
+    orm.start_mappers()
+    engine = create_async_engine("sqlite+aiosqlite://")
+    async with engine.begin() as connection:
+        await connection.run_sync(orm.metadata.create_all)
+    return async_sessionmaker(engine, expire_on_commit=False, class_=AsyncSession)
+
+
+@pytest.mark.asyncio
+async def test_sql_upserts_merge_into_the_stored_minute():
+    sessions = await sqlite_sessions()
+    async with sessions() as session:
+        repository = SqlAlchemyRepository(session)
+        first = await repository.upsert(location(1.0, accuracy=None))
+        second = await repository.upsert(location(4.0, samples=2))
+        [third] = await repository.upsert_many([location(0.0), location(0.0, samples=2,
+                                                                        accuracy=16.0)])
+        await session.commit()
+
+    assert second.id == third.id == first.id
+    assert (second.lat, second.accuracy, second.samples) == (3.0, 10.0, 3)
+    assert (third.lat, third.accuracy, third.samples) == (1.5, 12.0, 6)
+    async with sessions() as session:
+        stored = await SqlAlchemyRepository(session).get_last_location_for_user("a1")
+    assert (stored.lat, stored.samples) == (1.5, 6)
+
+
+def fields(location):
+    return (location.id, location.timestamp, location.lat, location.long,
+            location.accuracy, location.speed, location.user_id, location.samples)
+
+
+@pytest.mark.asyncio
+async def test_sql_reads_match_the_mapped_rows():
+    sessions = await sqlite_sessions()
+    async with sessions() as session:
+        session.add_all([location(float(minute), samples=minute + 1, user_id=user_id,
+                                  minute=minute, accuracy=None if minute else 5.0)
+                         for user_id in ("a1", "b2") for minute in range(3)])
+        await session.commit()
+    async with sessions() as session:
+        # What the getters read through the ORM before
+        mapped = {(i.user_id, i.timestamp.minute): fields(i) for i in (
+            await session.execute(select(models.Location))).scalars()}
+
+    # get_last_locations_for_users takes DISTINCT ON, postgres only
+    async with sessions() as session:
+        repository = SqlAlchemyRepository(session)
+        last = await repository.get_last_location_for_user("a1")
+        at = await repository.get_location_by_timestamp("b2", datetime(2017, 7, 30, 0, 0))
+        by_id = await repository.get(last.id)
+        stream = [i async for i in repository.get_range(
+            "a1", after=datetime(2017, 7, 30, 0, 0), limit=1)]
+        assert await repository.get_last_location_for_user("c3") is None
+
+    assert fields(last) == fields(by_id) == mapped[("a1", 2)]
+    assert fields(at) == mapped[("b2", 0)]
+    assert [fields(i) for i in stream] == [mapped[("a1", 1)]]
+
+
+def test_chunks():
+    assert list(chunks([1, 2, 3, 4, 5], 2)) == [[1, 2], [3, 4], [5]]
+
+
+def test_nearest_keeps_locations_within_the_radius():
+    here, there = location(40.7), location(40.71, user_id="b2")
+    far = location(41.0, user_id="c3")
+
+    near = nearest([far, there, here], 40.7, -73.9, radius=2000)
+
+    assert [(i.user_id, round(d)) for i, d in near] == [("a1", 0), ("b2", 1112)]
+    assert nearest([here], 40.7, -73.9, 1000, since=datetime(2017, 7, 31)) == []
+
+
+class DocumentCollection:
+    """The find and find_one calls of the mongo getters, over documents
+    kept in a list."""
+
+    def __init__(self, documents):
+        self.documents = documents
+        self.found = []
+
+    def find(self, query):
+        self.found = [dict(i) for i in self.documents
+                      if all(i[key] == value for key, value in query.items())]
+        return self
+
+    def sort(self, key, direction):
+        self.found.sort(key=lambda i: i[key], reverse=direction < 0)
+        return self
+
+    def limit(self, count):
+        self.found = self.found[:count]
+        return self
+
+    async def to_list(self, length):
+        return self.found[:length]
+
+    async def find_one(self, query):
+        found = self.find(query).found
+        return found[0] if found else None
+
+
+@pytest.mark.asyncio
+async def test_mongo_getters_leave_out_positions():
+    stored = [location(40.7), location(40.8, minute=1)]
+    collection = DocumentCollection([])
+    repository = MongoDBRepository({"locations": {"locations": collection,
+                                                  "locations_rollups": None}},
+                                   "locations", "locations", None, geo=True)
+    collection.documents = [dict(repository._document(i), _id=n) for n, i in enumerate(stored)]
+
+    assert await repository.get_last_location_for_user("a1") == stored[1]
+    assert await repository.get_location_by_timestamp("a1", stored[0].timestamp) == stored[0]
+    assert await repository.get_location_by_timestamp("b2", stored[0].timestamp) is None
+
+
+def test_mongo_positions_follow_the_merged_mean():
+    repository = MongoDBRepository({"locations": {"locations": None,
+                                                  "locations_rollups": None}},
+                                   "locations", "locations", None, geo=True)
+
+    assert repository._document(location(40.7))["position"] == {
+        "type": "Point", "coordinates": [-73.9, 40.7]}
+    merge, position = repository._update(location(40.7))
+    assert "lat" in merge["$set"]
+    assert position == {"$set": {"position": {"type": "Point",
+                                              "coordinates": ["$long", "$lat"]}}}
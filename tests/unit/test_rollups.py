@@ -0,0 +1,72 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from api.backfill import backfill
+from api.domain import models
+from api.utils.rollups import bucket_of, haversine, merge, rollups_of
+from tests.fakes import FakeUnitOfWork
+
+
+def point(second, lat, speed=1.0, user_id="a1"):
+    return {"timestamp": datetime(2017, 1, 1, 13, 4) + timedelta(seconds=second),
+            "lat": lat, "long": -73.9, "speed": speed, "user_id": user_id}
+
+
+def test_bucket_of():
+    timestamp = datetime(2017, 1, 1, 13, 7, 12)
+
+    assert bucket_of(timestamp, timedelta(minutes=5)) == datetime(2017, 1, 1, 13, 5)
+    assert bucket_of(timestamp, timedelta(days=1)) == datetime(2017, 1, 1)
+
+
+def test_haversine():
+    # A degree of latitude
+    assert haversine(40.0, -73.9, 41.0, -73.9) == pytest.approx(111_195, abs=1)
+
+
+def test_rollups_sum_points_into_every_resolution():
+    rollups = rollups_of([point(90, 40.002, speed=None), point(30, 40.0, speed=3.0),
+                          point(60, 40.001)])
+
+    assert [(r.resolution, r.bucket.minute, r.points) for r in rollups] == [
+        ("1d", 0, 3), ("1h", 0, 3), ("5m", 0, 1), ("5m", 5, 2)]
+    day = rollups[0]
+    assert day.lat == pytest.approx(40.001)
+    assert day.max_speed == 3.0
+    assert day.distance == pytest.approx(haversine(40.0, -73.9, 40.002, -73.9))
+
+
+def test_merged_rollups_equal_rollups_of_all_points():
+    points = [point(second, 40.0 + second / 1000, speed=second % 7) for second in range(0, 600, 7)]
+    merged = {}
+    for start in range(0, len(points), 10):
+        for rollup in rollups_of(points[start:start + 10]):
+            key = (rollup.resolution, rollup.bucket)
+            merged[key] = merge(merged[key], rollup) if key in merged else rollup
+
+    for rollup in rollups_of(points):
+        other = merged[(rollup.resolution, rollup.bucket)]
+        assert (other.points, other.max_speed, other.last_timestamp) == (
+            rollup.points, rollup.max_speed, rollup.last_timestamp)
+        assert other.sum_lat == pytest.approx(rollup.sum_lat)
+        assert other.distance == pytest.approx(rollup.distance)
+
+
+@pytest.mark.asyncio
+async def test_backfill_rebuilds_rollups_from_minutes():
+    uow = FakeUnitOfWork()
+    for minute in range(3):
+        location = models.Location(timestamp=datetime(2017, 1, 1, 13, minute),
+                                   lat=40.0 + minute / 100, long=-73.9, accuracy=5.0,
+                                   speed=float(minute), user_id="a1", samples=2)
+        uow.rows[(location.user_id, location.timestamp)] = location
+
+    await backfill(uow, chunk_size=2)
+    await backfill(uow, chunk_size=2)
+
+    async with uow:
+        [hour] = await uow.locations.get_rollups("a1", "1h")
+    assert (hour.points, hour.max_speed) == (6, 2.0)
+    assert hour.lat == pytest.approx(40.01)
+    assert hour.distance == pytest.approx(haversine(40.0, -73.9, 40.02, -73.9))
@@ -0,0 +1,19 @@
+from simulation.simulate import fan_out, percentile
+
+
+def test_fan_out_copies_users_with_new_ids():
+    users = {"a1": [{"lat": 1.0, "user_id": "a1"}, {"lat": 2.0, "user_id": "a1"}]}
+
+    copies = fan_out(users, 2, limit=1)
+
+    assert copies == {"a1-0": [{"lat": 1.0, "user_id": "a1-0"}],
+                      "a1-1": [{"lat": 1.0, "user_id": "a1-1"}]}
+
+
+def test_percentile_is_nearest_rank():
+    values = [float(i) for i in range(1, 101)]
+
+    assert percentile(values, 50) == 50.0
+    assert percentile(values, 99) == 99.0
+    assert percentile(values, 100) == 100.0
+    assert percentile([], 95) == 0.0
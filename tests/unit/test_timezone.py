@@ -0,0 +1,78 @@
+from datetime import datetime
+
+import pytz
+
+from api.utils.timezone import TimezoneResolver
+
+
+def test_convert_matches_uncached_conversion():
+    resolver = TimezoneResolver()
+    timestamp = datetime(2017, 1, 1, 13, 5, 12)
+
+    assert resolver.convert(timestamp, 40.701, -73.916) == datetime(2017, 1, 1, 18, 5, 12)
+    # Same cell, from the cache this time
+    assert resolver.convert(timestamp, 40.702, -73.917) == datetime(2017, 1, 1, 18, 5, 12)
+    assert resolver.stats()["cell_hits"] == 1
+
+
+def test_convert_keeps_aware_timestamps():
+    resolver = TimezoneResolver()
+    timestamp = pytz.timezone("Europe/Berlin").localize(datetime(2017, 7, 1, 12))
+
+    assert resolver.convert(timestamp, 40.701, -73.916) == datetime(2017, 7, 1, 10)
+    assert resolver.stats()["lookups"] == 0
+
+
+def test_user_fast_path():
+    resolver = TimezoneResolver()
+    resolver.timezone_at(40.701, -73.916, user_id="a1")
+    resolver.timezone_at(40.7011, -73.9161, user_id="a1")
+
+    assert resolver.stats()["user_hits"] == 1
+
+
+def test_border_cells_are_resolved_exactly():
+    # Cell crossing the New York / Chicago border at the Indiana / Ohio line
+    resolver = TimezoneResolver(precision=0)
+    tz = resolver.timezone_at(40.5, -84.9)
+
+    assert tz.zone == resolver.finder.timezone_at(lng=-84.9, lat=40.5)
+    resolver.timezone_at(40.6, -84.95)
+    assert resolver.stats()["border_lookups"] == 2
+
+
+def test_convert_many_and_eviction():
+    resolver = TimezoneResolver(maxsize=1)
+    timestamps = [datetime(2017, 1, 1, 13), datetime(2017, 1, 1, 13)]
+
+    utc = resolver.convert_many(timestamps, [40.701, 52.52], [-73.916, 13.405])
+
+    assert utc == [datetime(2017, 1, 1, 18), datetime(2017, 1, 1, 12)]
+    assert resolver.stats()["cells"] == 1
+
+
+def test_convert_many_looks_up_each_cell_once():
+    resolver = TimezoneResolver()
+    berlin = pytz.timezone("Europe/Berlin").localize(datetime(2017, 7, 1, 12))
+    timestamps = [datetime(2017, 1, 1, 13, minute) for minute in range(4)] + [berlin]
+    lats = [40.701, 52.52, 40.702, 52.521, 40.701]
+    longs = [-73.916, 13.405, -73.917, 13.406, -73.916]
+    user_ids = ["a1", "b2", "c3", "b2", "a1"]
+
+    utc = resolver.convert_many(timestamps, lats, longs, user_ids)
+
+    assert utc == [TimezoneResolver().convert(*point)
+                   for point in zip(timestamps, lats, longs, user_ids)]
+    assert resolver.stats()["lookups"] == 2
+    assert set(resolver.users) == {"a1", "b2", "c3"}
+
+
+def test_convert_many_resolves_border_cells_point_by_point():
+    resolver = TimezoneResolver(precision=0)
+    timestamps = [datetime(2017, 1, 1, 13), datetime(2017, 1, 1, 13)]
+
+    utc = resolver.convert_many(timestamps, [40.5, 40.6], [-84.9, -84.95])
+
+    assert utc == [TimezoneResolver().convert(timestamp, lat, long) for timestamp, lat, long
+                   in zip(timestamps, [40.5, 40.6], [-84.9, -84.95])]
+    assert resolver.stats()["border_lookups"] == 2
@@ -0,0 +1,68 @@
+import asyncio
+
+import pytest
+
+from api.adapters import repository
+from api.service_layer import unit_of_work
+
+
+class FakeSession:
+    def __init__(self):
+        self.committed = False
+
+    async def commit(self):
+        self.committed = True
+
+    async def rollback(self):
+        pass
+
+    async def close(self):
+        pass
+
+
+@pytest.mark.asyncio
+async def test_sessions_are_kept_per_task():
+    uow = unit_of_work.SqlAlchemyUnitOfWork(FakeSession)
+
+    async def request():
+        async with uow:
+            session = uow.session
+            await asyncio.sleep(0)
+            await uow.commit()
+            return session, uow.session
+
+    for session, after in await asyncio.gather(*[request() for _ in range(10)]):
+        assert session is after
+        assert session.committed
+
+
+@pytest.mark.asyncio
+async def test_read_only_skips_commit():
+    uow = unit_of_work.SqlAlchemyUnitOfWork(FakeSession)
+
+    async with uow.read_only():
+        await uow.commit()
+        assert not uow.session.committed
+    assert not uow.is_read_only
+
+
+@pytest.mark.asyncio
+async def test_read_only_mongo_starts_no_session():
+    uow = unit_of_work.MongoDBUnitOfWork(
+        client={"locations": {"locations": None, "locations_rollups": None}})
+
+    async with uow.read_only():
+        await uow.commit()
+        assert uow.session is None
+
+
+@pytest.mark.asyncio
+async def test_mongo_without_transactions_starts_no_session():
+    uow = unit_of_work.MongoDBUnitOfWork(
+        client={"locations": {"locations": None, "locations_rollups": None}},
+        transactions=False, timeseries=True)
+
+    async with uow:
+        assert uow.session is None
+        assert isinstance(uow.locations, repository.MongoDBTimeSeriesRepository)
+        await uow.commit()
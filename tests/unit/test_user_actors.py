@@ -0,0 +1,63 @@
+import asyncio
+
+import pytest
+
+from api.service_layer.user_actors import UserActors
+
+
+@pytest.mark.asyncio
+async def test_points_arriving_together_are_stored_in_one_batch(make_bus, points):
+    bus = make_bus()
+    handled = []
+
+    async def handle(cmd):
+        handled.append(len(cmd.locations))
+        return await bus.handle(cmd)
+    actors = UserActors(handle, max_batch=4)
+
+    statuses = await asyncio.gather(*[actors.put(cmd)
+                                      for cmd in points("a1", 6) + points("a1", 1)])
+
+    # The first point was flushed with its minute by then
+    assert statuses == ["accepted"] * 6 + ["out_of_order"]
+    assert handled == [4, 3]
+    # The fourth point closed the first minute, the rest is still buffered
+    [location] = bus.uow.rows.values()
+    assert location.samples == 3
+    assert bus.uow.commits == 1
+
+
+@pytest.mark.asyncio
+async def test_users_are_stored_by_their_own_actor(make_bus, points):
+    bus = make_bus()
+    actors = UserActors(bus.handle)
+
+    await asyncio.gather(*[actors.put(cmd) for cmd in points("a1", 4) + points("b2", 4)])
+
+    assert sorted(user_id for user_id, _ in bus.uow.rows) == ["a1", "b2"]
+    assert actors.stats()["batches"] == 2
+
+
+@pytest.mark.asyncio
+async def test_a_failed_batch_fails_each_of_its_points(points):
+    async def handle(cmd):
+        raise ConnectionError("redis is down")
+    actors = UserActors(handle)
+
+    results = await asyncio.gather(*[actors.put(cmd) for cmd in points("a1", 2)],
+                                   return_exceptions=True)
+
+    assert [type(result) for result in results] == [ConnectionError] * 2
+
+
+@pytest.mark.asyncio
+async def test_idle_actors_end_after_the_ttl(make_bus, points):
+    actors = UserActors(make_bus().handle, ttl=0.01)
+    await actors.put(points("a1", 1)[0])
+    assert actors.stats()["actors"] == 1
+
+    await asyncio.sleep(0.05)
+
+    assert actors.mailboxes == {}
+    assert actors.stats()["evicted"] == 1
+    assert await actors.put(points("a1", 2)[1]) == "accepted"
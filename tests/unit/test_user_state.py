@@ -0,0 +1,75 @@
+from api.utils.user_state import MINUTE_US, UserStateCache
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_unknown_and_newer_points_go_to_redis():
+    cache = UserStateCache()
+    assert cache.check("a1", 10) is None
+
+    cache.accepted("a1", 10)
+
+    assert cache.check("a1", 11) is None
+    assert cache.check("b2", 10) is None
+
+
+def test_points_not_newer_are_turned_away():
+    cache = UserStateCache()
+    cache.accepted("a1", 10)
+    cache.accepted("a1", 20)
+
+    assert cache.check("a1", 10) == "duplicate"
+    assert cache.check("a1", 20) == "duplicate"
+    assert cache.check("a1", 15) == "out_of_order"
+    assert cache.stats()["hit_rate"] == 3 / 3
+
+
+def test_closing_a_minute_starts_a_new_buffer():
+    cache = UserStateCache()
+    cache.accepted("a1", 10)
+    cache.accepted("a1", 10 + MINUTE_US)
+
+    # Flushed with the previous minute, redis no longer has it buffered
+    assert cache.check("a1", 10) == "out_of_order"
+    assert cache.check("a1", 10 + MINUTE_US) == "duplicate"
+
+
+def test_entries_expire():
+    clock = Clock()
+    cache = UserStateCache(ttl=60, clock=clock)
+    cache.accepted("a1", 10)
+    clock.now = 60
+
+    assert cache.check("a1", 10) is None
+    assert cache.stats()["expired"] == 1
+
+
+def test_least_recently_used_users_are_evicted():
+    cache = UserStateCache(maxsize=2)
+    cache.accepted("a1", 10)
+    cache.accepted("b2", 10)
+    cache.accepted("a1", 20)
+    cache.accepted("c3", 10)
+
+    assert cache.check("b2", 10) is None
+    assert cache.check("a1", 10) == "duplicate"
+    assert cache.stats()["evicted"] == 1
+
+
+def test_new_epoch_empties_the_cache():
+    cache = UserStateCache()
+    cache.check_epoch("1")
+    cache.accepted("a1", 10)
+    cache.check_epoch("1")
+    assert cache.check("a1", 10) == "duplicate"
+
+    cache.check_epoch("2")
+
+    assert cache.check("a1", 10) is None
+    assert cache.stats()["resets"] == 1